@@ -1,14 +1,338 @@
+import itertools
+
 import pandas as pd
-from data_wrangling import DataCleaning
+import tracing
+from aggregate_cache import AggregateCache
+from data_wrangling import DATE_PARTS, DataCleaning
+from date_index import date_index_of
+from kpi_cube import KpiCube
+from kpi_incremental import IncrementalKpiState
+from kpi_query import KpiQuery
+from parallel import EVENT_SOURCES, partitioned_joins
+from retention import DEFAULT_COHORT, DEFAULT_DAYS, CohortRetention
+
+FRAMES = ('adspend', 'installs', 'payouts', 'revenue')
+# The input frames each cached entry is derived from, so that appending rows to one frame only drops the entries
+# that depend on it; entries not listed here depend on every frame.
+DEPENDENCIES = {
+    'daily_acquisition': ('adspend', 'installs'),
+    'user_acquisition_costs': ('adspend', 'installs'),
+    'revenue_generated_per_install': ('installs', 'revenue'),
+    'total_payouts_made_per_install': ('installs', 'payouts'),
+    'retention_activity': ('installs', 'payouts', 'revenue'),
+    'user_retention_rate': ('installs', 'payouts', 'revenue'),
+    'cohort_retention_engine': ('installs', 'payouts', 'revenue'),
+    'cohort_retention': ('installs', 'payouts', 'revenue'),
+    'installs_have_ids': ('installs',),
+    'unique_installs': ('installs',),
+}
+
+
+def _frame_property(name):
+    def get(self):
+        # Rows added with append are only concatenated when a computation needs the raw frame
+        if self._appended[name]:
+            self._frames[name] = pd.concat([self._frames[name]] + self._appended[name], ignore_index=True)
+            self._appended[name] = []
+        return self._frames[name]
+
+    def set(self, df):
+        self._frames[name] = df
+        self._appended[name] = []
+        self._versions[name] += 1
+        self._incremental = None
+
+    return property(get, set, doc=f'The {name} frame, including the rows added with append.')
 
 
 class KpiAnalytics:
-    def __init__(self, adspend_df, installs_df, payouts_df, revenue_df):
+    _namespaces = itertools.count()
+
+    adspend_df = _frame_property('adspend')
+    installs_df = _frame_property('installs')
+    payouts_df = _frame_property('payouts')
+    revenue_df = _frame_property('revenue')
+
+    def __init__(self, adspend_df, installs_df, payouts_df, revenue_df, cache=None, id_encoder=None, use_cube=True,
+                 workers=1):
+        self._frames = {}
+        self._appended = {name: [] for name in FRAMES}
+        self._versions = dict.fromkeys(FRAMES, 0)
+        self._incremental = None
         self.adspend_df = adspend_df
         self.installs_df = installs_df
         self.payouts_df = payouts_df
         self.revenue_df = revenue_df
+        # Intermediate aggregates and results are memoized here; pass one AggregateCache to several instances to
+        # share the memory budget between them.
+        self.cache = cache if cache is not None else AggregateCache()
+        self._namespace = next(self._namespaces)
+        # When the id columns were encoded with DataCleaning.id_columns_to_codes, all joins and groupbys run on the
+        # integer codes and the labels are restored only in the returned results.
+        self.id_encoder = id_encoder
+        # Group-bys over network, country and date columns are answered from the network x country x day cube
+        # instead of the event rows.
+        self.use_cube = use_cube
+        # With more than one worker the install event and retention joins run on install_id partitions in a process
+        # pool; the results are identical to the serial ones.
+        self.workers = workers
+
+    def invalidate_cache(self):
+        """
+        Drops every cached aggregate and result of this instance. Call it after modifying one of the input frames in
+        place; replacing a frame attribute is detected automatically.
+
+        :return: None
+        :rtype: None
+        """
+        self.cache.invalidate(self._namespace)
+        self._incremental = None
+
+    @tracing.traced('KpiAnalytics.append')
+    def append(self, adspend_df=None, installs_df=None, payouts_df=None, revenue_df=None):
+        """
+        Adds a new batch of rows (typically one day) without recomputing the history. The day-grain cube and the
+        per-install retention state are updated for the affected installs and cells only, including revenue and
+        payouts that arrive late for older installs; all KPIs answered from the cube then reflect the new rows. The
+        first call builds the incremental state from the history once. The raw frames are only concatenated when a
+        KPI that needs the event rows (e.g. grouped by install_id) is requested.
+
+        The frames must be cleaned like the ones the instance was created with. If the installs contain an install
+        id that was already ingested, or lack network or country ids, the rows are still added and the next query
+        recomputes from the raw frames.
+
+        :param adspend_df: New ad spend rows.
+        :type adspend_df: pandas.DataFrame
+        :param installs_df: New installs.
+        :type installs_df: pandas.DataFrame
+        :param payouts_df: New payout events.
+        :type payouts_df: pandas.DataFrame
+        :param revenue_df: New revenue events.
+        :type revenue_df: pandas.DataFrame
+        :return: None
+        :rtype: None
+        """
+        if self.use_cube and self._incremental is None:
+            self._derive_join_date_parts()
+            self._incremental = IncrementalKpiState.from_analytics(self)
+        batches = dict(zip(FRAMES, (adspend_df, installs_df, payouts_df, revenue_df)))
+        for name, df in batches.items():
+            # The batch gets the date columns of the history, so that the concatenated frames have no gaps. They are
+            # added to a copy: the caller's frame is left as it was
+            if df is not None and len(df):
+                missing = [col for col in DATE_PARTS if col in self._frames[name].columns and col not in df.columns]
+                if missing:
+                    batches[name] = DataCleaning.break_down_date(df.copy(), missing)
+        adspend_df, installs_df, payouts_df, revenue_df = (batches[name] for name in FRAMES)
+        if self._incremental is not None and self._incremental.can_append(installs_df):
+            self._incremental.append(adspend_df=adspend_df, installs_df=installs_df, payouts_df=payouts_df,
+                                     revenue_df=revenue_df)
+        else:
+            self._incremental = None
+
+        appended = set()
+        for name, df in zip(FRAMES, (adspend_df, installs_df, payouts_df, revenue_df)):
+            if df is not None and len(df):
+                self._appended[name].append(df)
+                self._versions[name] += 1
+                appended.add(name)
+        if appended:
+            # Only the entries derived from the appended frames are dropped
+            self.cache.invalidate(self._namespace, lambda key: appended.intersection(
+                self._dependencies(key[1], key[2:-1])))
+
+    @staticmethod
+    def _dependencies(name, args):
+        if name == 'install_events':
+            return ('installs', args[0])
+        if name == 'date_index':
+            return args
+        if name.endswith(' labelled'):
+            name = name[:-len(' labelled')]
+        return DEPENDENCIES.get(name, FRAMES)
+
+    def _cache_key(self, name, *args):
+        args = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        # The versions of the frames the entry depends on, so that replacing one of them misses only those entries
+        versions = tuple(self._versions[frame] for frame in self._dependencies(name, args))
+        return (self._namespace, name) + args + (versions,)
+
+    def _cached(self, name, compute, *args):
+        if tracing.active() is not None:
+            # Only cache misses do work worth a span of their own
+            compute = tracing.traced(f'KpiAnalytics compute {name}')(compute)
+        return self.cache.get_or_compute(self._cache_key(name, *args), compute)
+
+    def _decode(self, df, groupby_column, object_ids=False):
+        """
+        Restores the id labels of a result and re-sorts it by its group keys, since groupby sorted it by code.
+        """
+        df = self.id_encoder.decode(df)
+        if object_ids:
+            process_df = DataCleaning(data=df, columns=list(df.columns))
+            process_df.id_columns_to_object()
+            df = process_df.data
+        sort_columns = groupby_column if isinstance(groupby_column, list) else [groupby_column]
+        if any(col in self.id_encoder.labels for col in sort_columns):
+            df = df.sort_values(sort_columns, ignore_index=True)
+        return df
+
+    def _labelled_result(self, name, result, groupby_column, *args, object_ids=False):
+        """
+        Returns a copy of a cached result with the id labels restored. Results are handed out as copies so that
+        callers (e.g. the charts, which cast columns in place) cannot corrupt the cached frame.
+        """
+        if self.id_encoder is None:
+            return result.copy()
+        return self._cached(name + ' labelled', lambda: self._decode(result.copy(), groupby_column, object_ids),
+                            groupby_column, *args).copy()
+
+    def _daily_acquisition(self):
+        """
+        Installs, ad spend and user acquisition cost per network, country and day, with the date broken down.
+        """
+        def compute():
+            # Aggregate adspend data by network_id
+            adspend_per_network = self.adspend_df.groupby(['network_id', 'country_id', 'event_date'])[
+                'value_usd'].sum()
+
+            # Merge with installs data on network_id
+            installs_per_network = self.installs_df.groupby(['network_id', 'country_id', 'event_date'])[
+                'install_id'].count().reset_index()
+            installs_with_adspend = tracing.merge(installs_per_network, adspend_per_network,
+                                                  name='KpiAnalytics merge installs with adspend',
+                                                  on=['network_id', 'country_id', 'event_date'], how='left')
+            installs_with_adspend.fillna(0, inplace=True)
+
+            # Calculate user acquisition cost per network
+            installs_with_adspend['user_acquisition_cost_usd'] = installs_with_adspend['value_usd'] / \
+                                                                 installs_with_adspend['install_id']
+            return DataCleaning.break_down_date(installs_with_adspend)
+
+        return self._cached('daily_acquisition', compute)
+
+    def _install_events(self, source):
+        """
+        Revenue or payouts summed per install and day, outer-joined with the installs. The value column is named
+        '<source>_per_install_usd'.
+        """
+        def compute():
+            joins = self._partitioned_joins()
+            if joins is not None:
+                return joins[('install_events', source)]
+
+            self._derive_date_parts('installs', DATE_PARTS)
+            events_df = self.revenue_df if source == 'revenue' else self.payouts_df
+            agregated_events = events_df.groupby(['install_id', 'event_date'])['value_usd'].sum().reset_index()
+            events_with_installs = tracing.merge(agregated_events, self.installs_df,
+                                                 name='KpiAnalytics merge events with installs',
+                                                 on=['install_id', 'event_date'], how='outer')
+            return self._events_frame(events_with_installs, source)
+
+        return self._cached('install_events', compute, source)
+
+    @staticmethod
+    def _events_frame(events_with_installs, source):
+        return events_with_installs.rename(columns={'value_usd': f'{source}_per_install_usd'})
+
+    def _retention_activity(self):
+        """
+        Installs joined with the last monthly payout and revenue activity, with the number of days active.
+        """
+        def compute():
+            joins = self._partitioned_joins()
+            if joins is not None:
+                return joins[('retention_activity',)]
+
+            self._derive_date_parts('installs', DATE_PARTS)
+            payouts_df = self._monthly_last_activity('payouts')
+            revenue_df = self._monthly_last_activity('revenue')
+            installs_df = self.installs_df.rename(
+                columns={'event_date': 'install_date', 'year and month': 'install_year and month'})
+
+            df = tracing.merge(installs_df, payouts_df, name='KpiAnalytics merge installs with payout months',
+                               on='install_id', how='left')
+            df = tracing.merge(df, revenue_df, name='KpiAnalytics merge installs with revenue months', on='install_id',
+                               how='left')
+            return self._activity_frame(df)
+
+        return self._cached('retention_activity', compute)
+
+    def _monthly_last_activity(self, source):
+        """
+        The last event date of every install per month. On a frame sorted by date each month is a slice, and the
+        last row of an install in it is its last date; the rows come grouped by month instead of sorted by install,
+        which keeps the months of every install in order, and that is all the joins with the installs depend on.
+        """
+        events_df = self.revenue_df if source == 'revenue' else self.payouts_df
+        index = self._date_index(source)
+        if index is None or not len(index):
+            events_df = self._derive_date_parts(source, ['year and month'])
+            return events_df.groupby(['install_id', 'year and month'])['event_date'].max().reset_index()
+
+        months = []
+        for month, start, end in index.months():
+            last = events_df.iloc[start:end].drop_duplicates('install_id', keep='last')[['install_id', 'event_date']]
+            last.insert(1, 'year and month', month)
+            months.append(last)
+        df = pd.concat(months, ignore_index=True)
+        # Like groupby, which drops missing ids and infers the type of object ids
+        df = df[df['install_id'].notna()].reset_index(drop=True)
+        df['install_id'] = df['install_id'].infer_objects()
+        return df
+
+    def _derive_date_parts(self, name, columns):
+        """
+        Adds the date columns a computation needs to a source frame that was loaded without them, in place like
+        break_down_date, and returns the frame.
+        """
+        df = getattr(self, f'{name}_df')
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            DataCleaning.break_down_date(df, missing)
+        return df
+
+    def _derive_join_date_parts(self):
+        """
+        The date columns the joins of the installs with their events carry: all of the installs', the events' months.
+        """
+        self._derive_date_parts('installs', DATE_PARTS)
+        for source in EVENT_SOURCES:
+            self._derive_date_parts(source, ['year and month'])
+
+    def _date_index(self, name):
+        """
+        The DateIndex of a source frame, or None if the frame is not sorted by date (appended rows are not).
+        """
+        return self._cached('date_index', lambda: date_index_of(getattr(self, f'{name}_df')), name)
+
+    @staticmethod
+    def _activity_frame(df):
+        df['last_active'] = df[['event_date_x', 'event_date_y']].max(axis=1)
+        df['days_active'] = (df['last_active'] - df['install_date']).dt.days
+        df['days_active'] = df['days_active'].fillna(0)
+        return df
 
+    def _partitioned_joins(self):
+        """
+        Runs the install event joins of both sources and the retention join in one partitioned pass over the worker
+        pool and caches all three, so that the other two are cache hits afterwards. Returns None in serial mode or
+        when the install ids cannot be partitioned.
+        """
+        if self.workers <= 1:
+            return None
+        self._derive_join_date_parts()
+        joins = partitioned_joins(self.installs_df, self.payouts_df, self.revenue_df, self.workers)
+        if joins is None:
+            return None
+
+        frames = {('install_events', source): self._events_frame(joins[source], source) for source in EVENT_SOURCES}
+        frames[('retention_activity',)] = self._activity_frame(joins['retention'])
+        for key, frame in frames.items():
+            self.cache.put(self._cache_key(*key), frame)
+        return frames
+
+    @tracing.traced('KpiAnalytics.user_acquisition_costs')
     def user_acquisition_costs(self, groupby_column='network_id', mean=True):
         """
         Calculates user acquisition costs by network from ad spend and installs data.
@@ -20,36 +344,81 @@ class KpiAnalytics:
         :return: A DataFrame of user acquisition costs by network.
         :rtype: pandas.DataFrame
         """
-        # Aggregate adspend data by network_id
-        adspend_per_network = self.adspend_df.groupby(['network_id', 'country_id', 'event_date'])['value_usd'].sum()
+        user_acquisition_costs_per_network = self._user_acquisition_costs(groupby_column, mean)
+        return self._labelled_result('user_acquisition_costs', user_acquisition_costs_per_network,
+                                     groupby_column, mean, object_ids=True)
 
-        # Merge with installs data on network_id
-        installs_per_network = self.installs_df.groupby(['network_id', 'country_id', 'event_date'])[
-            'install_id'].count().reset_index()
-        installs_with_adspend = pd.merge(installs_per_network, adspend_per_network,
-                                         on=['network_id', 'country_id', 'event_date'], how='left')
-        installs_with_adspend.fillna(0, inplace=True)
+    @tracing.traced('KpiAnalytics.cube')
+    def cube(self):
+        """
+        Returns the pre-aggregated network x country x day cube of the KPI measures, building it on first use.
+        Use KpiCube.rollup to materialize coarser grains such as network x month.
 
-        # Calculate user acquisition cost per network
-        installs_with_adspend['user_acquisition_cost_usd'] = installs_with_adspend['value_usd'] / \
-                                                             installs_with_adspend['install_id']
-        installs_with_adspend = DataCleaning.break_down_date(installs_with_adspend)
+        :return: The day-grain cube.
+        :rtype: KpiCube
+        """
+        if self._incremental is not None:
+            return self._cached('cube', self._incremental.cube)
+        return self._cached('cube', lambda: KpiCube.from_frames(
+            self._daily_acquisition(), self._install_events('revenue'), self._install_events('payouts'),
+            self._retention_activity()))
 
-        # Aggregate user acquisition cost by network
-        if mean:
-            user_acquisition_costs_per_network = installs_with_adspend.groupby(groupby_column)[
-                'user_acquisition_cost_usd'].mean().reset_index()
-        else:
-            user_acquisition_costs_per_network = installs_with_adspend.groupby(groupby_column)[
-                'user_acquisition_cost_usd'].sum().reset_index()
+    def query(self):
+        """
+        Starts a lazy query, which filters the source frames before computing the KPIs, e.g.
+        `analytics.query().where(country_id=[1, 2]).grouped_profit('network_id').collect()`.
 
-        process_df = DataCleaning(data=user_acquisition_costs_per_network,
-                                  columns=list(user_acquisition_costs_per_network.columns))
-        process_df.id_columns_to_object()
-        user_acquisition_costs_per_network = process_df.data
+        :return: An empty query over this instance.
+        :rtype: KpiQuery
+        """
+        return KpiQuery(self)
+
+    def _cube_covers(self, groupby_column, events=False):
+        if not self.use_cube or not self._installs_have_ids() or not self.cube().covers(groupby_column):
+            return False
+        # Revenue and payouts rows off the install day carry no network or country, so the cube only sees them
+        # through the group columns that drop those rows anyway.
+        columns = groupby_column if isinstance(groupby_column, list) else [groupby_column]
+        return not events or bool({'network_id', 'country_id'} & set(columns))
+
+    def _installs_have_ids(self):
+        # The incremental state only accepts installs with both ids
+        if self._incremental is not None:
+            return True
+        return self._cached('installs_have_ids',
+                            lambda: bool(self.installs_df[['network_id', 'country_id']].notna().all().all()))
+
+    def _unique_installs(self):
+        if self._incremental is not None:
+            return True
+        return self._cached('unique_installs', lambda: self.installs_df['install_id'].is_unique)
+
+    def _user_acquisition_costs(self, groupby_column, mean):
+        def compute():
+            if self._cube_covers(groupby_column):
+                user_acquisition_costs_per_network = self.cube().user_acquisition_costs(groupby_column, mean)
+            else:
+                user_acquisition_costs_per_network = self._grouped_acquisition_costs(groupby_column, mean)
+
+            if self.id_encoder is None:
+                process_df = DataCleaning(data=user_acquisition_costs_per_network,
+                                          columns=list(user_acquisition_costs_per_network.columns))
+                process_df.id_columns_to_object()
+                user_acquisition_costs_per_network = process_df.data
+            return user_acquisition_costs_per_network
+
+        return self._cached('user_acquisition_costs', compute, groupby_column, mean)
+
+    def _grouped_acquisition_costs(self, groupby_column, mean):
+        installs_with_adspend = self._daily_acquisition()
 
-        return user_acquisition_costs_per_network
+        # Aggregate user acquisition cost by network
+        grouped = installs_with_adspend.groupby(groupby_column, observed=True)['user_acquisition_cost_usd']
+        if mean:
+            return grouped.mean().reset_index()
+        return grouped.sum().reset_index()
 
+    @tracing.traced('KpiAnalytics.revenue_generated_per_install')
     def revenue_generated_per_install(self, groupby_column='install_id', mean=True):
         """
         Computes the revenue generated per install and aggregates it by the given `groupby_column`.
@@ -63,22 +432,27 @@ class KpiAnalytics:
         :return: A dataframe with the `groupby_column` and the revenue generated per user.
         :rtype: pandas.DataFrame
         """
-        # Merge revenue and installs data on install_id
-        agregated_revenue = self.revenue_df.groupby(['install_id', 'event_date'])['value_usd'].sum().reset_index()
-        revenue_with_installs = pd.merge(agregated_revenue, self.installs_df, on=['install_id', 'event_date'],
-                                         how='outer')
-        revenue_with_installs = revenue_with_installs.rename(columns={'value_usd': 'revenue_per_install_usd'})
+        revenue_generated_per_user = self._revenue_generated_per_install(groupby_column, mean)
+        return self._labelled_result('revenue_generated_per_install', revenue_generated_per_user,
+                                     groupby_column, mean)
 
-        # Aggregate revenue per user by country
-        if mean:
-            revenue_generated_per_user = revenue_with_installs.groupby(groupby_column)[
-                'revenue_per_install_usd'].mean().reset_index()
-        else:
-            revenue_generated_per_user = revenue_with_installs.groupby(groupby_column)[
-                'revenue_per_install_usd'].sum().reset_index()
+    def _revenue_generated_per_install(self, groupby_column, mean):
+        def compute():
+            if self._cube_covers(groupby_column, events=True):
+                return self.cube().per_install('revenue', groupby_column, mean)
 
-        return revenue_generated_per_user
+            # Merge revenue and installs data on install_id
+            revenue_with_installs = self._install_events('revenue')
 
+            # Aggregate revenue per user by country
+            grouped = revenue_with_installs.groupby(groupby_column, observed=True)['revenue_per_install_usd']
+            if mean:
+                return grouped.mean().reset_index()
+            return grouped.sum().reset_index()
+
+        return self._cached('revenue_generated_per_install', compute, groupby_column, mean)
+
+    @tracing.traced('KpiAnalytics.total_payouts_made_per_install')
     def total_payouts_made_per_install(self, groupby_column='install_id', mean=True):
         """
         Calculates the total payouts made per install.
@@ -90,25 +464,26 @@ class KpiAnalytics:
         :return: A DataFrame with the payouts per install.
         :rtype: pandas.DataFrame
         """
-        # Aggregate payouts data by install_id
-        # payouts_per_install = self.payouts_df.groupby(groupby_column)['value_usd'].sum()
+        payouts_per_install = self._total_payouts_made_per_install(groupby_column, mean)
+        return self._labelled_result('total_payouts_made_per_install', payouts_per_install, groupby_column, mean)
 
-        # Merge revenue and installs data on install_id
-        agregated_payouts = self.payouts_df.groupby(['install_id', 'event_date'])['value_usd'].sum().reset_index()
-        payouts_with_installs = pd.merge(agregated_payouts, self.installs_df, on=['install_id', 'event_date'],
-                                         how='outer')
-        payouts_with_installs = payouts_with_installs.rename(columns={'value_usd': 'payouts_per_install_usd'})
+    def _total_payouts_made_per_install(self, groupby_column, mean):
+        def compute():
+            if self._cube_covers(groupby_column, events=True):
+                return self.cube().per_install('payouts', groupby_column, mean)
 
-        # Aggregate revenue per user by country
-        if mean:
-            payouts_per_install = payouts_with_installs.groupby(groupby_column)[
-                'payouts_per_install_usd'].mean().reset_index()
-        else:
-            payouts_per_install = payouts_with_installs.groupby(groupby_column)[
-                'payouts_per_install_usd'].sum().reset_index()
+            # Merge payouts and installs data on install_id
+            payouts_with_installs = self._install_events('payouts')
 
-        return payouts_per_install
+            # Aggregate payouts per user by country
+            grouped = payouts_with_installs.groupby(groupby_column, observed=True)['payouts_per_install_usd']
+            if mean:
+                return grouped.mean().reset_index()
+            return grouped.sum().reset_index()
 
+        return self._cached('total_payouts_made_per_install', compute, groupby_column, mean)
+
+    @tracing.traced('KpiAnalytics.user_retention_rate')
     def user_retention_rate(self, groupby_column='network_id', days_active=False):
         """
         Calculates user retention rate for each group in the specified column, based on the number of users who
@@ -123,32 +498,62 @@ class KpiAnalytics:
             active, grouped by the specified column.
         :rtype: pandas.DataFrame
         """
-        # Calculate the number of users who installed the app on day 0
+        retention = self._user_retention_rate(groupby_column, days_active)
+        return self._labelled_result('user_retention_rate', retention, groupby_column, days_active)
 
-        payouts_df = self.payouts_df.groupby(['install_id', 'year and month'])['event_date'].max().reset_index()
-        revenue_df = self.revenue_df.groupby(['install_id', 'year and month'])['event_date'].max().reset_index()
-        installs_df = self.installs_df.rename(
-            columns={'event_date': 'install_date', 'year and month': 'install_year and month'})
+    def _user_retention_rate(self, groupby_column, days_active):
+        def compute():
+            # Distinct users only add up across cube cells when every install_id is a single install
+            if self.use_cube and self._installs_have_ids() and self._unique_installs() and \
+                    self.cube().covers_retention(groupby_column):
+                return self.cube().user_retention_rate(groupby_column, days_active)
 
-        df = pd.merge(installs_df, payouts_df, on='install_id', how='left')
-        df = pd.merge(df, revenue_df, on='install_id', how='left')
-        df['last_active'] = df[['event_date_x', 'event_date_y']].max(axis=1)
-        df['days_active'] = (df['last_active'] - df['install_date']).dt.days
-        df['days_active'] = df['days_active'].fillna(0)
+            # Calculate the number of users who installed the app on day 0
+            df = self._retention_activity()
 
-        if days_active:
-            df = df.groupby(groupby_column)['days_active'].mean().reset_index()
-        else:
-            n_installs = df.groupby(groupby_column)['install_id'].nunique().reset_index()
+            if days_active:
+                return df.groupby(groupby_column, observed=True)['days_active'].mean().reset_index()
+
+            n_installs = df.groupby(groupby_column, observed=True)['install_id'].nunique().reset_index()
             n_installs = n_installs.rename(columns={'install_id': 'total_users'})
-            n_retained = df.loc[df['days_active'] == 0].groupby(groupby_column)['install_id'].nunique().reset_index()
+            n_retained = df.loc[df['days_active'] == 0].groupby(groupby_column, observed=True)[
+                'install_id'].nunique().reset_index()
             n_retained = n_retained.rename(columns={'install_id': 'retained_users'})
-            df = pd.merge(n_installs, n_retained, on=groupby_column, how='left')
-            df = df.fillna(0)
+            df = tracing.merge(n_installs, n_retained, name='KpiAnalytics merge retained users', on=groupby_column,
+                               how='left')
+            # Only groups without retained users are missing; the group columns may be categorical
+            df['retained_users'] = df['retained_users'].fillna(0)
             df['retension_rate'] = df['retained_users'] / df['total_users'] * 100
+            return df
 
-        return df
+        return self._cached('user_retention_rate', compute, groupby_column, days_active)
 
+    @tracing.traced('KpiAnalytics.cohort_retention')
+    def cohort_retention(self, days=DEFAULT_DAYS, groupby_column=None, rolling=False):
+        """
+        Calculates Dn retention rates (D1, D3, D7, ...) per install cohort from a cohort x day-offset activity matrix.
+        A user is active on day n if they have a payout or revenue event n days after installing. Pass
+        days=range(31) for the full retention triangle; cells whose day is not observed yet are NaN.
+
+        :param days: The day offsets to report. Default is (1, 3, 7, 14, 30).
+        :type days: iterable
+        :param groupby_column: The install columns defining a cohort, named as in user_retention_rate. Default is
+            ['network_id', 'country_id', 'install_date'].
+        :type groupby_column: list
+        :param rolling: Whether to count users active on day n or later instead of exactly on day n. Default is False.
+        :type rolling: bool
+        :return: A pandas dataframe with the cohort columns, 'cohort_size' and one 'D<n>' column per day.
+        :rtype: pandas.DataFrame
+        """
+        groupby_column = groupby_column or DEFAULT_COHORT
+        days = tuple(days)
+        engine = self._cached('cohort_retention_engine', lambda: CohortRetention(
+            self._derive_date_parts('installs', DATE_PARTS), self.payouts_df, self.revenue_df))
+        retention = self._cached('cohort_retention', lambda: engine.retention(days, groupby_column, rolling),
+                                 groupby_column, days, rolling)
+        return self._labelled_result('cohort_retention', retention, groupby_column, days, rolling)
+
+    @tracing.traced('KpiAnalytics.total_profit')
     def total_profit(self):
         """
         Calculates the profit generated by the app per network, country, and day.
@@ -156,25 +561,36 @@ class KpiAnalytics:
         :return: A cleaned data frame with the breakdown of date columns.
         :rtype: pandas.DataFrame
         """
+        return self._labelled_result('total_profit', self._profit_frame(), ['network_id', 'country_id', 'event_date'],
+                                     object_ids=True)
+
+    def _profit_frame(self):
+        """
+        The joined profit frame behind total_profit and grouped_profit, shared through the cache.
+        """
+        return self._cached('profit_frame', self._compute_profit_frame)
+
+    def _compute_profit_frame(self):
         # Get user acquisition costs
         cols = ['network_id', 'country_id', 'event_date']
-        user_acquisition_costs = self.user_acquisition_costs(groupby_column=cols, mean=False)
+        user_acquisition_costs = self._user_acquisition_costs(groupby_column=cols, mean=False)
         # Get revenue generated per install
-        revenue_generated_per_install = self.revenue_generated_per_install(groupby_column=cols, mean=False)
+        revenue_generated_per_install = self._revenue_generated_per_install(groupby_column=cols, mean=False)
         # Get total payouts made per install
-        total_payouts_made_per_install = self.total_payouts_made_per_install(groupby_column=cols, mean=False)
+        total_payouts_made_per_install = self._total_payouts_made_per_install(groupby_column=cols, mean=False)
         # Get user retention rate
         cols_ret = ['network_id', 'country_id', 'install_date']
-        user_retention_days_active = self.user_retention_rate(groupby_column=cols_ret)
+        user_retention_days_active = self._user_retention_rate(groupby_column=cols_ret, days_active=False)
         user_retention_days_active = user_retention_days_active.rename(columns={'install_date': 'event_date'})
-        user_retention_rate = self.user_retention_rate(groupby_column=cols_ret, days_active=True)
+        user_retention_rate = self._user_retention_rate(groupby_column=cols_ret, days_active=True)
         user_retention_rate = user_retention_rate.rename(columns={'install_date': 'event_date'})
 
         # Merge data frames
-        df = pd.merge(user_acquisition_costs, revenue_generated_per_install, on=cols, how='left')
-        df = pd.merge(df, total_payouts_made_per_install, on=cols, how='left')
-        df = pd.merge(df, user_retention_rate, on=cols, how='left')
-        df = pd.merge(df, user_retention_days_active, on=cols)
+        df = tracing.merge(user_acquisition_costs, revenue_generated_per_install, name='KpiAnalytics profit merge',
+                           on=cols, how='left')
+        df = tracing.merge(df, total_payouts_made_per_install, name='KpiAnalytics profit merge', on=cols, how='left')
+        df = tracing.merge(df, user_retention_rate, name='KpiAnalytics profit merge', on=cols, how='left')
+        df = tracing.merge(df, user_retention_days_active, name='KpiAnalytics profit merge', on=cols)
 
         # Calculate profit
         df['profit_usd'] = df['revenue_per_install_usd'] - df['payouts_per_install_usd'] - df[
@@ -185,6 +601,7 @@ class KpiAnalytics:
 
         return df
 
+    @tracing.traced('KpiAnalytics.grouped_profit')
     def grouped_profit(self, groupby_column, mean=True):
         """
         Groups the total profit data by the specified column and returns either the mean or the sum of profit for
@@ -197,12 +614,14 @@ class KpiAnalytics:
         Defaults to True. :type mean: bool :return: A pandas DataFrame object with the grouped profit data. :rtype:
         pandas.DataFrame
         """
-        df = self.total_profit()
-        if mean:
-            df = df.groupby(groupby_column)[
-                'profit_usd'].mean().reset_index()
-        else:
-            df = df.groupby(groupby_column)[
-                'profit_usd'].sum().reset_index()
+        def compute():
+            if self._cube_covers(groupby_column):
+                return self.cube().grouped_profit(groupby_column, mean)
 
-        return df
+            df = self._profit_frame()
+            if mean:
+                return df.groupby(groupby_column, observed=True)['profit_usd'].mean().reset_index()
+            return df.groupby(groupby_column, observed=True)['profit_usd'].sum().reset_index()
+
+        grouped = self._cached('grouped_profit', compute, groupby_column, mean)
+        return self._labelled_result('grouped_profit', grouped, groupby_column, mean)
@@ -0,0 +1,130 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+
+class AggregateCache:
+    """
+    A memory-capped LRU cache for intermediate and final KPI frames.
+
+    Entries are keyed on a hashable tuple whose first element is a namespace (one per KpiAnalytics instance), so a
+    single cache can be shared between several analytics objects and invalidated per namespace. Lookups and
+    updates hold a lock, so threads can share a cache; values are computed outside of it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    @staticmethod
+    def size_of(value):
+        """
+        Estimates the number of bytes held by a cached value.
+
+        :param value: The value to measure. DataFrames and Series are measured with pandas' deep memory usage, bytes
+            by their length, other objects by their `nbytes` attribute if they have one.
+        :type value: object
+        :return: The estimated size in bytes.
+        :rtype: int
+        """
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True, deep=True).sum())
+        if isinstance(value, pd.Series):
+            return int(value.memory_usage(index=True, deep=True))
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        return int(getattr(value, 'nbytes', 0))
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the value stored under `key`, computing and storing it first if it is missing.
+
+        :param key: The hashable cache key.
+        :type key: tuple
+        :param compute: A callable without arguments that produces the value on a cache miss.
+        :type compute: callable
+        :return: The cached or freshly computed value.
+        :rtype: object
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries until the cache fits in `max_bytes`. Values that
+        are larger than `max_bytes` on their own are not stored.
+
+        :param key: The hashable cache key.
+        :type key: tuple
+        :param value: The value to store.
+        :type value: object
+        :return: None
+        :rtype: None
+        """
+        nbytes = self.size_of(value)
+        with self._lock:
+            self.discard(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+
+    def discard(self, key):
+        """
+        Removes a single entry from the cache if it is present.
+
+        :param key: The hashable cache key.
+        :type key: tuple
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def invalidate(self, namespace=None, match=None):
+        """
+        Drops cached entries. If a namespace is given only the entries belonging to it are dropped, otherwise the
+        whole cache is cleared.
+
+        :param namespace: The namespace to invalidate. Default is None (everything).
+        :type namespace: object
+        :param match: A callable that gets the key of each entry in the namespace and tells whether to drop it.
+            Default is None (every entry of the namespace).
+        :type match: callable
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                self.current_bytes = 0
+                return
+            for key in [key for key in self._entries if key[0] == namespace and (match is None or match(key))]:
+                self.discard(key)
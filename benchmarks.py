@@ -0,0 +1,290 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import matplotlib
+
+# The charts of ForeCast must not open windows or block
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from data_wrangling import DataCleaning, IdEncoder
+from hypothesis_and_forecast import ForeCast
+from KPIs import KpiAnalytics
+from synthetic_data import SyntheticData
+from tracing import current_rss, peak_rss, reset_peak_rss
+
+DEFAULT_ROWS = (10_000, 100_000, 1_000_000)
+DEFAULT_TOLERANCE = 0.2
+# Differences below these are noise, whatever the ratio
+MIN_SECONDS = 0.05
+MIN_BYTES = 1024 ** 2
+TABLES = ['adspend', 'installs', 'payouts', 'revenue']
+KPI_CASES = [
+    ('user_acquisition_costs', {'groupby_column': 'network_id'}),
+    ('user_acquisition_costs', {'groupby_column': ['network_id', 'year and month']}),
+    ('revenue_generated_per_install', {'groupby_column': 'install_id'}),
+    ('revenue_generated_per_install', {'groupby_column': 'network_id'}),
+    ('revenue_generated_per_install', {'groupby_column': ['network_id', 'year and month']}),
+    ('total_payouts_made_per_install', {'groupby_column': 'install_id'}),
+    ('total_payouts_made_per_install', {'groupby_column': 'network_id'}),
+    ('total_payouts_made_per_install', {'groupby_column': ['network_id', 'year and month']}),
+    ('user_retention_rate', {'groupby_column': 'network_id'}),
+    ('user_retention_rate', {'groupby_column': 'network_id', 'days_active': True}),
+    ('user_retention_rate', {'groupby_column': ['network_id', 'install_year and month']}),
+    ('cohort_retention', {}),
+    ('total_profit', {}),
+    ('grouped_profit', {'groupby_column': 'network_id', 'mean': False}),
+    ('grouped_profit', {'groupby_column': ['network_id', 'year and month'], 'mean': False}),
+    ('cube', {}),
+]
+
+
+@contextlib.contextmanager
+def _quiet():
+    # The steps print their findings and pandas warns about chained assignment; the notebook silences both too
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def _label(method, kwargs):
+    return f"{method}({', '.join(f'{key}={value!r}' for key, value in kwargs.items())})"
+
+
+class BenchmarkSuite:
+    """
+    Times every DataCleaning step and every KpiAnalytics and ForeCast method on synthetic data of several scales and
+    records the peak memory they allocate.
+
+    Peak memory is the growth of the peak resident set size during a step, which the Linux kernel tracks for free, so
+    one run measures both. Where the peak cannot be reset, a second run under tracemalloc records the peak of the
+    memory allocated by each step instead, so the tracing does not distort the timings. KPI methods are timed
+    on a fresh KpiAnalytics each, i.e. including the intermediate aggregates they need; 'all methods' runs every case
+    on one instance, like the notebook does.
+    """
+
+    def __init__(self, rows=DEFAULT_ROWS, seed=0, repeat=1, analytics_options=None):
+        self.rows = rows
+        self.seed = seed
+        self.repeat = repeat
+        self.analytics_options = analytics_options or {}
+
+    def run(self, log=None):
+        """
+        Runs the suite.
+
+        :param log: A stream for progress messages, e.g. sys.stderr. Default is None (silent).
+        :type log: file
+        :return: The environment, the parameters and one record per scale and step with 'seconds' and 'peak_bytes'.
+        :rtype: dict
+        """
+        records = []
+        for rows in self.rows:
+            raw = SyntheticData.for_rows(rows, seed=self.seed).frames()
+            seconds, peaks = {}, {}
+            use_rss = reset_peak_rss()
+            self._pipeline(raw, self._timer(seconds, peaks if use_rss else None, rows, log))
+            if not use_rss:
+                tracemalloc.start()
+                try:
+                    self._pipeline(raw, self._tracer(peaks))
+                finally:
+                    tracemalloc.stop()
+            for key in seconds:
+                records.append({'rows': rows, 'group': key[0], 'step': key[1], 'seconds': seconds[key],
+                                'peak_bytes': peaks[key]})
+        return {'environment': self.environment(), 'seed': self.seed, 'repeat': self.repeat,
+                'analytics_options': self.analytics_options, 'results': records}
+
+    @staticmethod
+    def environment():
+        return {'python': platform.python_version(), 'platform': platform.platform(), 'pandas': pd.__version__,
+                'numpy': np.__version__, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def _timer(self, seconds, peaks, rows, log):
+        def measure(group, step, fn, once=False):
+            best, result = np.inf, None
+            if peaks is not None:
+                reset_peak_rss()
+                before = current_rss()
+            for _ in range(1 if once else self.repeat):
+                with _quiet():
+                    start = time.perf_counter()
+                    result = fn()
+                    best = min(best, time.perf_counter() - start)
+            seconds[(group, step)] = best
+            if peaks is not None:
+                peaks[(group, step)] = peak_rss() - before
+            if log is not None:
+                print(f'{rows:>12,} {group:<24} {step:<80} {best:10.4f}s', file=log)
+            return result
+
+        return measure
+
+    @staticmethod
+    def _tracer(peaks):
+        def measure(group, step, fn, once=False):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            with _quiet():
+                result = fn()
+            peaks[(group, step)] = tracemalloc.get_traced_memory()[1] - before
+            return result
+
+        return measure
+
+    def _pipeline(self, raw, measure):
+        frames = self._clean(raw, measure)
+        self._kpis(frames, measure)
+        self._forecast(frames, measure)
+        plt.close('all')
+
+    @staticmethod
+    def _clean(raw, measure):
+        encoder = IdEncoder()
+        frames = {}
+        for name in TABLES:
+            group = f'DataCleaning[{name}]'
+            df = raw[name].copy()
+            codes = DataCleaning(data=raw[name].copy(), columns=list(df.columns))
+            measure(group, 'id_columns_to_codes', lambda: codes.id_columns_to_codes(encoder), once=True)
+
+            # The steps modify the frame in place, so they cannot be repeated
+            process_df = DataCleaning(data=df, columns=list(df.columns))
+            measure(group, 'id_columns_to_object', process_df.id_columns_to_object, once=True)
+            measure(group, 'date_column_type', process_df.date_column_type, once=True)
+            measure(group, 'check_duplicates', process_df.check_duplicates, once=True)
+            measure(group, 'fill_missing_values', process_df.fill_missing_values, once=True)
+            # Like the notebook, only the payout outliers are removed
+            measure(group, 'check_for_outliers',
+                    lambda: process_df.check_for_outliers(remove_outliers=name == 'payouts'), once=True)
+            frames[name] = measure(group, 'break_down_date', lambda: DataCleaning.break_down_date(process_df.data))
+        return frames
+
+    def _analytics(self, frames):
+        return KpiAnalytics(adspend_df=frames['adspend'], installs_df=frames['installs'],
+                            payouts_df=frames['payouts'], revenue_df=frames['revenue'], **self.analytics_options)
+
+    def _kpis(self, frames, measure):
+        for method, kwargs in KPI_CASES:
+            measure('KpiAnalytics', _label(method, kwargs),
+                    lambda: getattr(self._analytics(frames), method)(**kwargs))
+
+        def all_methods():
+            analytics = self._analytics(frames)
+            for method, kwargs in KPI_CASES:
+                getattr(analytics, method)(**kwargs)
+
+        measure('KpiAnalytics', 'all methods', all_methods)
+
+        # The last install day arrives as a new batch
+        last_day = frames['installs']['event_date'].max()
+        history = {name: df[df['event_date'] < last_day] for name, df in frames.items()}
+        batch = {f'{name}_df': df[df['event_date'] >= last_day] for name, df in frames.items()}
+        analytics = self._analytics(history)
+        analytics.cube()
+        measure('KpiAnalytics', 'append', lambda: analytics.append(**batch), once=True)
+
+    def _forecast(self, frames, measure):
+        forecast = ForeCast(df=self._analytics(frames).total_profit())
+        measure('ForeCast', 'test_hypothesis', forecast.test_hypothesis)
+        measure('ForeCast', 'check_hypothesis', forecast.check_hypothesis)
+        measure('ForeCast', 'forecast', forecast.forecast)
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares benchmark results with a saved baseline. A step regressed if its time or its peak memory grew by more
+    than `tolerance` and by more than the noise floor (MIN_SECONDS, MIN_BYTES).
+
+    :param results: The output of BenchmarkSuite.run.
+    :type results: dict
+    :param baseline: The output of an earlier run, e.g. loaded from its JSON file.
+    :type baseline: dict
+    :param tolerance: The relative growth that is still accepted. Default is 0.2 (20 %).
+    :type tolerance: float
+    :return: One row per step found in both runs with the times, peaks, their ratios and a 'regression' flag.
+    :rtype: pandas.DataFrame
+    """
+    keys = ['rows', 'group', 'step']
+    df = pd.merge(pd.DataFrame(results['results']), pd.DataFrame(baseline['results']), on=keys,
+                  suffixes=('', '_baseline'))
+    df['time_ratio'] = df['seconds'] / df['seconds_baseline']
+    df['memory_ratio'] = df['peak_bytes'] / df['peak_bytes_baseline'].replace(0, np.nan)
+    slower = (df['time_ratio'] > 1 + tolerance) & (df['seconds'] - df['seconds_baseline'] > MIN_SECONDS)
+    larger = (df['memory_ratio'] > 1 + tolerance) & (df['peak_bytes'] - df['peak_bytes_baseline'] > MIN_BYTES)
+    df['regression'] = slower | larger
+    return df[keys + ['seconds', 'seconds_baseline', 'time_ratio', 'peak_bytes', 'peak_bytes_baseline',
+                      'memory_ratio', 'regression']]
+
+
+def benchmark_workers(frames, workers=(1, 2, 4), **kwargs):
+    """
+    Times the KPI cases for several worker counts of KpiAnalytics, each on a fresh instance, and checks that every
+    parallel result equals the serial one.
+
+    :param frames: The cleaned 'adspend', 'installs', 'payouts' and 'revenue' frames.
+    :type frames: dict
+    :param workers: The worker counts to time. The first one is the reference. Default is (1, 2, 4).
+    :type workers: tuple
+    :param kwargs: Further keyword arguments for KpiAnalytics, e.g. use_cube or id_encoder.
+    :return: One row per worker count with 'seconds', 'speedup' against the reference and 'identical'.
+    :rtype: pandas.DataFrame
+    """
+    # The cube is not a frame, and the parallel joins only run behind the frames
+    cases = [(method, case) for method, case in KPI_CASES if method != 'cube']
+    rows, reference = [], None
+    for n in workers:
+        analytics = KpiAnalytics(**{f'{name}_df': frames[name] for name in TABLES}, workers=n, **kwargs)
+        with _quiet():
+            start = time.perf_counter()
+            results = [getattr(analytics, method)(**case) for method, case in cases]
+            seconds = time.perf_counter() - start
+        if reference is None:
+            reference = (seconds, results)
+        identical = all(result.equals(expected) for result, expected in zip(results, reference[1]))
+        rows.append({'workers': n, 'seconds': seconds, 'speedup': reference[0] / seconds, 'identical': identical})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the KPI pipeline on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_ROWS),
+                        help='Scales in rows over installs, payouts and revenue.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='Timed runs per step; the best one is kept.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of KpiAnalytics.')
+    parser.add_argument('--no-cube', action='store_true', help='Answer the KPIs from the raw frames.')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results.')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    suite = BenchmarkSuite(rows=args.rows, seed=args.seed, repeat=args.repeat,
+                           analytics_options={'workers': args.workers, 'use_cube': not args.no_cube})
+    results = suite.run(log=sys.stderr)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        comparison = compare(results, json.load(f), args.tolerance)
+    regressions = comparison[comparison['regression']]
+    with pd.option_context('display.width', 250, 'display.max_colwidth', 80, 'display.max_rows', None):
+        print(comparison.to_string(index=False))
+        print(f'\n{len(regressions)} regression(s)')
+    return 1 if len(regressions) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
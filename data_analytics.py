@@ -1,7 +1,34 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from tracing import traced
+
+# The size of charts rendered to files; long series are downsampled to about one point per pixel of width
+FIGURE_SIZE = (8, 5)
+DPI = 100
+
+
+def _figure(path):
+    # Charts rendered to a file use a Figure of their own instead of pyplot, so they need no display and leave the
+    # interactive figures alone
+    if path is None:
+        return plt.subplots()
+    fig = Figure(figsize=FIGURE_SIZE)
+    return fig, fig.subplots()
 
 
-def bar_chart(data, x_column, y_column, title=''):
+def _finish(fig, path):
+    if path is None:
+        plt.show()
+    else:
+        fig.savefig(path, dpi=DPI)
+
+
+def bar_chart(data, x_column, y_column, title='', path=None):
     """
     Create a bar chart using the specified data, x and y columns, and title.
 
@@ -13,18 +40,21 @@ def bar_chart(data, x_column, y_column, title=''):
     :type y_column: str
     :param title: the title of the chart (optional)
     :type title: str
+    :param path: the image file to render the chart to instead of showing it (optional)
+    :type path: str
     :return: None
     :rtype: None
     """
     data[x_column] = data[x_column].astype(str).astype('category')
-    plt.bar(data[x_column], data[y_column])
-    plt.xlabel(x_column)
-    plt.ylabel(y_column)
-    plt.title(title)
-    plt.show()
+    fig, ax = _figure(path)
+    ax.bar(data[x_column], data[y_column])
+    ax.set_xlabel(x_column)
+    ax.set_ylabel(y_column)
+    ax.set_title(title)
+    _finish(fig, path)
 
 
-def pie_chart(data, label_column, value_column, title=''):
+def pie_chart(data, label_column, value_column, title='', path=None):
     """
     Create a pie chart using the specified data, label column, value column, and title.
 
@@ -36,15 +66,18 @@ def pie_chart(data, label_column, value_column, title=''):
     :type value_column: str
     :param title: the title of the chart (optional)
     :type title: str
+    :param path: the image file to render the chart to instead of showing it (optional)
+    :type path: str
     :return: None
     :rtype: None
     """
-    plt.pie(data[value_column], labels=data[label_column], autopct='%1.1f%%')
-    plt.title(title)
-    plt.show()
+    fig, ax = _figure(path)
+    ax.pie(data[value_column], labels=data[label_column], autopct='%1.1f%%')
+    ax.set_title(title)
+    _finish(fig, path)
 
 
-def time_series_chart(data, x_column, y_column, title=''):
+def time_series_chart(data, x_column, y_column, title='', path=None, max_points=None):
     """
     Create a time series chart from a pandas DataFrame.
 
@@ -56,17 +89,25 @@ def time_series_chart(data, x_column, y_column, title=''):
     :type y_column: str
     :param title: The title of the chart.
     :type title: str
+    :param path: The image file to render the chart to instead of showing it. Default is None.
+    :type path: str
+    :param max_points: The number of points to downsample the series to, see downsample_frame. Default is None (no
+        downsampling).
+    :type max_points: int
     :return: None
     :rtype: None
     """
-    plt.plot(data[x_column], data[y_column])
-    plt.xlabel(x_column)
-    plt.ylabel(y_column)
-    plt.title(title)
-    plt.show()
+    if max_points:
+        data = downsample_frame(data, x_column, y_column, max_points)
+    fig, ax = _figure(path)
+    ax.plot(data[x_column], data[y_column])
+    ax.set_xlabel(x_column)
+    ax.set_ylabel(y_column)
+    ax.set_title(title)
+    _finish(fig, path)
 
 
-def hist_chart(data, column, title=''):
+def hist_chart(data, column, title='', path=None):
     """
     Create a histogram chart of a given column in a dataset.
 
@@ -76,17 +117,20 @@ def hist_chart(data, column, title=''):
     :type column: str
     :param title: Optional title for the chart.
     :type title: str
+    :param path: Optional image file to render the chart to instead of showing it.
+    :type path: str
     :return: None
     :rtype: None
     """
-    plt.hist(data[column].astype(str).astype('category'))
-    plt.xlabel(column)
-    plt.ylabel('Frequency')
-    plt.title(title)
-    plt.show()
+    fig, ax = _figure(path)
+    ax.hist(data[column].astype(str).astype('category'))
+    ax.set_xlabel(column)
+    ax.set_ylabel('Frequency')
+    ax.set_title(title)
+    _finish(fig, path)
 
 
-def time_series_breakdown(data, x_column, y_column, breakdown_column, title=''):
+def time_series_breakdown(data, x_column, y_column, breakdown_column, title='', path=None, max_points=None):
     """
     Plots a time series chart for a data set, broken down by a given column.
 
@@ -100,21 +144,22 @@ def time_series_breakdown(data, x_column, y_column, breakdown_column, title=''):
     :type breakdown_column: str
     :param title: The title of the chart. Default is an empty string.
     :type title: str
+    :param path: The image file to render the chart to instead of showing it. Default is None.
+    :type path: str
+    :param max_points: The number of points to downsample each line to, see downsample_frame. Default is None (no
+        downsampling).
+    :type max_points: int
     :return: None
     :rtype: None
     """
-    # Get unique values in breakdown column
-    breakdown_values = data[breakdown_column].unique()
+    if max_points:
+        data = downsample_frame(data, x_column, y_column, max_points, breakdown_column)
 
     # Create a figure and axis object
-    fig, ax = plt.subplots()
-
-    # Loop over unique values and plot a line for each value
-    for value in breakdown_values:
-        # Filter data for current value
-        subset = data[data[breakdown_column] == value]
+    fig, ax = _figure(path)
 
-        # Plot a line for current value
+    # Split the data by breakdown value in one pass, in order of appearance, and plot a line for each value
+    for value, subset in data.groupby(breakdown_column, sort=False, observed=True):
         ax.plot(subset[x_column], subset[y_column], label=value)
 
     # Set labels and title
@@ -126,10 +171,10 @@ def time_series_breakdown(data, x_column, y_column, breakdown_column, title=''):
     ax.legend()
 
     # Show the plot
-    plt.show()
+    _finish(fig, path)
 
 
-def regressions_charts(x, y, prediction, xlabel, ylabel, title):
+def regressions_charts(x, y, prediction, xlabel, ylabel, title, path=None):
     """
     Plots a scatter plot of `X` versus `Y` and a regression line based on `prediction`.
 
@@ -145,11 +190,177 @@ def regressions_charts(x, y, prediction, xlabel, ylabel, title):
     :type ylabel: str
     :param title: The title for the plot.
     :type title: str
+    :param path: The image file to render the plot to instead of showing it. Default is None.
+    :type path: str
     :return: None
     """
-    plt.scatter(x, y)
-    plt.plot(x, prediction, color='red')
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.title(title)
-    plt.show()
+    fig, ax = _figure(path)
+    ax.scatter(x, y)
+    ax.plot(x, prediction, color='red')
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    _finish(fig, path)
+
+
+CHARTS = {chart.__name__: chart for chart in (bar_chart, pie_chart, time_series_chart, hist_chart,
+                                              time_series_breakdown, regressions_charts)}
+
+
+def _numbers(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'mM':
+        values = values.view(np.int64)
+    return values.astype(np.float64)
+
+
+def _lttb_lines(x, y, starts, lengths, n_out):
+    """
+    lttb of several lines at once, line i being x[starts[i]:starts[i] + lengths[i]] and longer than n_out. Returns
+    the positions kept, n_out per line.
+    """
+    starts, lengths = starts[:, None], lengths[:, None]
+    # Segment 0 is the first point, segments 1 to n_out - 2 are the buckets and the last one is the last point
+    bounds = starts + np.concatenate([np.zeros_like(lengths), 1 + np.arange(n_out - 1) * (lengths - 2) // (n_out - 2),
+                                      lengths], axis=1)
+    means = np.add.reduceat(np.stack([x, y]), bounds[:, :-1].ravel(), axis=1).reshape(2, len(starts), n_out)
+    means /= np.diff(bounds, axis=1)
+    # reduceat runs the last segment of a line up to the next line
+    means[:, :, -1] = x[bounds[:, -1] - 1], y[bounds[:, -1] - 1]
+    kept = np.empty((len(starts), n_out), dtype=np.int64)
+    kept[:, 0], kept[:, -1] = bounds[:, 0], bounds[:, -1] - 1
+    previous = kept[:, 0]
+    lines = np.arange(len(starts))
+    for i in range(1, n_out - 1):
+        start, stop = bounds[:, i], bounds[:, i + 1]
+        # The points of bucket i of every line, padded to the widest bucket with its last point
+        points = np.minimum(start[:, None] + np.arange((stop - start).max()), stop[:, None] - 1)
+        x_previous, y_previous = x[previous][:, None], y[previous][:, None]
+        x_next, y_next = means[0, :, i + 1][:, None], means[1, :, i + 1][:, None]
+        # Twice the area of the triangle (previous point, point, next mean) for every point of the bucket
+        area = np.abs((x_previous - x_next) * (y[points] - y_previous) -
+                      (x_previous - x[points]) * (y_next - y_previous))
+        previous = points[lines, np.argmax(area, axis=1)]
+        kept[:, i] = previous
+    return kept
+
+
+def lttb(x, y, n_out):
+    """
+    Picks the points of a line that keep its shape with the Largest-Triangle-Three-Buckets algorithm: the first and
+    last point plus, in each of n_out - 2 equal buckets of the points in between, the point that forms the largest
+    triangle with the point picked in the previous bucket and the mean of the next bucket. Peaks and dips survive,
+    unlike with every k-th point.
+
+    :param x: The x values, sorted; numbers or datetimes.
+    :type x: numpy.ndarray or pandas.Series
+    :param y: The y values, without missing values.
+    :type y: numpy.ndarray or pandas.Series
+    :param n_out: The number of points to keep.
+    :type n_out: int
+    :return: The positions of the points kept, in order.
+    :rtype: numpy.ndarray
+    """
+    if n_out >= len(x) or n_out < 3:
+        return np.arange(len(x))
+    return _lttb_lines(_numbers(x), _numbers(y), np.array([0]), np.array([len(x)]), n_out)[0]
+
+
+def downsample_frame(data, x_column, y_column, max_points, breakdown_column=None):
+    """
+    Reduces every line of a time series chart to at most `max_points` points with lttb, which keeps its shape at a
+    fraction of the drawing time once the line has more points than the chart has pixels. All lines are reduced
+    together, so the cost hardly depends on the number of lines. Rows without a y value are dropped and lines that
+    are not sorted by x are sorted first; data with x values that are neither numbers nor datetimes is returned as
+    is.
+
+    :param data: The data of the chart.
+    :type data: pandas.DataFrame
+    :param x_column: The name of the column containing the x-axis values.
+    :type x_column: str
+    :param y_column: The name of the column containing the y-axis values.
+    :type y_column: str
+    :param max_points: The number of points to keep per line.
+    :type max_points: int
+    :param breakdown_column: The name of the column with one line per value. Default is None (one line).
+    :type breakdown_column: str
+    :return: The rows kept, line by line in order of appearance.
+    :rtype: pandas.DataFrame
+    """
+    columns = [x_column, y_column] + ([breakdown_column] if breakdown_column is not None else [])
+    if data[x_column].dtype.kind not in 'biufmM' or max_points < 3:
+        return data[columns].dropna(subset=[y_column])
+    x, y = _numbers(data[x_column]), _numbers(data[y_column])
+    if breakdown_column is None:
+        lines = np.zeros(len(data), dtype=np.int64)
+    else:
+        # Rows without a breakdown value are in no line, as in groupby
+        lines = pd.factorize(data[breakdown_column])[0]
+    lines[np.isnan(y)] = -1
+    if (lines[1:] >= lines[:-1]).all():
+        # Already grouped by line, e.g. a single line without missing values
+        first = np.searchsorted(lines, 0)
+        order, lines, x, y = np.arange(first, len(lines)), lines[first:], x[first:], y[first:]
+    else:
+        order = np.argsort(lines, kind='stable')
+        # The rows in no line sort first
+        order = order[np.searchsorted(lines[order], 0):]
+        lines, x, y = lines[order], x[order], y[order]
+    descending = np.diff(x) < 0
+    if descending.any() and (descending & (lines[1:] == lines[:-1])).any():
+        by_x = np.lexsort((x, lines))
+        order, x, y = order[by_x], x[by_x], y[by_x]
+
+    lengths = np.bincount(lines)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    long_lines = lengths > max_points
+    # Short lines are kept whole: +1 where one starts and -1 where it ends
+    kept = np.zeros(len(order) + 1, dtype=np.int8)
+    kept[starts[~long_lines]] += 1
+    kept[starts[~long_lines] + lengths[~long_lines]] -= 1
+    kept = np.cumsum(kept[:-1], dtype=np.int8).astype(bool)
+    if long_lines.any():
+        kept[_lttb_lines(x, y, starts[long_lines], lengths[long_lines], max_points).ravel()] = True
+    return data.iloc[order[kept]][columns]
+
+
+def _render(spec):
+    spec = dict(spec)
+    CHARTS[spec.pop('chart')](**spec)
+    return spec['path']
+
+
+@traced('render_charts')
+def render_charts(specs, workers=None, max_points=None):
+    """
+    Renders many charts to image files without a display, e.g. for nightly reports. Time series are downsampled
+    here, so only the few points that are drawn are sent to the worker processes, which draw the charts.
+
+    :param specs: One dict per chart: 'chart', the name of a chart function of this module (see CHARTS), 'path',
+        the image file (its extension sets the format), and the other keyword arguments of that function.
+    :type specs: list
+    :param workers: The number of worker processes. Default is None (one per CPU, at most one per chart).
+    :type workers: int
+    :param max_points: The number of points to downsample every line of a time series chart to. Default is None
+        (the width of the image in pixels).
+    :type max_points: int
+    :return: The paths of the images, in the order of `specs`.
+    :rtype: list
+    """
+    max_points = max_points or FIGURE_SIZE[0] * DPI
+    prepared, downsampled = [], {}
+    for spec in specs:
+        spec = dict(spec)
+        if spec['chart'] in ('time_series_chart', 'time_series_breakdown'):
+            # Charts of the same lines of the same frame, e.g. with other titles or formats, share the downsampling
+            lines = (id(spec['data']), spec['x_column'], spec['y_column'], spec.get('breakdown_column'))
+            if lines not in downsampled:
+                downsampled[lines] = downsample_frame(spec['data'], *lines[1:3], max_points, lines[3])
+            spec['data'], spec['max_points'] = downsampled[lines], None
+        prepared.append(spec)
+
+    workers = min(len(prepared), workers or os.cpu_count() or 1)
+    if workers <= 1:
+        return [_render(spec) for spec in prepared]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_render, prepared))
@@ -1,5 +1,25 @@
+import contextlib
+import importlib.util
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+from date_index import date_index_of, sort_by_date
+from seen_rows import SeenRows, row_fingerprints
+from sketches import QuantileSketches
+from tracing import traced
+
+DEFAULT_CHUNKSIZE = 1_000_000
+DEFAULT_DTYPES = {'value_usd': 'float64'}
+DATE_PARTS = ['year', 'month', 'year and month', 'day_of_week']
+SOURCES = ['adspend', 'installs', 'payouts', 'revenue']
+# The notebook only removes the outliers of the payouts
+REMOVE_OUTLIERS = ('payouts',)
+# In alphabetical order, so day_of_week sorts and groups in the same order as the day names did as strings
+DAYS_OF_WEEK = pd.CategoricalDtype(sorted(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
+                                           'Sunday']))
 
 
 class DataCleaning:
@@ -8,6 +28,7 @@ class DataCleaning:
         self.data = data
         self.columns = columns
 
+    @traced('DataCleaning.id_columns_to_object')
     def id_columns_to_object(self):
         """
         Convert all columns containing 'id' in the column name to object data type.
@@ -19,6 +40,22 @@ class DataCleaning:
             if 'id' in col:
                 self.data[col] = self.data[col].astype('object')
 
+    @traced('DataCleaning.id_columns_to_codes')
+    def id_columns_to_codes(self, encoder):
+        """
+        Replace all columns containing 'id' in the column name with compact integer codes from a shared IdEncoder.
+        Use the same encoder for every frame that is joined later, so that equal ids get equal codes.
+
+        :param encoder: The id dictionary shared between the frames.
+        :type encoder: IdEncoder
+        :return: None
+        :rtype: None
+        """
+        for col in self.data.columns:
+            if 'id' in col:
+                self.data[col] = encoder.encode(col, self.data[col])
+
+    @traced('DataCleaning.date_column_type')
     def date_column_type(self):
         """
         This function converts any columns containing the word 'date' to a datetime format using pandas'
@@ -31,97 +68,621 @@ class DataCleaning:
             if 'date' in col:
                 self.data[col] = pd.to_datetime(self.data[col])
 
-    def check_duplicates(self):
+    @traced('DataCleaning.sort_by_date')
+    def sort_by_date(self):
+        """
+        Sorts the rows by event_date, keeping the order of rows with the same date, and attaches a DateIndex of the
+        row offsets of each date to the frame. break_down_date and KpiAnalytics then work on date slices instead of
+        scanning the whole frame. Run it after date_column_type and the steps that drop rows.
+
+        :return: None
+        :rtype: None
+        """
+        self.data = sort_by_date(self.data)
+
+    @traced('DataCleaning.check_duplicates')
+    def check_duplicates(self, seen=None, remember=True, verbose=True):
         """
         This function checks for duplicates in a pandas DataFrame and removes them if found. If duplicates are
         found, the function prints the number of duplicates found, drops the duplicates, and resets the index of
         the DataFrame. If no duplicates are found, the function prints a message saying so.
 
-        :return: None
-        :rtype: None
+        Rows are compared by their 64-bit fingerprints (see row_fingerprints) instead of value by value.
+
+        :param seen: Rows seen in earlier chunks or batches of the same source, e.g. a SeenRows or BloomSeenRows kept
+            on disk. Rows already in it are treated as duplicates and the remaining rows are added to it. Default is
+            None (only look for duplicates within the data).
+        :type seen: SeenRows
+        :param remember: Whether to add the remaining rows to `seen`. Default is True.
+        :type remember: bool
+        :param verbose: Whether to print the result of the check. Default is True.
+        :type verbose: bool
+        :return: The number of duplicate records dropped.
+        :rtype: int
         """
         # Check for duplicates
-        num_duplicates = self.data.duplicated().sum()
+        if seen is None:
+            duplicated = pd.Series(row_fingerprints(self.data)).duplicated().to_numpy()
+        else:
+            duplicated = ~seen.first_occurrences(self.data, remember=remember)
+        num_duplicates = int(duplicated.sum())
         if num_duplicates > 0:
-            print(f"Found {num_duplicates} duplicate records.")
+            if verbose:
+                print(f"Found {num_duplicates} duplicate records.")
             # Drop duplicates and reset index
-            self.data.drop_duplicates(inplace=True)
-            self.data.reset_index(drop=True, inplace=True)
-        else:
+            self.data = self.data[~duplicated].reset_index(drop=True)
+        elif verbose:
             print("No duplicate records found.")
 
-    def fill_missing_values(self):
+        return num_duplicates
+
+    @traced('DataCleaning.fill_missing_values')
+    def fill_missing_values(self, means=None, verbose=True):
         """
         This function fills in missing values in a pandas DataFrame with either the mean value (for numeric columns)
         or an empty string (for non-numeric columns). If any missing values remain after filling, the function
         prints the row index and column name where the missing values are located.
 
+        :param means: Precomputed fill value per numeric column, e.g. the mean over a whole file that is cleaned
+            chunk by chunk. Columns that are missing from it are filled with their own mean. Default is None.
+        :type means: dict
+        :param verbose: Whether to print the rows that still have missing values. Default is True.
+        :type verbose: bool
         :return: None
         :rtype: None
         """
-        # Loop through columns in DataFrame
-        for col in self.columns:
-            # Check if column is numeric
-            if pd.api.types.is_numeric_dtype(self.data[col]):
-                # Fill in missing values with column mean
-                self.data[col].fillna(self.data[col].mean(), inplace=True)
-            else:
-                # Fill in missing values with empty string
-                self.data[col].dropna(inplace=True)
+        means = means or {}
+        # Non-numeric columns keep their missing values
+        numeric = [col for col in self.columns if pd.api.types.is_numeric_dtype(self.data[col])]
+        # One pass over all numeric columns finds the ones to fill, and only those need their mean
+        has_missing = self.data[numeric].isna().any()
+        to_fill = [col for col in numeric if has_missing[col]]
+        fill_values = self.data[[col for col in to_fill if col not in means]].mean().to_dict()
+        fill_values.update({col: means[col] for col in to_fill if col in means})
+        if fill_values:
+            self.data.fillna(fill_values, inplace=True)
 
         # Check for any remaining missing values and print row index and column name
-        missing_values = self.data.isnull().any(axis=1)
-        if missing_values.any():
-            print("Rows with missing values:")
-            print(self.data[missing_values])
+        if verbose:
+            missing_values = self.data.isnull().any(axis=1)
+            if missing_values.any():
+                print("Rows with missing values:")
+                print(self.data[missing_values])
 
-    def check_for_outliers(self,remove_outliers=False):
+    @traced('DataCleaning.check_for_outliers')
+    def check_for_outliers(self, remove_outliers=False, bounds=None, inplace=False):
         """
         This function checks for outliers in a pandas DataFrame and returns a dictionary with the number of outliers
         for each numeric column. If remove_outliers is set to True, the function will remove the outliers from the
         DataFrame and return the same dictionary.
 
+        The quartiles of all columns come from one quantile call and the rows are filtered once with a combined mask.
+        When outliers are removed, each column is still checked on the rows the previous columns kept, so from the
+        second column with removed rows on its quartiles are computed on those rows.
+
         :param remove_outliers: A boolean indicating whether to remove outliers or not. Default is False.
         :type remove_outliers: bool
+        :param bounds: Precomputed (lower, upper) outlier bounds per numeric column, e.g. from the IQR over a whole
+            file that is cleaned chunk by chunk. Columns that are missing from it use their own IQR. Default is None.
+        :type bounds: dict
+        :param inplace: Whether to remove the rows from the frame itself, one column at a time, instead of from a
+            filtered copy, so that the frame is never held twice. Default is False.
+        :type inplace: bool
         :return: A dictionary with the number of outliers for each numeric column.
         :rtype: dict
         """
+        bounds = bounds or {}
+        numeric = [col for col in self.columns if self.data[col].dtype in ['int64', 'float64']]
+        quartiles = self.data[[col for col in numeric if col not in bounds]].quantile([0.25, 0.75])
 
         outliers = {}
-        for col in self.columns:
-            if self.data[col].dtype in ['int64', 'float64']:
-                # Calculate the interquartile range (IQR)
-                q1 = self.data[col].quantile(0.25)
-                q3 = self.data[col].quantile(0.75)
-                iqr = q3 - q1
-
-                # Calculate the lower and upper bounds for outliers
-                lower_bound = q1 - 1.5 * iqr
-                upper_bound = q3 + 1.5 * iqr
-
-                # Find the number of outliers for this column
-                num_outliers = len(self.data[(self.data[col] < lower_bound) | (self.data[col] > upper_bound)])
-                outliers[col] = num_outliers
-                if remove_outliers:
-                    self.data = self.data[(self.data[col] >= lower_bound) & (self.data[col] <= upper_bound)]
+        keep = np.ones(len(self.data), dtype=bool)
+        for col in numeric:
+            values = self.data[col].to_numpy()
+            if col in bounds:
+                lower_bound, upper_bound = bounds[col]
+            elif remove_outliers and not keep.all():
+                lower_bound, upper_bound = self.iqr_bounds(self.data[col][keep])
+            else:
+                q1, q3 = quartiles[col]
+                lower_bound, upper_bound = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
 
+            # Find the number of outliers for this column
+            outliers[col] = int(((values < lower_bound) | (values > upper_bound))[keep].sum())
+            if remove_outliers:
+                # Missing values are not outliers, but do not stay either
+                keep &= (values >= lower_bound) & (values <= upper_bound)
+
+        if not keep.all():
+            self._keep_rows(keep, inplace)
         return outliers
+
+    def _keep_rows(self, keep, inplace):
+        if not inplace:
+            self.data = self.data[keep]
+            return
+        # Every column is taken out, filtered and put back, so at most one column (or block of columns of the same
+        # type) exists twice at a time
+        rows = np.flatnonzero(keep)
+        dtypes = self.data.dtypes
+        columns = {col: self.data.pop(col).array.take(rows) for col in list(self.data.columns)}
+        # A frame without columns can take an index of another length
+        self.data.index = self.data.index.take(rows)
+        for col in list(columns):
+            # With the dtype given, pandas does not look for dates in object columns
+            self.data[col] = pd.Series(columns.pop(col), index=self.data.index, dtype=dtypes[col], copy=False)
+
     @staticmethod
-    def break_down_date(df):
+    def iqr_bounds(values):
+        """
+        Calculates the lower and upper outlier bounds of a numeric column as 1.5 times the interquartile range
+        below the first and above the third quartile.
+
+        :param values: The column values.
+        :type values: pandas.Series
+        :return: The lower and upper bound.
+        :rtype: tuple
+        """
+        # Calculate the interquartile range (IQR)
+        q1 = values.quantile(0.25)
+        q3 = values.quantile(0.75)
+        iqr = q3 - q1
+
+        # Calculate the lower and upper bounds for outliers
+        return q1 - 1.5 * iqr, q3 + 1.5 * iqr
+
+    @staticmethod
+    @traced('DataCleaning.break_down_date')
+    def break_down_date(df, columns=None):
         """
         This function takes in a pandas DataFrame with a 'date' column and adds four new columns to the DataFrame: 'year',
         'month', 'year and month', and 'day_of_week'. The 'year' column contains the year of each date, the 'month'
         column contains the month of each date, the 'year and month' column contains the first day of each month in the
-        format 'YYYY-MM-DD', and the 'day_of_week' column contains the name of the day of the week for each date.
+        format 'YYYY-MM-DD', and the 'day_of_week' column contains the name of the day of the week for each date, as a
+        categorical.
+
+        The columns are computed once per distinct date and looked up for every row. KpiAnalytics derives the columns
+        a computation needs when a frame lacks them, so frames can skip this step, or add only some `columns`, and
+        leave the rest to be derived lazily.
 
         :param df: A pandas DataFrame object with a 'date' column.
         :type df: pandas.DataFrame
+        :param columns: The columns to add. Default is None (all four).
+        :type columns: list
         :return: The input DataFrame with four new columns added.
         :rtype: pandas.DataFrame
         """
-        df['year'] = df['event_date'].dt.year
-        df['month'] = df['event_date'].dt.month
-        df['year and month'] = df['event_date'].dt.to_period('M').dt.to_timestamp()
-        df['day_of_week'] = df['event_date'].dt.day_name()
+        columns = DATE_PARTS if columns is None else columns
+        index = date_index_of(df)
+        if index is not None:
+            # Sorted by date: the values of each date are repeated over its rows
+            days, expand = index.days, index.expand
+        else:
+            codes, days = pd.factorize(df['event_date'])
+
+            def expand(values):
+                # Missing dates get missing values; -1 is the missing category code
+                return pd.api.extensions.take(values, codes, allow_fill=True,
+                                              fill_value=-1 if values.dtype == np.int8 else None)
+
+        parts = DataCleaning._calendar(pd.Series(days))
+        for col in columns:
+            values = expand(parts[col])
+            df[col] = pd.Categorical.from_codes(values, dtype=DAYS_OF_WEEK) if col == 'day_of_week' else values
 
         return df
+
+    @staticmethod
+    def _calendar(days):
+        """
+        The date columns of each distinct date, with day_of_week as category codes.
+        """
+        return {'year': days.dt.year.to_numpy(), 'month': days.dt.month.to_numpy(),
+                'year and month': days.dt.to_period('M').dt.to_timestamp().to_numpy(),
+                'day_of_week': pd.Categorical(days.dt.day_name(), dtype=DAYS_OF_WEEK).codes}
+
+
+class IdEncoder:
+    """
+    An append-only dictionary from id labels to compact integer codes, kept per id column name and shared between
+    the adspend, installs, payouts and revenue frames. Codes are assigned in order of first appearance and never
+    change, so frames (or chunks) can be encoded one after another.
+    """
+
+    def __init__(self):
+        self.labels = {}
+
+    def encode(self, col, values):
+        """
+        Encodes the values of an id column, adding unseen labels to the dictionary.
+
+        :param col: The id column name, e.g. 'install_id'.
+        :type col: str
+        :param values: The id labels.
+        :type values: pandas.Series
+        :return: The integer codes, with the index of `values`.
+        :rtype: pandas.Series
+        """
+        labels = self.labels.get(col, pd.Index([], dtype='object'))
+        codes = labels.get_indexer(values)
+        unseen = codes == -1
+        if unseen.any():
+            labels = labels.append(pd.Index(pd.unique(values[unseen]), dtype='object'))
+            codes[unseen] = labels.get_indexer(values[unseen])
+            self.labels[col] = labels
+        code_type = np.int32 if len(labels) < np.iinfo(np.int32).max else np.int64
+        return pd.Series(codes.astype(code_type), index=values.index, name=values.name)
+
+    def decode(self, df):
+        """
+        Maps the encoded id columns of a frame back to their labels. Missing codes (e.g. from outer joins) become
+        missing labels.
+
+        :param df: A frame with encoded id columns.
+        :type df: pandas.DataFrame
+        :return: The same frame with the labels restored.
+        :rtype: pandas.DataFrame
+        """
+        for col in df.columns:
+            if col in self.labels:
+                codes = df[col].to_numpy()
+                if codes.dtype.kind == 'f':
+                    codes = np.where(np.isnan(codes), -1, codes)
+                df[col] = pd.api.extensions.take(self.labels[col].to_numpy(), codes.astype(np.int64),
+                                                 allow_fill=True)
+        return df
+
+
+def _read_spilled(path, dtype, chunksize):
+    with open(path, 'rb') as file:
+        while True:
+            chunk = np.fromfile(file, dtype=dtype, count=chunksize)
+            if not len(chunk):
+                return
+            yield chunk
+
+
+def _sortable_keys(values):
+    # Unsigned integers in the order of the float64 values: positive values get their sign bit set, negative values
+    # get every bit flipped
+    bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+    return np.where(bits >> np.uint64(63), ~bits, bits | np.uint64(1 << 63))
+
+
+def _from_sortable_keys(keys):
+    keys = np.asarray(keys, dtype=np.uint64)
+    return np.where(keys >> np.uint64(63), keys & ~np.uint64(1 << 63), ~keys).view(np.float64)
+
+
+def _order_statistics(chunks, ranks):
+    """
+    Finds the values at the given ranks of values that are read in chunks, without holding more than a chunk.
+
+    Every pass over the chunks counts the values by the next 16 bits of an integer key in the order of the values,
+    among the values whose higher bits are those found so far for the rank, so four passes find the exact values.
+
+    :param chunks: Returns the values as an iterable of float64 arrays without NaNs. It is called once per pass.
+    :type chunks: callable
+    :param ranks: The 0-based ranks of the values in sorted order.
+    :type ranks: list
+    :return: The values at the ranks.
+    :rtype: numpy.ndarray
+    """
+    ranks, inverse = np.unique(np.asarray(ranks, dtype=np.int64), return_inverse=True)
+    prefixes = np.zeros(len(ranks), dtype=np.uint64)
+    for shift in (48, 32, 16, 0):
+        # Ranks whose higher bits are the same share their counts
+        shared, rank_prefix = np.unique(prefixes, return_inverse=True)
+        counts = np.zeros((len(shared), 1 << 16), dtype=np.int64)
+        for values in chunks():
+            keys = _sortable_keys(values)
+            for i, prefix in enumerate(shared):
+                selected = keys if shift == 48 else keys[keys >> np.uint64(shift + 16) == prefix]
+                buckets = (selected >> np.uint64(shift)) & np.uint64(0xFFFF)
+                counts[i] += np.bincount(buckets.astype(np.intp), minlength=1 << 16)
+
+        cumulative = np.cumsum(counts, axis=1)[rank_prefix]
+        buckets = np.array([np.searchsorted(row, rank, side='right') for row, rank in zip(cumulative, ranks)])
+        ranks = ranks - np.where(buckets > 0, cumulative[np.arange(len(ranks)), np.maximum(buckets - 1, 0)], 0)
+        prefixes = (prefixes << np.uint64(16)) | buckets.astype(np.uint64)
+    return _from_sortable_keys(prefixes)[inverse]
+
+
+def _linear_quantiles(chunks, count, quantiles):
+    # numpy.quantile's default 'linear' interpolation, which pandas' quantile uses, between two order statistics
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    virtual = count * quantiles + (1 + quantiles * -1) - 1
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = previous.astype(np.int64)
+    values = _order_statistics(chunks, np.concatenate([previous, np.minimum(previous + 1, count - 1)]))
+    a, b = values[:len(quantiles)], values[len(quantiles):]
+    difference = b - a
+    return np.where(gamma >= 0.5, b - difference * (1 - gamma), a + difference * gamma)
+
+
+class StreamingDataCleaning:
+    """
+    Runs the DataCleaning sequence over a CSV file in bounded chunks instead of loading the whole file.
+
+    The file is read twice. The first pass collects the statistics that need the whole file (column means for
+    fill_missing_values, IQR bounds and outlier counts for check_for_outliers, the duplicate count); the second pass
+    cleans every chunk with those statistics, so the chunks come out as if the whole file had been cleaned at once.
+    Dtypes are declared and dates are parsed during the read, and with an IdEncoder the id columns are stored as
+    shared integer codes instead of Python objects. When dropping duplicates, the statistics pass also holds a table
+    of two to four 64-bit slots per distinct row.
+
+    Memory is bounded by the chunk size in both modes. For the exact quartiles the statistics pass spills the numeric
+    columns to a temporary directory, 8 bytes per row and column (e.g. 800 MB of disk per column for 100 million
+    rows), and finds the quartiles by reading the spilled columns back a chunk at a time, five times per column. With
+    `approximate` the quartiles come from a sketches.QuantileSketches per column instead, so nothing is spilled or
+    read back: the quartiles are within `approximate` (a relative accuracy, e.g. 0.01) of the exact ones, every
+    column's bounds are taken over all rows rather than the rows left by the outliers of earlier columns, and the
+    outlier counts are estimates. Use it when the temporary disk space or the extra reads are too costly.
+
+    To deduplicate files of the same source against each other, e.g. exports with overlapping windows, pass the rows
+    ingested before as `seen`, a SeenRows or BloomSeenRows kept on disk. Rows found in it are dropped as duplicates
+    and the rows of the file are added to it while the chunks are cleaned.
+    """
+
+    def __init__(self, path, chunksize=DEFAULT_CHUNKSIZE, dtype=None, drop_duplicates=False, remove_outliers=False,
+                 break_down_date=True, id_encoder=None, seen=None, approximate=None):
+        self.path = path
+        self.approximate = approximate
+        self.id_encoder = id_encoder
+        self.chunksize = chunksize
+        self.seen = seen
+        self.drop_duplicates = drop_duplicates or seen is not None
+        self.remove_outliers = remove_outliers
+        self.break_down_date = break_down_date
+
+        self.columns = list(pd.read_csv(path, nrows=0).columns)
+        self.date_columns = [col for col in self.columns if 'date' in col]
+        self.dtype = {col: col_type for col, col_type in DEFAULT_DTYPES.items() if col in self.columns}
+        self.dtype.update(dtype or {})
+
+        self.means = None
+        self.bounds = None
+        self.outliers = None
+        self.num_duplicates = None
+
+    def _read_chunks(self):
+        return pd.read_csv(self.path, chunksize=self.chunksize, dtype=self.dtype, parse_dates=self.date_columns)
+
+    def _prepare(self, chunk, seen, history=None):
+        cleaner = DataCleaning(data=chunk, columns=self.columns)
+        # Rows are fingerprinted by their raw ids: codes of an IdEncoder start from 0 in every run, so the same
+        # code can stand for different ids in the rows remembered on disk
+        if history is not None:
+            # Rows ingested before are dropped without adding this file's rows to them yet
+            cleaner.check_duplicates(seen=history, remember=False, verbose=False)
+        if seen is not None:
+            cleaner.check_duplicates(seen=seen, verbose=False)
+        if self.id_encoder is not None:
+            cleaner.id_columns_to_codes(self.id_encoder)
+        else:
+            cleaner.id_columns_to_object()
+        return cleaner
+
+    @traced('StreamingDataCleaning.compute_statistics')
+    def compute_statistics(self):
+        """
+        Reads the file once and computes the column means, the outlier bounds and counts and the number of
+        duplicate records.
+
+        :return: A dictionary with the number of outliers for each numeric column.
+        :rtype: dict
+        """
+        if self.approximate:
+            return self._compute_statistics(None)
+        with tempfile.TemporaryDirectory(prefix='streaming-cleaning-') as spill:
+            return self._compute_statistics(spill)
+
+    def _compute_statistics(self, spill):
+        seen = SeenRows() if self.drop_duplicates else None
+        sums, counts, values = {}, {}, {}
+        num_read, num_rows = 0, 0
+        for chunk in self._read_chunks():
+            num_read += len(chunk)
+            data = self._prepare(chunk, seen, self.seen).data
+            num_rows += len(data)
+            for col in self.columns:
+                if pd.api.types.is_numeric_dtype(data[col]):
+                    sums[col] = sums.get(col, 0.0) + data[col].sum()
+                    counts[col] = counts.get(col, 0) + data[col].count()
+                if data[col].dtype in ['int64', 'float64'] and self.approximate:
+                    quartiles = values.setdefault(col, QuantileSketches(self.approximate))
+                    quartiles.add(np.zeros(len(data), dtype=np.int64), data[col].to_numpy(dtype='float64'))
+                elif data[col].dtype in ['int64', 'float64']:
+                    path = values.setdefault(col, os.path.join(spill, f'{len(values)}.f8'))
+                    with open(path, 'ab') as file:
+                        file.write(data[col].to_numpy(dtype='float64').tobytes())
+
+        self.means = {col: sums[col] / counts[col] if counts[col] else np.nan for col in sums}
+        self.num_duplicates = num_read - num_rows
+
+        self.bounds, self.outliers = {}, {}
+        if self.approximate:
+            for col in self.columns:
+                if col not in values:
+                    continue
+                quartiles = values.pop(col)
+                # The missing values are filled with the mean before the quartiles are taken
+                missing = num_rows - counts[col]
+                if missing and counts[col]:
+                    quartiles.add(np.zeros(missing, dtype=np.int64), np.full(missing, self.means[col]))
+                q1, q3 = quartiles.quantiles((0.25, 0.75))[0]
+                self.bounds[col] = (q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1))
+                self.outliers[col] = quartiles.count_outside(*self.bounds[col])
+            return self.outliers
+
+        # Quartiles are taken in column order over the rows kept so far, as check_for_outliers does. The rows kept
+        # are spilled too, as one byte per row
+        keep, num_kept = None, num_rows
+        for col in self.columns:
+            if col not in values:
+                continue
+            path = values[col]
+            if counts[col] and num_kept:
+                def kept_values():
+                    return (column[kept] for column, kept in self._spilled(path, keep, self.means[col]))
+
+                q1, q3 = _linear_quantiles(kept_values, num_kept, (0.25, 0.75))
+                self.bounds[col] = (q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1))
+            else:
+                # Every value is missing, or no row is left
+                self.bounds[col] = (np.nan, np.nan)
+
+            lower_bound, upper_bound = self.bounds[col]
+            next_keep = path + '.keep' if self.remove_outliers else None
+            self.outliers[col] = 0
+            with open(next_keep, 'wb') if next_keep else contextlib.nullcontext() as file:
+                for column, kept in self._spilled(path, keep, self.means[col]):
+                    is_outlier = (column < lower_bound) | (column > upper_bound)
+                    self.outliers[col] += int((is_outlier & kept).sum())
+                    if file is not None:
+                        file.write((kept & ~is_outlier).tobytes())
+            if self.remove_outliers:
+                keep, num_kept = next_keep, num_kept - self.outliers[col]
+
+        return self.outliers
+
+    def _spilled(self, path, keep, mean):
+        # Chunks of a spilled column with its missing values filled, each with its mask of the rows kept so far
+        masks = _read_spilled(keep, bool, self.chunksize) if keep else None
+        for column in _read_spilled(path, np.float64, self.chunksize):
+            column[np.isnan(column)] = mean
+            yield column, next(masks) if masks else np.ones(len(column), dtype=bool)
+
+    def iter_chunks(self):
+        """
+        Yields the cleaned chunks of the file, computing the statistics first if needed.
+
+        :return: A generator of cleaned DataFrames.
+        :rtype: generator
+        """
+        if self.means is None:
+            self.compute_statistics()
+        seen = (self.seen if self.seen is not None else SeenRows()) if self.drop_duplicates else None
+        for chunk in self._read_chunks():
+            cleaner = self._prepare(chunk, seen)
+            cleaner.fill_missing_values(means=self.means, verbose=False)
+            # The chunk is only referenced by its cleaner, so the outliers can be removed from it in place
+            cleaner.check_for_outliers(remove_outliers=self.remove_outliers, bounds=self.bounds, inplace=True)
+            data = cleaner.data
+            if self.break_down_date:
+                data = DataCleaning.break_down_date(data)
+            yield data
+        if self.seen is not None:
+            self.seen.flush()
+
+    @traced('StreamingDataCleaning.read')
+    def read(self):
+        """
+        Cleans the whole file chunk by chunk and concatenates the cleaned chunks.
+
+        :return: The cleaned DataFrame.
+        :rtype: pandas.DataFrame
+        """
+        return pd.concat(self.iter_chunks(), ignore_index=True)
+
+
+def csv_engine():
+    """
+    :return: 'pyarrow', pandas' multithreaded CSV parser, if pyarrow is installed, else pandas' default 'c' parser.
+    :rtype: str
+    """
+    return 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+
+
+def clean_source(path, remove_outliers=False, drop_duplicates=False, engine=None, cache=None):
+    """
+    Reads the CSV of a source and runs the notebook's DataCleaning sequence on it.
+
+    :param path: The CSV file.
+    :type path: str
+    :param remove_outliers: Whether to remove the outliers. Default is False.
+    :type remove_outliers: bool
+    :param drop_duplicates: Whether to drop duplicate rows. Default is False.
+    :type drop_duplicates: bool
+    :param engine: The read_csv parser. Default is None (see csv_engine).
+    :type engine: str
+    :param cache: Where the cleaned frame is kept. If it holds the frame of the same file content and options, the
+        frame is loaded from there instead. Default is None (always read and clean).
+    :type cache: FrameCache
+    :return: The cleaned frame, with its date broken down.
+    :rtype: pandas.DataFrame
+    """
+    engine = engine or csv_engine()
+    if cache is not None:
+        key = cache.key(path, remove_outliers=remove_outliers, drop_duplicates=drop_duplicates, engine=engine)
+        df = cache.get(key)
+        if df is not None:
+            return df
+
+    df = pd.read_csv(path, engine=engine)
+    cleaner = DataCleaning(data=df, columns=list(df.columns))
+    cleaner.id_columns_to_object()
+    cleaner.date_column_type()
+    if drop_duplicates:
+        cleaner.check_duplicates(verbose=False)
+    cleaner.fill_missing_values(verbose=False)
+    cleaner.check_for_outliers(remove_outliers=remove_outliers, inplace=True)
+    df = DataCleaning.break_down_date(cleaner.data)
+    if cache is not None:
+        cache.put(key, df)
+    return df
+
+
+@traced('load_sources')
+def load_sources(paths, workers=None, processes=False, remove_outliers=REMOVE_OUTLIERS,
+                 drop_duplicates=False, id_encoder=None, engine=None, cache=None):
+    """
+    Reads and cleans the adspend, installs, payouts and revenue CSVs concurrently, each with clean_source, so that
+    one file is parsed while another is cleaned and the whole load takes about as long as the largest file. The
+    largest files are started first.
+
+    Threads share the frames for free and overlap wherever pandas and numpy release the GIL, which the pyarrow parser
+    does for the whole read. Processes also run the cleaning steps in parallel, but send every frame back pickled.
+
+    :param paths: The CSV of every source by source name, or a directory with adspend.csv, installs.csv, payouts.csv
+        and revenue.csv.
+    :type paths: dict or str
+    :param workers: The number of sources loaded at the same time. Default is None (one per source, at most one per
+        CPU).
+    :type workers: int
+    :param processes: Whether to use a process pool instead of a thread pool. Default is False.
+    :type processes: bool
+    :param remove_outliers: The sources whose outliers are removed. Default is ('payouts',), as in the notebook.
+    :type remove_outliers: tuple
+    :param drop_duplicates: Whether to drop duplicate rows. Default is False.
+    :type drop_duplicates: bool
+    :param id_encoder: If given, the id columns are replaced with codes from this shared IdEncoder, source by source
+        in the order of `paths`, so that the codes do not depend on which file finished first. Default is None.
+    :type id_encoder: IdEncoder
+    :param engine: The read_csv parser. Default is None (see csv_engine).
+    :type engine: str
+    :param cache: Where the cleaned frames are kept across sessions, see clean_source. Loading from it is nearly
+        instant with threads; processes send the loaded frames back pickled. Default is None.
+    :type cache: FrameCache
+    :return: The cleaned frames by source name, e.g. for KpiAnalytics(**{f'{name}_df': df for name, df in
+        frames.items()}).
+    :rtype: dict
+    """
+    if isinstance(paths, str):
+        paths = {name: os.path.join(paths, f'{name}.csv') for name in SOURCES}
+    engine = engine or csv_engine()
+    workers = workers or min(len(paths), os.cpu_count() or 1)
+    pool = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+    with pool:
+        futures = {name: pool.submit(clean_source, paths[name], name in remove_outliers, drop_duplicates, engine,
+                                     cache)
+                   for name in sorted(paths, key=lambda name: os.path.getsize(paths[name]), reverse=True)}
+        frames = {}
+        for name in paths:
+            frames[name] = futures[name].result()
+            if id_encoder is not None:
+                cleaner = DataCleaning(data=frames[name], columns=list(frames[name].columns))
+                cleaner.id_columns_to_codes(id_encoder)
+                frames[name] = cleaner.data
+    return frames
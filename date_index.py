@@ -0,0 +1,155 @@
+import weakref
+
+import numpy as np
+import pandas as pd
+
+# The key of the index in DataFrame.attrs, which pandas carries along with the frame
+DATE_INDEX_ATTR = 'date_index'
+
+
+class DateIndex:
+    """
+    The row offsets of each distinct event_date of a frame sorted by event_date: the rows of the i-th date are
+    `offsets[i]:offsets[i + 1]`. Date windows and months are then contiguous row slices found by binary search
+    instead of boolean masks over the whole frame.
+
+    The index travels with the frame in `DataFrame.attrs`. Since pandas also copies attrs to frames derived from it
+    (filtered, reordered or joined ones), date_index_of only returns the index after checking that it still describes
+    the frame. That check is a pass over the dates, so the index remembers the last frame it passed for, with the
+    buffer and length of its dates, and is only checked again for another frame or a replaced event_date column;
+    like the other caches, it does not notice dates overwritten in place.
+    """
+
+    def __init__(self, days, offsets):
+        self.days = days
+        self.offsets = offsets
+        # The frame, event_date buffer address and length the index was last found to match
+        self._matched = None
+
+    @classmethod
+    def build(cls, dates):
+        """
+        Builds the index of sorted dates.
+
+        :param dates: The event dates in ascending order, without missing values.
+        :type dates: numpy.ndarray
+        :return: The index.
+        :rtype: DateIndex
+        """
+        starts = np.flatnonzero(dates[1:] != dates[:-1]) + 1
+        offsets = np.concatenate([[0], starts, [len(dates)]]).astype(np.int64)
+        return cls(dates[offsets[:-1]] if len(dates) else dates[:0], offsets if len(dates) else offsets[-1:])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def counts(self):
+        """
+        :return: The number of rows of each date.
+        :rtype: numpy.ndarray
+        """
+        return np.diff(self.offsets)
+
+    def matches(self, dates):
+        """
+        Checks that the index describes these dates: they are sorted and every date starts and ends where the index
+        says, which leaves no room for any other value.
+
+        :param dates: The event_date column of the frame.
+        :type dates: numpy.ndarray
+        :return: True if the index is exact for the dates.
+        :rtype: bool
+        """
+        if len(dates) != len(self) or dates.dtype != self.days.dtype:
+            return False
+        if not len(dates):
+            return True
+        return bool(np.array_equal(dates[self.offsets[:-1]], self.days)
+                    and np.array_equal(dates[self.offsets[1:] - 1], self.days)
+                    and not np.isnat(dates[-1]) and (dates[1:] >= dates[:-1]).all())
+
+    def bounds(self, start=None, stop=None):
+        """
+        Finds the rows of a date window by binary search.
+
+        :param start: The first date of the window. Default is None (from the first row).
+        :type start: str or pandas.Timestamp
+        :param stop: The last date of the window, inclusive. Default is None (to the last row).
+        :type stop: str or pandas.Timestamp
+        :return: The first and the end row of the window.
+        :rtype: tuple
+        """
+        low = 0 if start is None else np.searchsorted(self.days, np.datetime64(pd.Timestamp(start)), 'left')
+        high = len(self.days) if stop is None else np.searchsorted(self.days, np.datetime64(pd.Timestamp(stop)),
+                                                                   'right')
+        return int(self.offsets[low]), int(self.offsets[max(low, high)])
+
+    def window(self, df, start=None, stop=None):
+        """
+        :return: The rows of `df` between start and stop (inclusive), as a slice of the sorted frame.
+        :rtype: pandas.DataFrame
+        """
+        low, high = self.bounds(start, stop)
+        return df.iloc[low:high]
+
+    def months(self):
+        """
+        :return: The first day of each month with rows, and the first and end row of the month.
+        :rtype: generator
+        """
+        months = self.days.astype('datetime64[M]')
+        starts = np.flatnonzero(np.concatenate([[True], months[1:] != months[:-1]]))
+        ends = np.append(starts[1:], len(self.days))
+        for start, end in zip(starts, ends):
+            yield pd.Timestamp(months[start]), int(self.offsets[start]), int(self.offsets[end])
+
+    def expand(self, values):
+        """
+        Repeats one value per date to one value per row.
+
+        :param values: The values of the distinct dates, in the order of `days`.
+        :type values: numpy.ndarray
+        :return: The values per row.
+        :rtype: numpy.ndarray
+        """
+        return np.repeat(values, self.counts())
+
+
+def sort_by_date(df):
+    """
+    Sorts a frame by event_date, keeping the order of rows with the same date, and attaches its DateIndex. Frames
+    with missing dates are sorted, but get no index.
+
+    :param df: A frame with a datetime event_date column.
+    :type df: pandas.DataFrame
+    :return: The sorted frame with a fresh row index.
+    :rtype: pandas.DataFrame
+    """
+    df = df.sort_values('event_date', kind='stable', ignore_index=True)
+    dates = df['event_date'].to_numpy()
+    if not np.isnat(dates).any():
+        df.attrs[DATE_INDEX_ATTR] = DateIndex.build(dates)
+    return df
+
+
+def date_index_of(df):
+    """
+    Returns the DateIndex of a frame if it has one that still matches its rows.
+
+    :param df: The frame.
+    :type df: pandas.DataFrame
+    :return: The index, or None.
+    :rtype: DateIndex
+    """
+    index = df.attrs.get(DATE_INDEX_ATTR)
+    if index is None or 'event_date' not in df.columns:
+        return None
+    dates = df['event_date'].to_numpy()
+    signature = (dates.__array_interface__['data'][0], len(dates))
+    matched = index._matched
+    if matched is not None and matched[0]() is df and matched[1:] == signature:
+        return index
+    if not index.matches(dates):
+        return None
+    index._matched = (weakref.ref(df),) + signature
+    return index
@@ -0,0 +1,238 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+MEASURES = ['revenue', 'payouts', 'profit_usd']
+SERIES_KEYS = ['network_id', 'country_id']
+SEASON = 7
+# Candidate smoothing parameters of level, trend and season; every series picks the combination that predicted its
+# own history best
+ALPHAS = (0.01, 0.03, 0.1, 0.3)
+BETAS = (0.0, 0.01)
+GAMMAS = (0.01, 0.05, 0.15, 0.3)
+# The trend is damped so that it flattens out over long horizons instead of running away
+DAMPING = 0.98
+
+
+def _day_numbers(dates):
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+
+
+def _weekday(day_number):
+    # Day 0 of the epoch, 1970-01-01, is a Thursday; Monday is 0 as in pandas' dayofweek (not the alphabetical
+    # day_of_week categories)
+    return (day_number + 3) % SEASON
+
+
+class SeasonalForecaster:
+    """
+    Additive Holt-Winters forecasts (exponential smoothing of a level, a damped trend and a weekly season) of many
+    daily series at once, e.g. the revenue, payouts and profit of every network and country of
+    KpiAnalytics.total_profit.
+
+    Every series is smoothed with every candidate combination of ALPHAS, BETAS and GAMMAS in the same pass: the state
+    is a set of (combination, series) arrays and each day is one vectorized update of all of them, so the cost grows
+    with the number of days, not the number of series. Each series forecasts with the combination that had the
+    smallest squared one-step-ahead error on its history, ignoring its first week. Days without a value only carry
+    the state forward, so gaps and series that start late need no filling.
+
+    The state after the last day is kept, so update absorbs only the days after it (warm start): a nightly refit
+    costs one update per new day, and save and load keep the state between runs. A warm update gives the same state
+    as a fit over all the days, except for series whose first value is less than a week before the end of the
+    previous update: they start at the mean of the values seen up to then instead of their full first week, which
+    then fades out at the pace of the chosen alpha.
+    """
+
+    def __init__(self, keys, measures, last_day, level, trend, season, sse, observed, damping=DAMPING):
+        # The series are every key in `keys` times every measure, key-major
+        self.keys = keys
+        self.measures = list(measures)
+        self.last_day = last_day
+        self.level = level
+        self.trend = trend
+        # Indexed by weekday, then combination and series, so that one day's season is contiguous
+        self.season = season
+        self.sse = sse
+        self.observed = observed
+        self.damping = damping
+        self.grid = np.array(list(itertools.product(ALPHAS, BETAS, GAMMAS)))
+
+    @property
+    def last_date(self):
+        return pd.Timestamp(self.last_day, unit='D')
+
+    @classmethod
+    def fit(cls, df, measures=MEASURES, keys=SERIES_KEYS, damping=DAMPING):
+        """
+        Fits the series of a frame from scratch.
+
+        :param df: One row per series and day, e.g. the output of KpiAnalytics.total_profit.
+        :type df: pandas.DataFrame
+        :param measures: The columns to forecast. Default is MEASURES.
+        :type measures: list
+        :param keys: The columns that identify a series. Default is SERIES_KEYS.
+        :type keys: list
+        :param damping: The factor the trend is multiplied by every day. Default is DAMPING.
+        :type damping: float
+        :return: The fitted forecaster.
+        :rtype: SeasonalForecaster
+        """
+        df = df.dropna(subset=keys)
+        days = _day_numbers(df['event_date'])
+        n_combinations = len(ALPHAS) * len(BETAS) * len(GAMMAS)
+        empty = np.empty((n_combinations, 0))
+        forecaster = cls(pd.MultiIndex.from_arrays([[]] * len(keys), names=keys), measures,
+                         (int(days.min()) if len(days) else 0) - 1, empty, empty.copy(), np.empty((SEASON, n_combinations, 0)),
+                         empty.copy(), np.empty(0, dtype=np.int64), damping)
+        return forecaster.update(df)
+
+    def update(self, df):
+        """
+        Absorbs the days after the last fitted day. Rows of earlier days are ignored, series that were not seen
+        before are fitted from scratch and series without new rows are carried forward. Series that started within
+        a week of the last fitted day keep the level they were started at, see the class description.
+
+        :param df: One row per series and day, with the key and measure columns.
+        :type df: pandas.DataFrame
+        :return: self
+        :rtype: SeasonalForecaster
+        """
+        days = _day_numbers(df['event_date'])
+        df = df.loc[(days > self.last_day) & df[self.keys.names].notna().all(axis=1).to_numpy()]
+        if not len(df):
+            return self
+        days = _day_numbers(df['event_date'])
+        row_keys = pd.MultiIndex.from_frame(df[self.keys.names])
+        new_keys = row_keys.unique().difference(self.keys, sort=False)
+        if len(new_keys):
+            self._add_series(len(new_keys))
+            self.keys = self.keys.append(new_keys)
+
+        # One row of values per series and one column per day since the last fitted day
+        n_measures = len(self.measures)
+        first_day, n_days = self.last_day + 1, int(days.max()) - self.last_day
+        values = np.full((len(self.keys) * n_measures, n_days), np.nan)
+        series = self.keys.get_indexer(row_keys)[:, None] * n_measures + np.arange(n_measures)
+        values[series, (days - first_day)[:, None]] = df[self.measures].to_numpy(dtype=np.float64)
+        if len(new_keys):
+            self._initialize(values, len(new_keys) * n_measures)
+
+        alpha, beta, gamma = (self.grid[:, [i]] for i in range(3))
+        for t in range(n_days):
+            y = values[:, t]
+            observed = ~np.isnan(y)
+            weekday = _weekday(first_day + t)
+            season = self.season[weekday]
+            # A series without any value yet starts at its first one
+            fresh = observed & np.isnan(self.level)
+            if fresh.any():
+                self.level[:, fresh] = y[fresh] - season[:, fresh]
+                self.trend[:, fresh] = 0
+            error = np.where(observed, y - (self.level + self.damping * self.trend + season), 0)
+            self.level += self.damping * self.trend + alpha * error
+            self.trend = self.damping * self.trend + beta * error
+            season += gamma * error
+            # The first week only settles the season, so its errors do not choose the parameters
+            self.sse += np.where(self.observed >= SEASON, error * error, 0)
+            self.observed += observed
+        self.last_day += n_days
+        return self
+
+    def _add_series(self, n_keys):
+        n_series = n_keys * len(self.measures)
+        self.level = np.concatenate([self.level, np.full((len(self.grid), n_series), np.nan)], axis=1)
+        self.trend = np.concatenate([self.trend, np.zeros((len(self.grid), n_series))], axis=1)
+        self.season = np.concatenate([self.season, np.zeros((SEASON, len(self.grid), n_series))], axis=2)
+        self.sse = np.concatenate([self.sse, np.zeros((len(self.grid), n_series))], axis=1)
+        self.observed = np.concatenate([self.observed, np.zeros(n_series, dtype=np.int64)])
+
+    def _initialize(self, values, n_series):
+        """
+        Starts the new series, the last `n_series` rows of `values`, at the mean of their first week of values and
+        without a season; a season estimated from one week is mostly noise.
+        """
+        values = values[-n_series:]
+        first = np.argmax(~np.isnan(values), axis=1)
+        columns = np.minimum(first[:, None] + np.arange(SEASON), values.shape[1] - 1)
+        week = np.take_along_axis(values, columns, axis=1)
+        counts = (~np.isnan(week)).sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            self.level[:, -n_series:] = np.where(counts > 0, np.nansum(week, axis=1) / counts, np.nan)
+
+    def _best(self):
+        # The combination with the smallest error of each series
+        return np.argmin(self.sse, axis=0)
+
+    def parameters(self):
+        """
+        :return: The smoothing parameters 'alpha', 'beta' and 'gamma' of every series, with its key columns and
+            'measure'.
+        :rtype: pandas.DataFrame
+        """
+        result = self._series_frame()
+        result[['alpha', 'beta', 'gamma']] = self.grid[self._best()]
+        return result
+
+    def _series_frame(self):
+        keys = self.keys.to_frame(index=False).loc[np.repeat(np.arange(len(self.keys)), len(self.measures))]
+        keys = keys.reset_index(drop=True)
+        keys['measure'] = np.tile(self.measures, len(self.keys))
+        return keys
+
+    def forecast(self, horizon=30):
+        """
+        Forecasts every series for the days after the last fitted day.
+
+        :param horizon: The number of days to forecast. Default is 30.
+        :type horizon: int
+        :return: One row per series key and day with the key columns, 'event_date' and the forecast of every measure.
+        :rtype: pandas.DataFrame
+        """
+        best = self._best()
+        series = np.arange(best.size)
+        steps = np.arange(1, horizon + 1)
+        # The damped trend adds damping + damping^2 + ... + damping^h after h days
+        trend_sum = np.cumsum(self.damping ** steps)
+        weekdays = _weekday(self.last_day + steps)
+        values = (self.level[best, series][:, None] + self.trend[best, series][:, None] * trend_sum +
+                  self.season[weekdays][:, best, series].T)
+
+        n_keys, n_measures = len(self.keys), len(self.measures)
+        result = self.keys.to_frame(index=False).loc[np.repeat(np.arange(n_keys), horizon)].reset_index(drop=True)
+        result['event_date'] = np.tile(pd.to_datetime(self.last_day + steps, unit='D'), n_keys)
+        # values is (series, day) with the measures of a key next to each other
+        result[self.measures] = values.reshape(n_keys, n_measures, horizon).transpose(0, 2, 1).reshape(-1, n_measures)
+        return result
+
+    def save(self, path):
+        """
+        Stores the fitted state in a .npz file.
+
+        :param path: The file.
+        :type path: str
+        :return: None
+        :rtype: None
+        """
+        np.savez(path, keys=np.asarray(self.keys.tolist(), dtype=object), names=np.asarray(self.keys.names),
+                 measures=np.asarray(self.measures), last_day=self.last_day, level=self.level, trend=self.trend,
+                 season=self.season, sse=self.sse, observed=self.observed, damping=self.damping, grid=self.grid)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a state stored by save, e.g. yesterday's, to update it with the new days.
+
+        :param path: The file.
+        :type path: str
+        :return: The forecaster.
+        :rtype: SeasonalForecaster
+        """
+        with np.load(path, allow_pickle=True) as state:
+            names = list(state['names'])
+            if not np.array_equal(state['grid'], np.array(list(itertools.product(ALPHAS, BETAS, GAMMAS)))):
+                raise ValueError(f'{path} was fitted with other candidate parameters')
+            keys = pd.MultiIndex.from_tuples([tuple(key) for key in state['keys']], names=names) if len(
+                state['keys']) else pd.MultiIndex.from_arrays([[]] * len(names), names=names)
+            return cls(keys, list(state['measures']), int(state['last_day']), state['level'], state['trend'],
+                       state['season'], state['sse'], state['observed'], float(state['damping']))
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from date_index import DATE_INDEX_ATTR, DateIndex, date_index_of
+
+# Part of every key, so that entries written by an older layout or cleaning sequence are not read back
+CACHE_FORMAT = 2
+# Bytes hashed at a time when fingerprinting a source file
+BLOCK_SIZE = 1 << 20
+# One memo file per source path, so that processes fingerprinting different files never rewrite each other's memo
+FINGERPRINTS_DIR = 'fingerprints'
+# Nullable extension arrays that are stored as their values plus a mask of the missing ones
+MASKED_ARRAYS = (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)
+
+
+def _write_json(path, value):
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+
+class FrameCache:
+    """
+    Cleaned frames on local disk, one directory per entry with one .npy file per column, so that a cleaned source
+    is loaded without parsing or cleaning it again.
+
+    Columns are memory-mapped copy-on-write and put into the frame without consolidating them, so loading reads
+    no data up front, several processes loading the same entry share its pages, and writing to a loaded frame only
+    copies the pages written. Integer ids stored as objects (see DataCleaning.id_columns_to_object) are kept as int64
+    and turned back into objects on load, which is the one copy; encoded ids and all other numeric, datetime and
+    categorical columns are not copied. Other object columns are pickled and read into memory. Extension dtypes are
+    stored with the frame and restored on load: timezone-aware datetimes as UTC datetimes, nullable integer, float
+    and boolean columns as their values plus a mask, and other extension columns (e.g. string) are pickled; dtypes
+    that cannot be restored from their name are rejected.
+
+    Entries are keyed by a fingerprint of the source file's content plus the cleaning options, see key. They are
+    written to a temporary directory that is renamed once complete, so a reader never sees a partial entry.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, path):
+        """
+        Hashes the content of a file. The hash is remembered per path, size and modification time, so an unchanged
+        file is only read once. Every path has its own memo file, which is replaced atomically, so concurrent
+        processes need no lock: at worst two of them hash the same file and write the same memo.
+
+        :param path: The file.
+        :type path: str
+        :return: The BLAKE2b hash of the content, in hex.
+        :rtype: str
+        """
+        stat = os.stat(path)
+        signature = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+        memo_directory = os.path.join(self.directory, FINGERPRINTS_DIR)
+        memo_path = os.path.join(memo_directory,
+                                 hashlib.blake2b(signature[0].encode(), digest_size=16).hexdigest() + '.json')
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+        except (OSError, ValueError):
+            memo = None
+        if memo is not None and memo[:3] == signature:
+            return memo[3]
+
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                digest.update(block)
+        os.makedirs(memo_directory, exist_ok=True)
+        _write_json(memo_path, signature + [digest.hexdigest()])
+        return digest.hexdigest()
+
+    def key(self, path, **options):
+        """
+        :param path: The source file.
+        :type path: str
+        :param options: The options the frame was cleaned with; they have to be JSON serializable.
+        :return: The key of the cleaned frame of this file content with these options.
+        :rtype: str
+        """
+        description = json.dumps({'format': CACHE_FORMAT, 'source': self.fingerprint(path), 'options': options},
+                                 sort_keys=True)
+        name = os.path.splitext(os.path.basename(path))[0]
+        return f'{name}-{hashlib.blake2b(description.encode(), digest_size=16).hexdigest()}'
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.directory, key, 'meta.json'))
+
+    def get(self, key):
+        """
+        Loads an entry.
+
+        :param key: The key, see key.
+        :type key: str
+        :return: The frame, or None if there is no such entry.
+        :rtype: pandas.DataFrame
+        """
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        def load(name):
+            return np.load(os.path.join(entry, f'{name}.npy'), mmap_mode='c')
+
+        columns = {}
+        for i, (column, kind, dtype) in enumerate(zip(meta['columns'], meta['kinds'], meta['dtypes'])):
+            if dtype is not None:
+                dtype = pd.api.types.pandas_dtype(dtype)
+            if kind == 'array':
+                columns[column] = load(i)
+            elif kind == 'datetimetz':
+                columns[column] = pd.Series(load(i)).dt.tz_localize('UTC').dt.tz_convert(dtype.tz).astype(dtype).array
+            elif kind == 'masked':
+                values = pd.array(load(i), dtype=dtype)
+                values[np.load(os.path.join(entry, f'{i}.mask.npy'))] = pd.NA
+                columns[column] = values
+            elif kind == 'object_int':
+                columns[column] = load(i).astype(object)
+            elif kind in ('categorical', 'ordered categorical'):
+                categories = np.load(os.path.join(entry, f'{i}.categories.npy'), allow_pickle=True)
+                dtype = pd.CategoricalDtype(categories, ordered=kind == 'ordered categorical')
+                columns[column] = pd.Categorical.from_codes(load(i), dtype=dtype)
+            else:
+                values = np.load(os.path.join(entry, f'{i}.npy'), allow_pickle=True)
+                columns[column] = values if dtype is None else pd.array(values, dtype=dtype)
+        index = load('index') if meta['index'] else None
+        df = pd.DataFrame(columns, index=index, copy=False)
+        if meta['date_index']:
+            df.attrs[DATE_INDEX_ATTR] = DateIndex(load('days'), load('offsets'))
+        return df
+
+    def put(self, key, df):
+        """
+        Stores a frame. An entry that exists already is kept. A column with an extension dtype that cannot be
+        restored from its name raises a TypeError.
+
+        :param key: The key, see key.
+        :type key: str
+        :param df: The frame; its columns need distinct names.
+        :type df: pandas.DataFrame
+        :return: None
+        :rtype: None
+        """
+        if key in self:
+            return
+        dtypes = [None if isinstance(df[column].dtype, (np.dtype, pd.CategoricalDtype)) else str(df[column].dtype)
+                  for column in df.columns]
+        for column, dtype in zip(df.columns, dtypes):
+            if dtype is not None and not self._restorable(dtype, df[column].dtype):
+                raise TypeError(f'Column {column} has dtype {dtype}, which cannot be cached')
+
+        tmp = tempfile.mkdtemp(prefix=f'{key}.', dir=self.directory)
+        kinds = []
+        for i, column in enumerate(df.columns):
+            values = df[column]
+            path = os.path.join(tmp, f'{i}.npy')
+            if isinstance(values.dtype, pd.DatetimeTZDtype):
+                kinds.append('datetimetz')
+                np.save(path, values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy())
+            elif isinstance(values.array, MASKED_ARRAYS):
+                kinds.append('masked')
+                np.save(path, values.to_numpy(dtype=values.dtype.numpy_dtype, na_value=0))
+                np.save(os.path.join(tmp, f'{i}.mask.npy'), values.isna().to_numpy())
+            elif isinstance(values.dtype, pd.CategoricalDtype):
+                kinds.append('ordered categorical' if values.cat.ordered else 'categorical')
+                np.save(path, values.cat.codes.to_numpy())
+                np.save(os.path.join(tmp, f'{i}.categories.npy'), values.cat.categories.to_numpy(), allow_pickle=True)
+            elif isinstance(values.dtype, np.dtype) and values.dtype != object:
+                kinds.append('array')
+                np.save(path, values.to_numpy())
+            elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=False) == 'integer':
+                kinds.append('object_int')
+                np.save(path, values.to_numpy(dtype=np.int64))
+            else:
+                kinds.append('pickle')
+                np.save(path, values.to_numpy(dtype=object), allow_pickle=True)
+
+        # A default index is not stored
+        index = not df.index.equals(pd.RangeIndex(len(df)))
+        if index:
+            np.save(os.path.join(tmp, 'index.npy'), df.index.to_numpy())
+        date_index = date_index_of(df)
+        if date_index is not None:
+            np.save(os.path.join(tmp, 'days.npy'), date_index.days)
+            np.save(os.path.join(tmp, 'offsets.npy'), date_index.offsets)
+        _write_json(os.path.join(tmp, 'meta.json'), {'columns': list(df.columns), 'kinds': kinds, 'dtypes': dtypes,
+                                                     'index': index, 'date_index': date_index is not None})
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @staticmethod
+    def _restorable(name, dtype):
+        try:
+            return pd.api.types.pandas_dtype(name) == dtype
+        except TypeError:
+            return False
+
+    def clear(self):
+        """
+        Removes every entry and remembered fingerprint.
+
+        :return: None
+        :rtype: None
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
@@ -1,12 +1,166 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
-import statsmodels.api as sm
-from data_analytics import regressions_charts
+import pandas as pd
+from forecasting import SeasonalForecaster
+from tracing import span, traced
+
+# The (x, y) pairs of test_hypothesis and check_hypothesis: acquisition costs vs retention, retention vs profit
+HYPOTHESES = [('user_acquisition_cost_usd', 'retension_rate'), ('retension_rate', 'profit_usd')]
+# Bootstrap replicates drawn per task and seed, so that the intervals do not depend on the number of workers
+BOOTSTRAP_BATCH = 100
+
+
+def _fit(codes, x, y, n_segments):
+    """
+    Fits y = intercept + slope * x by least squares in every segment at once from its sums, computed about the
+    segment means so that large values do not cancel out.
+    """
+    n = np.bincount(codes, minlength=n_segments).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.bincount(codes, x, n_segments) / n
+        y_mean = np.bincount(codes, y, n_segments) / n
+        dx, dy = x - x_mean[codes], y - y_mean[codes]
+        sxx = np.bincount(codes, dx * dx, n_segments)
+        syy = np.bincount(codes, dy * dy, n_segments)
+        sxy = np.bincount(codes, dx * dy, n_segments)
+        slope = sxy / sxx
+        return {'n': n, 'x_mean': x_mean, 'y_mean': y_mean, 'sxx': sxx, 'syy': syy, 'sxy': sxy, 'slope': slope,
+                'intercept': y_mean - slope * x_mean}
+
+
+def _bootstrap_slopes(codes, x, y, n_segments, replicates, seed):
+    """
+    Refits the slopes of every segment on `replicates` resamples of its rows, drawn with replacement within the
+    segment. The rows have to be sorted by segment.
+    """
+    rng = np.random.default_rng(seed)
+    counts = np.bincount(codes, minlength=n_segments)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[codes]
+    counts = counts[codes]
+    slopes = np.empty((replicates, n_segments))
+    for i in range(replicates):
+        rows = starts + (rng.random(len(codes)) * counts).astype(np.int64)
+        slopes[i] = _fit(codes, x[rows], y[rows], n_segments)['slope']
+    return slopes
 
 
 class ForeCast:
     def __init__(self, df):
         self.df = df
+        self._hypotheses = None
+        self.forecaster = None
+
+    @traced('ForeCast.regressions')
+    def regressions(self, by=None, pairs=HYPOTHESES, bootstrap=0, confidence=0.95, workers=1, seed=0):
+        """
+        Regresses y on x for every segment of the frame, e.g. per network, country or month, in one vectorized pass
+        over the segments' sums instead of one OLS fit per segment. Slopes, intercepts, standard errors and p-values
+        are those of OLS with a constant; rows where x or y is missing are left out.
+
+        :param by: The column or columns that define the segments. Default is None (the whole frame).
+        :type by: str or list
+        :param pairs: The (x, y) column pairs to regress. Default is HYPOTHESES.
+        :type pairs: list
+        :param bootstrap: The number of bootstrap resamples for the confidence interval of the slope; the rows are
+            resampled within each segment. Default is 0 (no interval).
+        :type bootstrap: int
+        :param confidence: The level of the bootstrap interval. Default is 0.95.
+        :type confidence: float
+        :param workers: The number of processes that draw the bootstrap resamples. Default is 1.
+        :type workers: int
+        :param seed: The seed of the bootstrap resamples. Default is 0.
+        :type seed: int
+        :return: One row per segment and pair with the segment columns, 'x', 'y', 'n', 'slope', 'intercept',
+            'correlation', 'r_squared', 'slope_se', 'intercept_se', 't_value' and the two-sided 'p_value' of the
+            slope, and with a bootstrap 'slope_ci_low' and 'slope_ci_high'.
+        :rtype: pandas.DataFrame
+        """
+        # scipy.stats takes a while to import and only the p-values need it
+        from scipy import stats
+
+        by = [by] if isinstance(by, str) else list(by or [])
+        if by:
+            grouped = self.df.groupby(by, observed=True)
+            segments = grouped.size().index.to_frame(index=False)
+            segment_of = grouped.ngroup().to_numpy(dtype=np.float64)
+        else:
+            segments = pd.DataFrame(index=[0])
+            segment_of = np.zeros(len(self.df))
 
+        results = []
+        for x_column, y_column in pairs:
+            x = self.df[x_column].to_numpy(dtype=np.float64)
+            y = self.df[y_column].to_numpy(dtype=np.float64)
+            # Rows in no segment (missing keys) or without x or y are left out, as statsmodels' missing='drop' does
+            rows = np.flatnonzero(~np.isnan(segment_of) & ~np.isnan(x) & ~np.isnan(y))
+            rows = rows[np.argsort(segment_of[rows], kind='stable')]
+            codes, x, y = segment_of[rows].astype(np.int64), x[rows], y[rows]
+            with span('ForeCast.ols', rows_in=len(rows)):
+                fit = _fit(codes, x, y, len(segments))
+            result = segments.copy()
+            result['x'], result['y'], result['n'] = x_column, y_column, fit['n'].astype(np.int64)
+            result['slope'], result['intercept'] = fit['slope'], fit['intercept']
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dof = fit['n'] - 2
+                result['correlation'] = fit['sxy'] / np.sqrt(fit['sxx'] * fit['syy'])
+                result['r_squared'] = result['correlation'] ** 2
+                # The residual variance; the residual sum of squares is syy - slope * sxy, which rounding can take
+                # below zero for a perfect fit
+                residuals = np.maximum(fit['syy'] - fit['slope'] * fit['sxy'], 0)
+                variance = np.where(dof > 0, residuals / dof, np.nan)
+                result['slope_se'] = np.sqrt(variance / fit['sxx'])
+                result['intercept_se'] = np.sqrt(variance * (1 / fit['n'] + fit['x_mean'] ** 2 / fit['sxx']))
+                result['t_value'] = fit['slope'] / result['slope_se']
+                result['p_value'] = 2 * stats.t.sf(np.abs(result['t_value']), np.where(dof > 0, dof, np.nan))
+            if bootstrap:
+                slopes = self._bootstrap(codes, x, y, len(segments), bootstrap, workers, seed)
+                with np.errstate(invalid='ignore'), span('ForeCast.bootstrap', rows_in=len(rows) * bootstrap):
+                    alpha = (1 - confidence) / 2
+                    result['slope_ci_low'], result['slope_ci_high'] = np.nanquantile(slopes, [alpha, 1 - alpha],
+                                                                                     axis=0)
+            results.append(result)
+        return pd.concat(results, ignore_index=True)
+
+    @staticmethod
+    def _bootstrap(codes, x, y, n_segments, bootstrap, workers, seed):
+        sizes = [min(BOOTSTRAP_BATCH, bootstrap - start) for start in range(0, bootstrap, BOOTSTRAP_BATCH)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        draw = partial(_bootstrap_slopes, codes, x, y, n_segments)
+        if workers <= 1:
+            return np.concatenate(list(map(draw, sizes, seeds)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return np.concatenate(list(pool.map(draw, sizes, seeds)))
+
+    @traced('ForeCast.forecast')
+    def forecast(self, horizon=30, forecaster=None):
+        """
+        Forecasts the revenue, payouts and profit of every network and country, see SeasonalForecaster. The fitted
+        forecaster is kept in self.forecaster, so that it can be saved and updated with the next day's frame.
+
+        :param horizon: The number of days to forecast. Default is 30.
+        :type horizon: int
+        :param forecaster: A forecaster fitted on earlier days, e.g. yesterday's, which is updated with the days of
+            the frame after its last day instead of fitting the whole history again. Default is None.
+        :type forecaster: SeasonalForecaster
+        :return: One row per network, country and day with 'event_date', 'revenue', 'payouts' and 'profit_usd'.
+        :rtype: pandas.DataFrame
+        """
+        with span('ForeCast.smoothing', rows_in=len(self.df)):
+            if forecaster is None:
+                self.forecaster = SeasonalForecaster.fit(self.df)
+            else:
+                self.forecaster = forecaster.update(self.df)
+        return self.forecaster.forecast(horizon)
+
+    def _hypothesis_results(self):
+        # Both hypothesis methods report the same two whole-frame regressions, which are fitted once
+        if self._hypotheses is None:
+            self._hypotheses = self.regressions()
+        return self._hypotheses
+
+    @traced('ForeCast.test_hypothesis')
     def test_hypothesis(self):
         """
         Tests the hypothesis that user acquisition costs and retention rates are correlated with profits.
@@ -15,61 +169,42 @@ class ForeCast:
         profits. Performs linear regression for each correlation and calculates the predicted values. Generates
         regression charts for each regression.
 
-        :return: None
-        :rtype: None
+        :return: The two regressions, see regressions.
+        :rtype: pandas.DataFrame
         """
-        # calculate correlation between acquisition costs and retention rates
-        correlation = np.corrcoef(self.df['user_acquisition_cost_usd'], self.df['retension_rate'])[0, 1]
-        print(f"Correlation between acquisition costs and retention rates: {correlation}")
-
-        # perform linear regression between acquisition costs and retention rates
-        x = sm.add_constant(self.df['user_acquisition_cost_usd'])
-        model = sm.OLS(self.df['retension_rate'], x).fit()
-        # print(model.summary())
-
-        # calculate predicted retention rates based on the regression model
-        predicted_retention_rates = model.predict(x)
-        regressions_charts(x=self.df['user_acquisition_cost_usd'], y=self.df['retension_rate'],
-                           prediction=predicted_retention_rates,
-                           xlabel="Acquisition Costs", ylabel="Retention Rates",
-                           title="Acquisition Costs vs. Retention Rates")
-
-        # calculate correlation between retention rates and profits
-        correlation = np.corrcoef(self.df['retension_rate'], self.df['profit_usd'])[0, 1]
-        print(f"Correlation between retention rates and profits: {correlation}")
-
-        # perform linear regression between retention rates and profits
-        x = sm.add_constant(self.df['retension_rate'])
-        model = sm.OLS(self.df['profit_usd'], x).fit()
-        # print(model.summary())
-
-        # calculate predicted profits based on the regression model
-        predicted_profits = model.predict(x)
-        regressions_charts(x=self.df['retension_rate'], y=self.df['profit_usd'],
-                           prediction=predicted_profits,
-                           xlabel="Rates", ylabel="Profits",
-                           title="Retention Rates vs. Profits")
+        from data_analytics import regressions_charts
+
+        results = self._hypothesis_results()
+        labels = [("acquisition costs and retention rates", "Acquisition Costs", "Retention Rates",
+                   "Acquisition Costs vs. Retention Rates"),
+                  ("retention rates and profits", "Rates", "Profits", "Retention Rates vs. Profits")]
+        for result, (pair, xlabel, ylabel, title) in zip(results.itertuples(), labels):
+            print(f"Correlation between {pair}: {result.correlation}")
+
+            # calculate predicted values based on the regression model
+            prediction = result.intercept + result.slope * self.df[result.x]
+            with span('ForeCast.chart'):
+                regressions_charts(x=self.df[result.x], y=self.df[result.y], prediction=prediction,
+                                   xlabel=xlabel, ylabel=ylabel, title=title)
+        return results
 
+    @traced('ForeCast.check_hypothesis')
     def check_hypothesis(self):
         """
         Perform hypothesis testing between acquisition costs and retention rates, and between profit and retention
         rates.
 
-           :return: None
-           :rtype: None
+           :return: The two regressions, see regressions.
+           :rtype: pandas.DataFrame
            """
+        results = self._hypothesis_results()
+        alpha = 0.05
         print('Perform hypothesis testing between acquisition costs and retention rates')
         print('')
-        alpha = 0.05
         print('Null hypothesis: increasing user acquisition costs do not lead to a higher user retention rate')
         print('Alternative hypothesis: increasing user acquisition costs lead to a higher user retention rate')
         print('')
-        x = self.df['user_acquisition_cost_usd']
-        y = self.df['retension_rate']
-        x = sm.add_constant(x)
-        model = sm.OLS(y, x).fit()
-        p_value = model.pvalues[1]
-        if p_value < alpha:
+        if results['p_value'][0] < alpha:
             print(
                 "Reject the null hypothesis. There is evidence that increasing user acquisition costs lead to a "
                 "higher user retention rate.")
@@ -81,16 +216,10 @@ class ForeCast:
         print('')
         print('Perform hypothesis testing between profit and retention rates')
         print('')
-        alpha = 0.05
         print('Null hypothesis: increasing user retention does not lead to a higher profits')
         print('Alternative hypothesis: increasing user retension lead to a higher profits')
         print('')
-        x = self.df['retension_rate']
-        y = self.df['profit_usd']
-        x = sm.add_constant(x)
-        model = sm.OLS(y, x).fit()
-        p_value = model.pvalues[1]
-        if p_value < alpha:
+        if results['p_value'][1] < alpha:
             print(
                 "Reject the null hypothesis. There is evidence that increasing user retension leads to a higher "
                 "profits.")
@@ -98,3 +227,4 @@ class ForeCast:
             print(
                 "Fail to reject the null hypothesis. There is no evidence that increasing retension leads to a higher "
                 "profits.")
+        return results
@@ -0,0 +1,208 @@
+import pandas as pd
+from data_wrangling import DATE_PARTS, DataCleaning
+
+CUBE_KEYS = ['network_id', 'country_id', 'event_date']
+MEASURES = ['installs', 'adspend_usd', 'uac_sum', 'uac_rows',
+            'revenue_usd', 'revenue_count', 'revenue_rows',
+            'payouts_usd', 'payouts_count', 'payouts_rows',
+            'total_users', 'retained_users', 'days_active_sum', 'cohort_rows',
+            'profit_usd', 'profit_rows']
+MERGED_MEASURES = MEASURES[:-2]
+# user_retention_rate groups by the install columns, which are stored under the cube's own names
+RETENTION_COLUMNS = {'install_date': 'event_date', 'install_year and month': 'year and month'}
+
+
+class KpiCube:
+    """
+    Additive KPI measures materialized per network, country and day, with roll-ups to any coarser grain.
+
+    Every measure is a sum or a count, so a roll-up is a single groupby-sum over the cube and the KPIs (means, rates,
+    profit) are derived from the rolled-up sums. The `*_rows` measures count the rows of the original frame that fell
+    into a cell; a KPI only reports the groups that have such rows, exactly like the groupby over the raw frame. Rows
+    without a network or country (revenue and payouts off the install day) are left out, so the cube matches the raw
+    frames only for installs with both ids and for group columns that include one of them. The retention counters
+    (distinct users) are only additive when every install_id belongs to a single install.
+    """
+
+    def __init__(self, data, dimensions):
+        self.data = data
+        self.dimensions = dimensions
+
+    @property
+    def nbytes(self):
+        return int(self.data.memory_usage(deep=True).sum())
+
+    @classmethod
+    def from_frames(cls, daily_acquisition, revenue_events, payouts_events, retention_activity):
+        """
+        Builds the day-grain cube from the intermediate frames of KpiAnalytics.
+
+        :param daily_acquisition: Installs, ad spend and user acquisition cost per network, country and day.
+        :type daily_acquisition: pandas.DataFrame
+        :param revenue_events: Revenue per install and day, outer-joined with the installs.
+        :type revenue_events: pandas.DataFrame
+        :param payouts_events: Payouts per install and day, outer-joined with the installs.
+        :type payouts_events: pandas.DataFrame
+        :param retention_activity: Installs with their days active.
+        :type retention_activity: pandas.DataFrame
+        :return: The cube at network, country and day grain.
+        :rtype: KpiCube
+        """
+        acquisition = daily_acquisition[CUBE_KEYS + ['install_id', 'value_usd', 'user_acquisition_cost_usd']].rename(
+            columns={'install_id': 'installs', 'value_usd': 'adspend_usd', 'user_acquisition_cost_usd': 'uac_sum'})
+        acquisition['uac_rows'] = 1
+
+        frames = [acquisition]
+        for source, events in [('revenue', revenue_events), ('payouts', payouts_events)]:
+            grouped = events.groupby(CUBE_KEYS)[f'{source}_per_install_usd']
+            frames.append(grouped.agg(['sum', 'count', 'size']).rename(
+                columns={'sum': f'{source}_usd', 'count': f'{source}_count', 'size': f'{source}_rows'}).reset_index())
+
+        activity = retention_activity.rename(columns={'install_date': 'event_date'})
+        grouped = activity.groupby(CUBE_KEYS)
+        cohorts = pd.DataFrame({'total_users': grouped['install_id'].nunique(),
+                                'days_active_sum': grouped['days_active'].sum(),
+                                'cohort_rows': grouped.size()})
+        cohorts['retained_users'] = activity.loc[activity['days_active'] == 0].groupby(
+            CUBE_KEYS)['install_id'].nunique()
+        frames.append(cohorts.reset_index())
+
+        data = frames[0]
+        for frame in frames[1:]:
+            data = pd.merge(data, frame, on=CUBE_KEYS, how='outer')
+        data[MERGED_MEASURES] = data[MERGED_MEASURES].fillna(0)
+
+        # total_profit keeps the acquisition rows that have a retention cohort
+        has_profit = (data['uac_rows'] > 0) & (data['cohort_rows'] > 0)
+        data['profit_usd'] = (data['revenue_usd'] - data['payouts_usd'] - data['uac_sum']).where(has_profit, 0)
+        data['profit_rows'] = has_profit.astype('int64')
+
+        data = data.sort_values(CUBE_KEYS, ignore_index=True)
+        data = DataCleaning.break_down_date(data)
+        return cls(data, CUBE_KEYS + DATE_PARTS)
+
+    def covers(self, groupby_column):
+        """
+        Tells whether the cube can be grouped by the given columns.
+
+        :param groupby_column: A column name or a list of column names.
+        :type groupby_column: str or list
+        :return: True if every column is a dimension of the cube.
+        :rtype: bool
+        """
+        return set(self._columns(groupby_column)) <= set(self.dimensions)
+
+    def covers_retention(self, groupby_column):
+        """
+        Tells whether the cube can answer user_retention_rate for the given group columns.
+
+        :param groupby_column: A column name or a list of column names.
+        :type groupby_column: str or list
+        :return: True if every column maps onto a dimension of the cube.
+        :rtype: bool
+        """
+        columns = self._columns(groupby_column)
+        # The events' own date columns do not exist in the retention frame
+        if set(columns) & set(RETENTION_COLUMNS.values()):
+            return False
+        return self.covers([RETENTION_COLUMNS.get(col, col) for col in columns])
+
+    @staticmethod
+    def _columns(groupby_column):
+        return groupby_column if isinstance(groupby_column, list) else [groupby_column]
+
+    def rollup(self, groupby_column):
+        """
+        Rolls the cube up to a coarser grain, e.g. network and month. The result is again a cube and can be rolled up
+        further or queried for any subset of its dimensions.
+
+        :param groupby_column: The dimensions to keep.
+        :type groupby_column: str or list
+        :return: The rolled-up cube.
+        :rtype: KpiCube
+        """
+        columns = self._columns(groupby_column)
+        data = self.data.groupby(columns, dropna=False, observed=True)[MEASURES].sum().reset_index()
+        return KpiCube(data, columns)
+
+    def _query(self, groupby_column, rows_column, measures):
+        cells = self.data[self.data[rows_column] > 0]
+        return cells.groupby(groupby_column, observed=True)[measures].sum().reset_index()
+
+    def user_acquisition_costs(self, groupby_column, mean=True):
+        """
+        User acquisition cost per group, as KpiAnalytics.user_acquisition_costs returns it.
+
+        :param groupby_column: Column(s) to group by.
+        :type groupby_column: str or list
+        :param mean: Whether to average the daily cost or to sum it. Default is True.
+        :type mean: bool
+        :return: A DataFrame with the group columns and 'user_acquisition_cost_usd'.
+        :rtype: pandas.DataFrame
+        """
+        df = self._query(groupby_column, 'uac_rows', ['uac_sum', 'uac_rows'])
+        df['user_acquisition_cost_usd'] = df['uac_sum'] / df['uac_rows'] if mean else df['uac_sum']
+        return df[self._columns(groupby_column) + ['user_acquisition_cost_usd']]
+
+    def per_install(self, source, groupby_column, mean=True):
+        """
+        Revenue or payouts per group, as KpiAnalytics.revenue_generated_per_install and
+        total_payouts_made_per_install return them.
+
+        :param source: Either 'revenue' or 'payouts'.
+        :type source: str
+        :param groupby_column: Column(s) to group by.
+        :type groupby_column: str or list
+        :param mean: Whether to average the values per install and day or to sum them. Default is True.
+        :type mean: bool
+        :return: A DataFrame with the group columns and '<source>_per_install_usd'.
+        :rtype: pandas.DataFrame
+        """
+        df = self._query(groupby_column, f'{source}_rows', [f'{source}_usd', f'{source}_count'])
+        value = df[f'{source}_usd'] / df[f'{source}_count'] if mean else df[f'{source}_usd']
+        df[f'{source}_per_install_usd'] = value
+        return df[self._columns(groupby_column) + [f'{source}_per_install_usd']]
+
+    def user_retention_rate(self, groupby_column, days_active=False):
+        """
+        Retention rate or mean days active per group, as KpiAnalytics.user_retention_rate returns them. Install
+        columns ('install_date', 'install_year and month') are accepted as group columns.
+
+        :param groupby_column: Column(s) to group by.
+        :type groupby_column: str or list
+        :param days_active: Whether to return the mean days active instead of the retention rate. Default is False.
+        :type days_active: bool
+        :return: A DataFrame with the group columns and the retention columns.
+        :rtype: pandas.DataFrame
+        """
+        columns = self._columns(groupby_column)
+        cube_columns = [RETENTION_COLUMNS.get(col, col) for col in columns]
+        df = self._query(cube_columns, 'cohort_rows',
+                         ['total_users', 'retained_users', 'days_active_sum', 'cohort_rows'])
+        df = df.rename(columns=dict(zip(cube_columns, columns)))
+        if days_active:
+            df['days_active'] = df['days_active_sum'] / df['cohort_rows']
+            return df[columns + ['days_active']]
+
+        df['total_users'] = df['total_users'].astype('int64')
+        # Like the left merge in KpiAnalytics, retained_users stays float only if a group has no retained users
+        if (df['retained_users'] > 0).all():
+            df['retained_users'] = df['retained_users'].astype('int64')
+        df['retension_rate'] = df['retained_users'] / df['total_users'] * 100
+        return df[columns + ['total_users', 'retained_users', 'retension_rate']]
+
+    def grouped_profit(self, groupby_column, mean=True):
+        """
+        Profit per group, as KpiAnalytics.grouped_profit returns it.
+
+        :param groupby_column: Column(s) to group by.
+        :type groupby_column: str or list
+        :param mean: Whether to average the daily profit or to sum it. Default is True.
+        :type mean: bool
+        :return: A DataFrame with the group columns and 'profit_usd'.
+        :rtype: pandas.DataFrame
+        """
+        df = self._query(groupby_column, 'profit_rows', ['profit_usd', 'profit_rows'])
+        if mean:
+            df['profit_usd'] = df['profit_usd'] / df['profit_rows']
+        return df[self._columns(groupby_column) + ['profit_usd']]
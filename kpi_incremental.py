@@ -0,0 +1,413 @@
+import numpy as np
+import pandas as pd
+from data_wrangling import DataCleaning
+from kpi_cube import CUBE_KEYS, DATE_PARTS, MEASURES, KpiCube
+
+SOURCES = ('revenue', 'payouts')
+# Measures every install contributes to the cube cell of its network, country and install date
+INSTALL_MEASURES = ['installs', 'revenue_usd', 'revenue_count', 'revenue_rows', 'payouts_usd', 'payouts_count',
+                    'payouts_rows', 'total_users', 'retained_users', 'days_active_sum', 'cohort_rows']
+
+
+def _nanoseconds(values):
+    return np.asarray(values, dtype='datetime64[ns]').view(np.int64)
+
+
+class _KeyedTable:
+    """
+    The rows of a table with a unique key, in arrays with spare capacity at the end: adding rows costs time in the
+    rows added (the capacity doubles when it runs out) and rows are updated in place by position. Keys are looked up
+    in the pandas index of the initial rows, whose hash table is built once, and in a dict of the keys added since.
+    """
+
+    def __init__(self, keys, df):
+        self.keys = keys
+        self.added = {}
+        self.size = len(df)
+        self.dtypes = df.dtypes.to_dict()
+        self.arrays = {}
+        for col in df.columns:
+            values = df[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.cat.codes
+            self.arrays[col] = values.to_numpy(copy=True)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, col):
+        # A view, so that writing to it updates the table
+        return self.arrays[col][:self.size]
+
+    def positions(self, keys):
+        """
+        :param keys: The keys to look up.
+        :type keys: pandas.Index
+        :return: The position of every key, -1 for keys that are not in the table.
+        :rtype: numpy.ndarray
+        """
+        positions = self.keys.get_indexer(keys)
+        if self.added:
+            missing = np.flatnonzero(positions < 0)
+            positions[missing] = [self.added.get(key, -1) for key in keys[missing]]
+        return positions
+
+    def add(self, keys, df):
+        """
+        Adds rows with new keys at the end.
+
+        :param keys: The keys of the rows.
+        :type keys: pandas.Index
+        :param df: The rows, with every column of the table.
+        :type df: pandas.DataFrame
+        :return: The positions of the rows.
+        :rtype: numpy.ndarray
+        """
+        end = self.size + len(keys)
+        capacity = len(next(iter(self.arrays.values())))
+        if end > capacity:
+            capacity = max(end, 2 * capacity)
+            for col, array in self.arrays.items():
+                grown = np.empty(capacity, dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                self.arrays[col] = grown
+        for col, dtype in self.dtypes.items():
+            values = df[col]
+            if isinstance(dtype, pd.CategoricalDtype):
+                values = pd.Categorical(values, dtype=dtype).codes
+            self.arrays[col][self.size:end] = np.asarray(values)
+        positions = np.arange(self.size, end)
+        self.added.update(zip(keys, positions.tolist()))
+        self.size = end
+        return positions
+
+    def frame(self):
+        """
+        :return: A copy of the rows.
+        :rtype: pandas.DataFrame
+        """
+        data = {}
+        for col, dtype in self.dtypes.items():
+            values = self[col].copy()
+            data[col] = pd.Categorical.from_codes(values, dtype=dtype) if isinstance(
+                dtype, pd.CategoricalDtype) else values
+        return pd.DataFrame(data)
+
+
+class _MonthlyActivity:
+    """
+    The last event date of one source per install and month, which is what user_retention_rate joins on. The months
+    of the installs the state was built with are arrays sorted by install position, the months that arrive later are
+    kept in a dict per position, and those of installs that were not ingested yet in a dict per install id until the
+    install arrives. Dates and months are nanoseconds.
+    """
+
+    def __init__(self, positions, install_ids, months, dates):
+        known = positions >= 0
+        order = np.argsort(positions[known], kind='stable')
+        self.positions = positions[known][order]
+        self.months = months[known][order]
+        self.dates = dates[known][order]
+        self.updates = {}
+        self.orphans = {}
+        self.add(positions[~known], install_ids[~known], months[~known], dates[~known])
+
+    def add(self, positions, install_ids, months, dates):
+        """
+        Records the last date per install and month of new events; positions are -1 for installs not ingested yet.
+        """
+        for position, install_id, month, date in zip(positions.tolist(), install_ids, months.tolist(),
+                                                     dates.tolist()):
+            last = self.updates.setdefault(position, {}) if position >= 0 else self.orphans.setdefault(install_id, {})
+            last[month] = max(last.get(month, date), date)
+
+    def adopt(self, install_ids, positions):
+        """
+        Moves the months of new installs that had events before they arrived to their positions.
+        """
+        for install_id, position in zip(install_ids, positions.tolist()):
+            last = self.orphans.pop(install_id, None)
+            if last is not None:
+                self.updates[position] = last
+
+    def last_dates(self, positions):
+        """
+        :param positions: Install positions.
+        :type positions: numpy.ndarray
+        :return: The 'position' and last 'event_date' of every month the installs were active in.
+        :rtype: pandas.DataFrame
+        """
+        low = np.searchsorted(self.positions, positions, 'left')
+        counts = np.searchsorted(self.positions, positions, 'right') - low
+        rows = np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        position, month, date = [self.positions[rows]], [self.months[rows]], [self.dates[rows]]
+        for p in positions.tolist():
+            for m, d in self.updates.get(p, {}).items():
+                position.append([p])
+                month.append([m])
+                date.append([d])
+        df = pd.DataFrame({'position': np.concatenate(position).astype(np.int64),
+                           'month': np.concatenate(month).astype(np.int64),
+                           'event_date': np.concatenate(date).astype(np.int64)})
+        df = df.groupby(['position', 'month'], as_index=False)['event_date'].max()
+        return pd.DataFrame({'position': df['position'],
+                             'event_date': df['event_date'].to_numpy().view('datetime64[ns]')})
+
+
+class IncrementalKpiState:
+    """
+    The running state behind KpiAnalytics.append: the day-grain cube cells plus the per-install facts they are
+    derived from, so that a new day of rows only touches the installs and cells it affects.
+
+    Per install it keeps the cell, the revenue and payouts on the install day and the retention contribution (rows,
+    days active, retained). Per install and month it keeps the last payout and revenue date, which is what
+    user_retention_rate joins on, so late events for old installs update the retention of their install date.
+    Events of installs that were not ingested yet are parked until the install arrives. No event history is kept.
+
+    The installs, cells and ad spend are _KeyedTables and the months _MonthlyActivity, which grow at the end and are
+    updated in place, so a refresh costs a groupby over the delta plus lookups and writes of the rows it touches,
+    independent of the size of the history. Building the state from the history is one pass over it.
+    """
+
+    def __init__(self, cells, adspend, installs, active_months, orphan_days):
+        self.cells = cells
+        self.adspend = adspend
+        self.installs = installs
+        self.active_months = active_months
+        # Per source, install id -> {day in nanoseconds: value}
+        self.orphan_days = orphan_days
+
+    @classmethod
+    def from_analytics(cls, analytics):
+        """
+        Builds the state from the full history held by a KpiAnalytics instance.
+
+        :param analytics: The analytics object with the history loaded.
+        :type analytics: KpiAnalytics
+        :return: The state, or None if the installs have duplicate install ids or missing network or country ids,
+            which the incremental path does not support.
+        :rtype: IncrementalKpiState
+        """
+        installs_df = analytics.installs_df
+        if not installs_df['install_id'].is_unique or installs_df[['network_id', 'country_id']].isna().any().any():
+            return None
+
+        data = analytics.cube().data
+        cells = _KeyedTable(pd.MultiIndex.from_frame(data[CUBE_KEYS]), data)
+        adspend = analytics.adspend_df.groupby(CUBE_KEYS)['value_usd'].sum()
+        adspend = _KeyedTable(adspend.index, adspend.to_frame())
+
+        install_ids = pd.Index(installs_df['install_id'])
+        n_installs = len(install_ids)
+        table = pd.DataFrame({'network_id': installs_df['network_id'].to_numpy(),
+                              'country_id': installs_df['country_id'].to_numpy(),
+                              'install_date': installs_df['event_date'].to_numpy()})
+        active_months, orphan_days = {}, {}
+        for source in SOURCES:
+            events = analytics._install_events(source)
+            on_install_day = events.loc[events['network_id'].notna()]
+            day = np.full(n_installs, np.nan)
+            day[install_ids.get_indexer(on_install_day['install_id'])] = on_install_day[f'{source}_per_install_usd']
+            table[f'{source}_day'] = day
+
+            months = analytics._monthly_last_activity(source)
+            active_months[source] = _MonthlyActivity(
+                install_ids.get_indexer(months['install_id']), months['install_id'].to_numpy(),
+                _nanoseconds(months['year and month']), _nanoseconds(months['event_date']))
+
+            events_df = analytics.revenue_df if source == 'revenue' else analytics.payouts_df
+            orphans = events_df[install_ids.get_indexer(events_df['install_id']) < 0]
+            orphan_days[source] = {}
+            cls._park(orphan_days[source], orphans.groupby(['install_id', 'event_date'])['value_usd'].sum())
+
+        activity = analytics._retention_activity()
+        positions = install_ids.get_indexer(activity['install_id'])
+        days_active = activity['days_active'].to_numpy(dtype=np.float64)
+        table['rows'] = np.bincount(positions, minlength=n_installs).astype(np.int64)
+        table['days_active_sum'] = np.bincount(positions, days_active, minlength=n_installs)
+        table['retained'] = np.bincount(positions, days_active == 0, minlength=n_installs) > 0
+        return cls(cells, adspend, _KeyedTable(install_ids, table), active_months, orphan_days)
+
+    @staticmethod
+    def _park(orphans, day_sums):
+        # Events of installs that were not ingested yet, summed per install and day
+        for (install_id, day), value in zip(day_sums.index, day_sums.to_numpy()):
+            days = orphans.setdefault(install_id, {})
+            day = pd.Timestamp(day).value
+            days[day] = days.get(day, 0) + value
+
+    def can_append(self, installs_df):
+        """
+        Tells whether a batch of installs can be applied incrementally: its install ids must be new and unique and
+        its network and country ids present.
+
+        :param installs_df: The new installs.
+        :type installs_df: pandas.DataFrame
+        :return: True if the batch can be applied.
+        :rtype: bool
+        """
+        if installs_df is None or not len(installs_df):
+            return True
+        install_ids = installs_df['install_id']
+        return bool(install_ids.is_unique and (self.installs.positions(pd.Index(install_ids)) < 0).all() and
+                    installs_df[['network_id', 'country_id']].notna().all().all())
+
+    def append(self, adspend_df=None, installs_df=None, payouts_df=None, revenue_df=None):
+        """
+        Applies one batch (typically a day) of new rows. The frames must be cleaned like the history, including the
+        date breakdown. Revenue and payouts may belong to installs of any date.
+
+        :param adspend_df: New ad spend rows.
+        :type adspend_df: pandas.DataFrame
+        :param installs_df: New installs.
+        :type installs_df: pandas.DataFrame
+        :param payouts_df: New payout events.
+        :type payouts_df: pandas.DataFrame
+        :param revenue_df: New revenue events.
+        :type revenue_df: pandas.DataFrame
+        :return: None
+        :rtype: None
+        """
+        events = {source: df for source, df in [('revenue', revenue_df), ('payouts', payouts_df)]
+                  if df is not None and len(df)}
+        touched = [self.installs.positions(pd.Index(df['install_id'].unique())) for df in events.values()]
+        touched = np.unique(np.concatenate(touched)) if touched else np.empty(0, dtype=np.int64)
+        touched = touched[touched >= 0]
+        before = self._contributions(touched)
+
+        new_installs = self._add_installs(installs_df)
+        for source, df in events.items():
+            self._add_events(source, df)
+
+        affected = np.concatenate([touched, new_installs]).astype(np.int64)
+        self._update_retention(affected)
+        delta = self._contributions(affected)
+        delta[:len(touched)] -= before
+        delta = pd.DataFrame(delta, columns=INSTALL_MEASURES)
+        delta['network_id'] = self.installs['network_id'][affected]
+        delta['country_id'] = self.installs['country_id'][affected]
+        delta['event_date'] = self.installs['install_date'][affected]
+        delta = delta.groupby(CUBE_KEYS)[INSTALL_MEASURES].sum()
+
+        adspend_cells = pd.MultiIndex.from_arrays([[]] * 3, names=CUBE_KEYS)
+        if adspend_df is not None and len(adspend_df):
+            adspend_delta = adspend_df.groupby(CUBE_KEYS)['value_usd'].sum()
+            positions = self.adspend.positions(adspend_delta.index)
+            known = positions >= 0
+            self.adspend['value_usd'][positions[known]] += adspend_delta.to_numpy()[known]
+            self.adspend.add(adspend_delta.index[~known], adspend_delta[~known].to_frame())
+            adspend_cells = adspend_delta.index
+
+        self._update_cells(delta, adspend_cells)
+
+    def _add_installs(self, installs_df):
+        if installs_df is None or not len(installs_df):
+            return np.empty(0, dtype=np.int64)
+        install_ids = pd.Index(installs_df['install_id'])
+        new = pd.DataFrame({'network_id': installs_df['network_id'].to_numpy(),
+                            'country_id': installs_df['country_id'].to_numpy(),
+                            'install_date': installs_df['event_date'].to_numpy(),
+                            'revenue_day': np.nan, 'payouts_day': np.nan, 'rows': 0, 'days_active_sum': 0.0,
+                            'retained': False})
+        positions = self.installs.add(install_ids, new)
+        install_days = _nanoseconds(new['install_date']).tolist()
+        for source in SOURCES:
+            # Events that arrived before their install
+            self.active_months[source].adopt(install_ids, positions)
+            column = self.installs[f'{source}_day']
+            for install_id, position, install_day in zip(install_ids, positions.tolist(), install_days):
+                days = self.orphan_days[source].pop(install_id, None)
+                if days is not None and install_day in days:
+                    column[position] = days[install_day]
+        return positions
+
+    def _add_events(self, source, events_df):
+        months = events_df.groupby(['install_id', 'year and month'])['event_date'].max()
+        install_ids = months.index.get_level_values(0)
+        self.active_months[source].add(self.installs.positions(install_ids), install_ids,
+                                       _nanoseconds(months.index.get_level_values(1)), _nanoseconds(months))
+
+        day_sums = events_df.groupby(['install_id', 'event_date'])['value_usd'].sum()
+        positions = self.installs.positions(day_sums.index.get_level_values(0))
+        known = positions >= 0
+        self._park(self.orphan_days[source], day_sums[~known])
+
+        positions, day_sums = positions[known], day_sums[known]
+        on_install_day = _nanoseconds(day_sums.index.get_level_values(1)) == _nanoseconds(
+            self.installs['install_date'][positions])
+        positions = positions[on_install_day]
+        column = self.installs[f'{source}_day']
+        column[positions] = np.nan_to_num(column[positions]) + day_sums.to_numpy()[on_install_day]
+
+    def _update_retention(self, positions):
+        """
+        Recomputes the rows, days active and retained flag of the installs at the given positions, the same way
+        KpiAnalytics.user_retention_rate derives them.
+        """
+        if not len(positions):
+            return
+        df = pd.DataFrame({'position': positions, 'install_date': self.installs['install_date'][positions]})
+        for source in ['payouts', 'revenue']:
+            df = pd.merge(df, self.active_months[source].last_dates(positions), on='position', how='left')
+        df['last_active'] = df[['event_date_x', 'event_date_y']].max(axis=1)
+        df['days_active'] = (df['last_active'] - df['install_date']).dt.days
+        df['days_active'] = df['days_active'].fillna(0)
+
+        activity = df.groupby('position')['days_active']
+        rows = activity.size()
+        self.installs['rows'][rows.index] = rows.to_numpy()
+        self.installs['days_active_sum'][rows.index] = activity.sum().to_numpy()
+        self.installs['retained'][rows.index] = (df['days_active'] == 0).groupby(df['position']).any().to_numpy()
+
+    def _contributions(self, positions):
+        contributions = {'installs': np.ones(len(positions))}
+        for source in SOURCES:
+            day = self.installs[f'{source}_day'][positions]
+            contributions[f'{source}_usd'] = np.nan_to_num(day)
+            contributions[f'{source}_count'] = ~np.isnan(day)
+            contributions[f'{source}_rows'] = np.ones(len(positions))
+        contributions['total_users'] = np.ones(len(positions))
+        contributions['retained_users'] = self.installs['retained'][positions]
+        contributions['days_active_sum'] = self.installs['days_active_sum'][positions]
+        contributions['cohort_rows'] = self.installs['rows'][positions]
+        return np.column_stack([contributions[measure].astype(np.float64) for measure in INSTALL_MEASURES])
+
+    def _update_cells(self, delta, adspend_cells):
+        positions = self.cells.positions(delta.index)
+        new = positions < 0
+        if new.any():
+            added = pd.DataFrame(0, index=delta.index[new], columns=MEASURES).reset_index()
+            added = DataCleaning.break_down_date(added, [col for col in DATE_PARTS if col in self.cells.dtypes])
+            positions[new] = self.cells.add(delta.index[new], added)
+        for measure in INSTALL_MEASURES:
+            column = self.cells[measure]
+            column[positions] += delta[measure].to_numpy().astype(column.dtype)
+
+        # Acquisition cost and profit depend on the whole cell, so they are recomputed for every touched cell
+        adspend_positions = self.cells.positions(adspend_cells)
+        cells = np.unique(np.concatenate([positions, adspend_positions[adspend_positions >= 0]]))
+        keys = pd.MultiIndex.from_arrays([self.cells[col][cells] for col in CUBE_KEYS], names=CUBE_KEYS)
+        spend = self.adspend.positions(keys)
+        adspend = np.where(spend >= 0, self.adspend['value_usd'][spend], 0)
+        installs = self.cells['installs'][cells]
+        has_installs = installs > 0
+        uac = np.where(has_installs, adspend / np.where(has_installs, installs, 1), 0)
+        has_profit = has_installs & (self.cells['cohort_rows'][cells] > 0)
+        self.cells['adspend_usd'][cells] = np.where(has_installs, adspend, 0)
+        self.cells['uac_sum'][cells] = uac
+        self.cells['uac_rows'][cells] = has_installs
+        self.cells['profit_usd'][cells] = np.where(
+            has_profit, self.cells['revenue_usd'][cells] - self.cells['payouts_usd'][cells] - uac, 0)
+        self.cells['profit_rows'][cells] = has_profit
+
+    def cube(self):
+        """
+        Returns the current day-grain cube.
+
+        :return: The cube built from the running cells, sorted like KpiCube.from_frames sorts them.
+        :rtype: KpiCube
+        """
+        data = self.cells.frame()
+        if self.cells.added:
+            data = data.sort_values(CUBE_KEYS, ignore_index=True)
+        return KpiCube(data, CUBE_KEYS + DATE_PARTS)
@@ -0,0 +1,380 @@
+import numpy as np
+import pandas as pd
+from data_wrangling import DataCleaning
+from kpi_cube import DATE_PARTS, RETENTION_COLUMNS
+
+# The frame each KPI groups: its filters apply to the rows of that frame
+KPI_BASES = {
+    'user_acquisition_costs': 'acquisition',
+    'revenue_generated_per_install': 'revenue',
+    'total_payouts_made_per_install': 'payouts',
+    'user_retention_rate': 'retention',
+    'total_profit': 'profit',
+    'grouped_profit': 'profit',
+}
+CELL_COLUMNS = ['network_id', 'country_id', 'event_date'] + DATE_PARTS
+FILTER_COLUMNS = {
+    'acquisition': CELL_COLUMNS,
+    'revenue': ['install_id'] + CELL_COLUMNS,
+    'payouts': ['install_id'] + CELL_COLUMNS,
+    'retention': ['install_id', 'network_id', 'country_id', 'install_date', 'install_year and month', 'year', 'month',
+                  'day_of_week'],
+    'profit': CELL_COLUMNS,
+}
+# The source columns each KPI reads, besides the install columns it groups by
+SOURCE_COLUMNS = {
+    'acquisition': {'adspend': ['network_id', 'country_id', 'event_date', 'value_usd'],
+                    'installs': ['install_id', 'network_id', 'country_id', 'event_date']},
+    'revenue': {'installs': ['install_id', 'event_date'], 'revenue': ['install_id', 'event_date', 'value_usd']},
+    'payouts': {'installs': ['install_id', 'event_date'], 'payouts': ['install_id', 'event_date', 'value_usd']},
+    'retention': {'installs': ['install_id', 'event_date', 'year and month'],
+                  'payouts': ['install_id', 'event_date', 'year and month'],
+                  'revenue': ['install_id', 'event_date', 'year and month']},
+    'profit': {'adspend': ['network_id', 'country_id', 'event_date', 'value_usd'],
+               'installs': ['install_id', 'network_id', 'country_id', 'event_date', 'year and month'],
+               'payouts': ['install_id', 'event_date', 'year and month', 'value_usd'],
+               'revenue': ['install_id', 'event_date', 'year and month', 'value_usd']},
+}
+FRAMES = ['adspend', 'installs', 'payouts', 'revenue']
+# Event columns that equal the install columns of the same join row
+EVENT_KEYS = ['install_id', 'event_date']
+# How revenue and payouts follow the filtered installs: 'day' for the KPIs that group the events per install and day,
+# 'install' for those that reach the events through the installs, None where the events are not read
+EVENT_MODES = {'acquisition': None, 'revenue': 'day', 'payouts': 'day', 'retention': 'install', 'profit': 'install'}
+
+
+def _columns(groupby_column):
+    return groupby_column if isinstance(groupby_column, list) else [groupby_column]
+
+
+def _describe(predicates):
+    parts = []
+    for column, (kind, value) in predicates:
+        if kind == 'range':
+            parts.append(f'{column} between {value[0]} and {value[1]}')
+        else:
+            parts.append(f'{column} in {list(value)}')
+    return ', '.join(parts) or 'all rows'
+
+
+class KpiQuery:
+    """
+    A lazy KPI query: filters and KPIs are collected first and compiled into one plan when the results are requested.
+
+    Filters keep the rows of the frame a KPI groups (the daily acquisition cells, the revenue or payouts per install
+    and day, the installs with their monthly activity, or the profit cells), so a filtered KPI equals the unfiltered
+    KPI computed over those rows only. The plan gets there without computing the history: every filter is pushed down
+    to the four source frames before any groupby or merge, revenue and payouts follow the filtered installs through a
+    semi-join where the KPI reaches them through the installs, the source frames are pruned to the columns the KPIs
+    read, and the filtered frames and intermediate aggregates are shared between all KPIs of the query.
+
+    A filter value is a list or set of values, a scalar, or a slice for an inclusive range, e.g.
+    `analytics.query().where(event_date=slice('2022-03-01', '2022-03-07'), network_id=[10]).grouped_profit(
+    ['network_id', 'year and month']).collect()`. KPIs added after where use its filters; where can be called again
+    to query further KPIs with other filters in the same plan.
+    """
+
+    def __init__(self, analytics, filters=None, outputs=()):
+        self.analytics = analytics
+        self.filters = filters or {}
+        self.outputs = outputs
+
+    def where(self, filters=None, **kwargs):
+        """
+        Adds filters for the KPIs added next. Columns with spaces ('year and month') can be passed in a dict.
+
+        :param filters: Filters by column name.
+        :type filters: dict
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return KpiQuery(self.analytics, {**self.filters, **(filters or {}), **kwargs}, self.outputs)
+
+    def _add(self, method, **kwargs):
+        base = KPI_BASES[method]
+        # Retention rows can also be filtered by the names of the install columns they come from
+        allowed = FILTER_COLUMNS[base] + (list(RETENTION_COLUMNS.values()) if base == 'retention' else [])
+        unknown = set(self.filters) - set(allowed)
+        if unknown:
+            raise ValueError(f'{method} cannot be filtered on {sorted(unknown)}; the columns of its rows are '
+                             f'{FILTER_COLUMNS[base]}')
+        return KpiQuery(self.analytics, self.filters, self.outputs + ((method, kwargs, dict(self.filters)),))
+
+    def user_acquisition_costs(self, groupby_column='network_id', mean=True):
+        """
+        Adds KpiAnalytics.user_acquisition_costs with the current filters; the arguments are those of that method.
+
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return self._add('user_acquisition_costs', groupby_column=groupby_column, mean=mean)
+
+    def revenue_generated_per_install(self, groupby_column='install_id', mean=True):
+        """
+        Adds KpiAnalytics.revenue_generated_per_install with the current filters; the arguments are those of that method.
+
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return self._add('revenue_generated_per_install', groupby_column=groupby_column, mean=mean)
+
+    def total_payouts_made_per_install(self, groupby_column='install_id', mean=True):
+        """
+        Adds KpiAnalytics.total_payouts_made_per_install with the current filters; the arguments are those of that method.
+
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return self._add('total_payouts_made_per_install', groupby_column=groupby_column, mean=mean)
+
+    def user_retention_rate(self, groupby_column='network_id', days_active=False):
+        """
+        Adds KpiAnalytics.user_retention_rate with the current filters; the arguments are those of that method.
+
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return self._add('user_retention_rate', groupby_column=groupby_column, days_active=days_active)
+
+    def total_profit(self):
+        """
+        Adds KpiAnalytics.total_profit with the current filters; the arguments are those of that method.
+
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return self._add('total_profit')
+
+    def grouped_profit(self, groupby_column, mean=True):
+        """
+        Adds KpiAnalytics.grouped_profit with the current filters; the arguments are those of that method.
+
+        :return: The extended query.
+        :rtype: KpiQuery
+        """
+        return self._add('grouped_profit', groupby_column=groupby_column, mean=mean)
+
+    def plan(self):
+        """
+        Compiles the query.
+
+        :return: The plan.
+        :rtype: QueryPlan
+        """
+        return QueryPlan(self.analytics, self.outputs)
+
+    def explain(self):
+        """
+        :return: A description of the compiled plan, one line per node.
+        :rtype: str
+        """
+        return self.plan().explain()
+
+    def collect(self):
+        """
+        Compiles and runs the query.
+
+        :return: The result of the KPI, or a list with one result per KPI if the query has several.
+        :rtype: pandas.DataFrame or list
+        """
+        return self.plan().execute()
+
+
+class QueryPlan:
+    """
+    The nodes of a compiled KpiQuery. Nodes are keyed by what they compute, so equal subplans (the same source frame
+    with the same filters, the same analytics over the same frames) are one node that runs once.
+    """
+
+    def __init__(self, analytics, outputs):
+        self.analytics = analytics
+        self.nodes = {}
+        self.results = {}
+        groups = {}
+        for position, (method, kwargs, filters) in enumerate(outputs):
+            base = KPI_BASES[method]
+            key = (self._predicates(filters, base), EVENT_MODES[base])
+            groups.setdefault(key, []).append((position, method, kwargs, base))
+        for (predicates, mode), kpis in list(groups.items()):
+            # Acquisition costs do not read events, so they join a group with the same filters that does
+            if mode is None and (predicates, 'install') in groups:
+                groups[(predicates, 'install')].extend(groups.pop((predicates, mode)))
+
+        self.outputs = [None] * len(outputs)
+        for (predicates, mode), kpis in groups.items():
+            analytics = self._analytics_node(predicates, mode, [kpi[1:] for kpi in kpis])
+            for position, method, kwargs, _ in kpis:
+                arguments = ', '.join(f'{key}={value!r}' for key, value in kwargs.items())
+                self.outputs[position] = self._node(('kpi', method, repr(kwargs), analytics), f'{method}({arguments})',
+                                                    [analytics], lambda a, m=method, kw=kwargs: getattr(a, m)(**kw))
+
+    def _predicates(self, filters, base):
+        encoder = self.analytics.id_encoder
+        predicates = []
+        for column, value in filters.items():
+            source = RETENTION_COLUMNS.get(column, column) if base == 'retention' else column
+            encoded = encoder is not None and source in encoder.labels
+            if isinstance(value, slice):
+                if encoded:
+                    raise ValueError(f'{column} holds id codes, which cannot be filtered by range')
+                predicates.append((source, ('range', (value.start, value.stop))))
+                continue
+            values = list(value) if isinstance(value, (list, tuple, set, frozenset, pd.Index, np.ndarray)) else [value]
+            if encoded:
+                codes = encoder.labels[source].get_indexer(pd.Index(values))
+                values = codes[codes >= 0].tolist()
+            predicates.append((source, ('in', tuple(sorted(values, key=repr)))))
+        return tuple(sorted(predicates, key=repr))
+
+    def _node(self, key, description, inputs, compute):
+        if key not in self.nodes:
+            self.nodes[key] = (description, inputs, compute)
+        return key
+
+    def _scan(self, name):
+        return self._node(('scan', name), f'scan {name}', [], lambda: getattr(self.analytics, f'{name}_df'))
+
+    def _filter(self, name, predicates):
+        if not predicates:
+            return self._scan(name)
+        description = f'filter {name}: {_describe(predicates)}'
+        window = dict(predicates).get('event_date')
+        if window is not None and window[0] == 'range' and self.analytics._date_index(name) is not None:
+            description += ' (date window by binary search)'
+        return self._node(('filter', name, predicates), description, [self._scan(name)],
+                          lambda df: self._filtered(name, df, predicates))
+
+    def _filtered(self, name, df, predicates):
+        index = self.analytics._date_index(name)
+        window = dict(predicates).get('event_date')
+        if index is not None and window is not None and window[0] == 'range':
+            # The rows of a date window of a sorted frame are one slice
+            df = index.window(df, *window[1])
+            predicates = tuple(predicate for predicate in predicates if predicate[0] != 'event_date')
+        return df[self._mask(df, predicates)] if predicates else df
+
+    @staticmethod
+    def _mask(df, predicates):
+        mask = np.ones(len(df), dtype=bool)
+        for column, (kind, value) in predicates:
+            if column in df.columns:
+                values = df[column]
+            else:
+                # A date column the frame was loaded without
+                values = DataCleaning.break_down_date(df[['event_date']].copy(), [column])[column]
+            if kind == 'range':
+                low, high = value
+                if pd.api.types.is_datetime64_any_dtype(values.dtype):
+                    low, high = [None if bound is None else pd.Timestamp(bound) for bound in (low, high)]
+                if low is not None:
+                    mask &= (values >= low).to_numpy()
+                if high is not None:
+                    mask &= (values <= high).to_numpy()
+            else:
+                mask &= values.isin(value).to_numpy()
+        return mask
+
+    def _events(self, name, predicates, mode, installs):
+        if not predicates:
+            return self._scan(name)
+        if mode == 'day' and {column for column, _ in predicates} <= set(EVENT_KEYS):
+            # Events off the install day still belong to the rows of their own day
+            return self._filter(name, predicates)
+        on = EVENT_KEYS if mode == 'day' else ['install_id']
+        return self._node(('semijoin', name, predicates, tuple(on)),
+                          f'semi-join {name} with the filtered installs on {on}', [self._scan(name), installs],
+                          lambda df, keys: df[self._semi_join_mask(df, keys, on)])
+
+    @staticmethod
+    def _semi_join_mask(df, keys, on):
+        if len(on) == 1:
+            return df[on[0]].isin(keys[on[0]]).to_numpy()
+        return pd.MultiIndex.from_frame(df[on]).isin(pd.MultiIndex.from_frame(keys[on]))
+
+    def _analytics_node(self, predicates, mode, kpis):
+        columns = {name: set() for name in FRAMES}
+        for method, kwargs, base in kpis:
+            for name, needed in SOURCE_COLUMNS[base].items():
+                columns[name].update(needed)
+            if base in ('revenue', 'payouts', 'retention') and 'groupby_column' in kwargs:
+                group = [RETENTION_COLUMNS.get(col, col) if base == 'retention' else col
+                         for col in _columns(kwargs['groupby_column'])]
+                columns['installs'].update(group)
+
+        installs = self._filter('installs', predicates)
+        inputs = {'installs': installs}
+        if columns['adspend']:
+            inputs['adspend'] = self._filter('adspend', predicates)
+        for name in ['payouts', 'revenue']:
+            if columns[name]:
+                inputs[name] = self._events(name, predicates, mode, installs)
+
+        names = list(inputs)
+        description = 'KpiAnalytics over ' + ', '.join(
+            f'{name}[{", ".join(sorted(columns[name]))}]' for name in names)
+        return self._node(('analytics', predicates, mode, tuple((n, tuple(sorted(columns[n]))) for n in FRAMES)),
+                          description, [inputs[name] for name in names],
+                          lambda *frames: self._sub_analytics(dict(zip(names, frames)), columns))
+
+    def _sub_analytics(self, frames, columns):
+        # The filtered frames are small, so the KPIs group them directly instead of building a cube
+        from KPIs import KpiAnalytics
+        pruned = {}
+        for name in FRAMES:
+            df = frames.get(name, getattr(self.analytics, f'{name}_df').iloc[:0])
+            # An owned copy, as the analytics derive date columns on their frames in place
+            pruned[f'{name}_df'] = df[[col for col in df.columns if col in columns[name]]].copy()
+        return KpiAnalytics(**pruned, cache=self.analytics.cache, id_encoder=self.analytics.id_encoder,
+                            use_cube=False)
+
+    def _run(self, key):
+        if key not in self.results:
+            description, inputs, compute = self.nodes[key]
+            if key[0] == 'scan':
+                self.results[key] = compute()
+            else:
+                # Cached with the analytics, so later queries with the same filters reuse the filtered frames and the
+                # aggregates of the analytics over them until the source frames change
+                self.results[key] = self.analytics._cached(
+                    'query', lambda: compute(*[self._run(node) for node in inputs]), key)
+        return self.results[key]
+
+    def execute(self):
+        """
+        Runs every node once. The results are copies, like those of KpiAnalytics, so that callers can modify them
+        without corrupting the cached node results.
+
+        :return: The result of the KPI, or a list with one result per KPI if the plan has several.
+        :rtype: pandas.DataFrame or list
+        """
+        results = [self._run(key) for key in self.outputs]
+        results = [result.copy() if isinstance(result, pd.DataFrame) else result for result in results]
+        return results[0] if len(results) == 1 else results
+
+    def explain(self):
+        """
+        :return: One line per node, inputs first, with the nodes it reads and the row count once it ran.
+        :rtype: str
+        """
+        ids, lines = {}, []
+
+        def visit(key):
+            if key in ids:
+                return ids[key]
+            description, inputs, _ = self.nodes[key]
+            input_ids = [visit(node) for node in inputs]
+            ids[key] = len(ids) + 1
+            line = f'[{ids[key]}] {description}'
+            if input_ids:
+                line += ' <- ' + ', '.join(f'[{i}]' for i in input_ids)
+            users = sum(key in node_inputs for _, node_inputs, _ in self.nodes.values())
+            if users > 1:
+                line += f' (shared by {users})'
+            if key in self.results and isinstance(self.results[key], pd.DataFrame):
+                line += f' ({len(self.results[key]):,} rows)'
+            lines.append(line)
+            return ids[key]
+
+        for key in self.outputs:
+            visit(key)
+        return '\n'.join(lines)
@@ -0,0 +1,366 @@
+import argparse
+import collections
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from aggregate_cache import AggregateCache
+from data_wrangling import load_sources
+from frame_cache import FrameCache
+from KPIs import KpiAnalytics
+
+# The KPIs served, with the group-by column of a request that names none
+ENDPOINTS = {
+    'grouped_profit': 'network_id',
+    'user_acquisition_costs': 'network_id',
+    'revenue_generated_per_install': 'network_id',
+    'total_payouts_made_per_install': 'network_id',
+    'user_retention_rate': 'network_id',
+}
+# Query parameters that are options of the KPI; every other parameter filters a column, see KpiService.frame
+OPTIONS = {'groupby', 'start', 'end', 'mean', 'days_active'}
+DEFAULT_RESULT_BYTES = 64 * 1024 ** 2
+# The number of most recent requests per endpoint the latency percentiles are taken over
+LATENCY_WINDOW = 1024
+DEFAULT_PORT = 8050
+
+
+def _parse_value(text):
+    # Ids are integers, so filter values that look like numbers are compared as numbers
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _parse_bool(text):
+    if text.lower() in ('1', 'true', 'yes'):
+        return True
+    if text.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f'{text!r} is not a boolean')
+
+
+class LatencyMetrics:
+    """
+    Request counts and latencies per endpoint. Percentiles are taken over the last LATENCY_WINDOW requests of an
+    endpoint, counts and the mean over all of them.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, cached=False, error=False):
+        """
+        Records one request.
+
+        :param endpoint: The endpoint that answered it.
+        :type endpoint: str
+        :param seconds: The time from receiving the request to having the response.
+        :type seconds: float
+        :param cached: Whether the response came from the result cache. Default is False.
+        :type cached: bool
+        :param error: Whether the request failed. Default is False.
+        :type error: bool
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'requests': 0, 'errors': 0, 'cache_hits': 0, 'total_seconds': 0.0,
+                'latencies': collections.deque(maxlen=self.window)})
+            stats['requests'] += 1
+            stats['errors'] += error
+            stats['cache_hits'] += cached
+            stats['total_seconds'] += seconds
+            stats['latencies'].append(seconds)
+
+    def summary(self):
+        """
+        :return: By endpoint, 'requests', 'errors', 'cache_hits' and the 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms' and
+            'max_ms' latency in milliseconds.
+        :rtype: dict
+        """
+        with self._lock:
+            endpoints = {endpoint: (dict(stats), np.array(stats['latencies']))
+                         for endpoint, stats in self._endpoints.items()}
+        summary = {}
+        for endpoint, (stats, latencies) in endpoints.items():
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            summary[endpoint] = {'requests': stats['requests'], 'errors': stats['errors'],
+                                 'cache_hits': stats['cache_hits'],
+                                 'mean_ms': stats['total_seconds'] / stats['requests'] * 1000,
+                                 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': latencies.max() * 1000}
+        return summary
+
+
+class KpiService:
+    """
+    Answers KPI requests of a long-lived process from data loaded once, e.g. for dashboards, over HTTP or a Unix
+    socket (see serve).
+
+    Requests without filters are answered from the network x country x day cube of the analytics, requests with a
+    date range or other filters by a KpiQuery, which pushes the filters down to the source frames. Both share the
+    intermediate aggregates memoized by the analytics, and the JSON of every answer is kept in an LRU result cache,
+    so a repeated request costs a dictionary lookup. Requests are handled on one thread each: cached answers are
+    served concurrently, while the analytics, which are not thread-safe, compute one answer at a time.
+
+    A request is an endpoint (a KPI of ENDPOINTS) with query parameters, e.g.
+    `/grouped_profit?groupby=network_id,year and month&start=2022-03-01&end=2022-03-31&country_id=1,2&mean=false`:
+    'groupby' takes comma-separated columns, 'start' and 'end' bound event_date inclusively, 'mean' and
+    'days_active' are the options of the KPI, and every other parameter keeps the rows whose column has one of its
+    comma-separated values. The answer is a JSON list of rows. '/metrics' returns the LatencyMetrics summary and
+    the result cache statistics.
+    """
+
+    def __init__(self, analytics, result_bytes=DEFAULT_RESULT_BYTES):
+        self.analytics = analytics
+        self.results = AggregateCache(result_bytes)
+        self.metrics = LatencyMetrics()
+        self._lock = threading.Lock()
+        # Bumped by every append, so that answers computed from the rows before it are not kept
+        self._generation = 0
+
+    @classmethod
+    def from_directory(cls, directory, cache_directory=None, result_bytes=DEFAULT_RESULT_BYTES, **analytics_options):
+        """
+        Loads and cleans the sources of a directory, see load_sources, and computes the aggregates.
+
+        :param directory: A directory with adspend.csv, installs.csv, payouts.csv and revenue.csv.
+        :type directory: str
+        :param cache_directory: Where the cleaned frames are kept across restarts, see FrameCache. Default is None.
+        :type cache_directory: str
+        :param result_bytes: The memory budget of the result cache. Default is DEFAULT_RESULT_BYTES.
+        :type result_bytes: int
+        :return: The warmed-up service.
+        :rtype: KpiService
+        """
+        cache = FrameCache(cache_directory) if cache_directory is not None else None
+        frames = load_sources(directory, cache=cache)
+        service = cls(KpiAnalytics(**{f'{name}_df': df for name, df in frames.items()}, **analytics_options),
+                      result_bytes)
+        service.warm()
+        return service
+
+    def warm(self):
+        """
+        Computes the cube and the profit frame, so that the first requests do not pay for them.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self.analytics.cube()
+            self.analytics.total_profit()
+
+    def append(self, **frames):
+        """
+        Adds new rows to the analytics, see KpiAnalytics.append, and drops the cached answers.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self.analytics.append(**frames)
+            self._generation += 1
+            self.results.invalidate()
+
+    def frame(self, endpoint, groupby=None, start=None, end=None, filters=None, **options):
+        """
+        Computes the answer to a request.
+
+        :param endpoint: The KPI, one of ENDPOINTS.
+        :type endpoint: str
+        :param groupby: The group-by column or columns. Default is None (the one of ENDPOINTS).
+        :type groupby: str or list
+        :param start: The first event_date. Default is None (no lower bound).
+        :type start: str
+        :param end: The last event_date. Default is None (no upper bound).
+        :type end: str
+        :param filters: Values to keep by column, see KpiQuery.where. Default is None.
+        :type filters: dict
+        :return: The KPI.
+        :rtype: pandas.DataFrame
+        """
+        if endpoint not in ENDPOINTS:
+            raise KeyError(endpoint)
+        groupby = groupby or ENDPOINTS[endpoint]
+        filters = dict(filters or {})
+        if start is not None or end is not None:
+            filters['event_date'] = slice(start, end)
+        with self._lock:
+            if not filters:
+                return getattr(self.analytics, endpoint)(groupby, **options)
+            query = self.analytics.query().where(filters)
+            return getattr(query, endpoint)(groupby, **options).collect()
+
+    def answer(self, endpoint, params):
+        """
+        Answers a request from the result cache, computing it on a miss.
+
+        :param endpoint: The KPI, one of ENDPOINTS.
+        :type endpoint: str
+        :param params: The query parameters, each with a list of values as parsed by urllib.parse.parse_qs.
+        :type params: dict
+        :return: The JSON rows, and whether they came from the result cache.
+        :rtype: tuple
+        """
+        request = self._parse(endpoint, params)
+        generation = self._generation
+        # Answers are computed outside the lock, so one that started before an append can be stored after the append
+        # invalidated the cache; keyed by generation it is never served, and it is dropped right away
+        key = ('result', generation, endpoint, repr(sorted(request.items())))
+        hits = self.results.hits
+        body = self.results.get_or_compute(key, lambda: self._encode(self.frame(endpoint, **request)))
+        if self._generation != generation:
+            self.results.discard(key)
+        # Counters of a shared cache can move on other threads, so a hit is only approximate under load
+        return body, self.results.hits > hits
+
+    @staticmethod
+    def _parse(endpoint, params):
+        if endpoint not in ENDPOINTS:
+            raise KeyError(endpoint)
+        params = {name: values[-1] for name, values in params.items()}
+        request = {}
+        if 'groupby' in params:
+            columns = [column.strip() for column in params['groupby'].split(',') if column.strip()]
+            request['groupby'] = columns[0] if len(columns) == 1 else columns
+        for bound in ('start', 'end'):
+            if bound in params:
+                request[bound] = params[bound]
+        if 'mean' in params:
+            if endpoint == 'user_retention_rate':
+                raise ValueError('user_retention_rate has no mean option')
+            request['mean'] = _parse_bool(params['mean'])
+        if 'days_active' in params:
+            if endpoint != 'user_retention_rate':
+                raise ValueError(f'{endpoint} has no days_active option')
+            request['days_active'] = _parse_bool(params['days_active'])
+        filters = {column: tuple(sorted((_parse_value(value) for value in values.split(',')), key=repr))
+                   for column, values in params.items() if column not in OPTIONS}
+        if filters:
+            request['filters'] = {column: list(values) for column, values in sorted(filters.items())}
+        return request
+
+    @staticmethod
+    def _encode(df):
+        return df.to_json(orient='records', date_format='iso').encode()
+
+    def metrics_summary(self):
+        """
+        :return: The latency metrics by endpoint and the 'result_cache' statistics.
+        :rtype: dict
+        """
+        return {'endpoints': self.metrics.summary(),
+                'result_cache': {'entries': len(self.results), 'bytes': self.results.current_bytes,
+                                 'hits': self.results.hits, 'misses': self.results.misses}}
+
+    def serve(self, host='127.0.0.1', port=DEFAULT_PORT, unix_socket=None):
+        """
+        Creates a server for the service, on a TCP port or on a Unix socket, which handles every request on its
+        own thread. Run it with serve_forever and stop it with shutdown.
+
+        :param host: The address to listen on. Default is 127.0.0.1 (local requests only).
+        :type host: str
+        :param port: The port to listen on. Default is DEFAULT_PORT; 0 picks a free one.
+        :type port: int
+        :param unix_socket: The path of a Unix socket to listen on instead of the port. Default is None.
+        :type unix_socket: str
+        :return: The server.
+        :rtype: socketserver.BaseServer
+        """
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = _ThreadingUnixHTTPServer(unix_socket, _KpiRequestHandler)
+        else:
+            server = ThreadingHTTPServer((host, port), _KpiRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        return server
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _KpiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        started = time.perf_counter()
+        url = urlsplit(self.path)
+        endpoint = url.path.strip('/')
+        service = self.server.service
+        if endpoint == 'metrics':
+            self._send(200, json.dumps(service.metrics_summary()).encode())
+            return
+
+        cached = False
+        try:
+            body, cached = service.answer(endpoint, parse_qs(url.query))
+            status = 200
+        except KeyError as e:
+            status, body = 404, json.dumps({'error': f'unknown endpoint or column {e}'}).encode()
+        except (ValueError, TypeError) as e:
+            status, body = 400, json.dumps({'error': str(e)}).encode()
+        except Exception as e:
+            # A failing KPI must not drop the connection without a response or a count in the metrics
+            print(f'Error answering {self.path}:', file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            status, body = 500, json.dumps({'error': f'{type(e).__name__}: {e}'}).encode()
+        # Recorded before the response is sent, so that a client sees its own request in the metrics
+        if endpoint in ENDPOINTS:
+            service.metrics.record(endpoint, time.perf_counter() - started, cached, status != 200)
+        self._send(status, body)
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are counted in the metrics instead of logged one by one
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the KPIs of a data directory over HTTP.')
+    parser.add_argument('directory', help='The directory with adspend.csv, installs.csv, payouts.csv and revenue.csv.')
+    parser.add_argument('--cache-dir', help='Where the cleaned frames are kept across restarts.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of the port.')
+    parser.add_argument('--result-bytes', type=int, default=DEFAULT_RESULT_BYTES,
+                        help='The memory budget of the result cache.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of KpiAnalytics.')
+    args = parser.parse_args(argv)
+
+    service = KpiService.from_directory(args.directory, args.cache_dir, args.result_bytes, workers=args.workers)
+    server = service.serve(args.host, args.port, args.socket)
+    print(f'Serving KPIs on {args.socket or f"http://{args.host}:{server.server_address[1]}"}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
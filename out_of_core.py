@@ -0,0 +1,207 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from aggregate_cache import DEFAULT_MAX_BYTES
+from parallel import install_id_array, partition_of
+
+DEFAULT_BUCKETS = 256
+# Peak memory of aggregating and joining a batch of buckets, relative to the raw bytes of its event rows
+JOIN_OVERHEAD = 6
+
+
+class EventPartitions:
+    """
+    A revenue or payouts table hash-partitioned by install_id into columnar files on local disk.
+
+    Every bucket keeps one raw binary file per column (install_id, event_date, value_usd) that chunks are appended to,
+    so the table is written in one pass and never held in memory as a whole. All events of an install land in the
+    same bucket and keep their original order, which lets the per install aggregation and join run on one batch of
+    buckets at a time with the same results as on the whole table.
+    """
+
+    def __init__(self, directory=None, n_buckets=DEFAULT_BUCKETS):
+        self.directory = tempfile.mkdtemp(prefix='kpi-events-', dir=directory)
+        self.n_buckets = n_buckets
+        self.rows = np.zeros(n_buckets, dtype=np.int64)
+        self.dtypes = None
+        self.id_dtype = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @classmethod
+    def from_chunks(cls, chunks, directory=None, n_buckets=DEFAULT_BUCKETS):
+        """
+        Partitions an event table given as cleaned chunks, e.g. StreamingDataCleaning(...).iter_chunks().
+
+        :param chunks: The chunks, or a single DataFrame.
+        :type chunks: iterable
+        :param directory: The parent directory of the bucket files. Default is the system's temporary directory.
+        :type directory: str
+        :param n_buckets: The number of buckets. Use more buckets if a single bucket exceeds the memory budget.
+            Default is 256.
+        :type n_buckets: int
+        :return: The partitioned table.
+        :rtype: EventPartitions
+        """
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        partitions = cls(directory, n_buckets)
+        for chunk in chunks:
+            partitions.append(chunk)
+        return partitions
+
+    def _path(self, bucket, column):
+        return os.path.join(self.directory, f'{bucket}.{column}.bin')
+
+    def append(self, chunk):
+        """
+        Appends a chunk of events to the buckets of their install ids.
+
+        :param chunk: Events with install_id, event_date and value_usd. The install ids must be integers.
+        :type chunk: pandas.DataFrame
+        :return: None
+        :rtype: None
+        """
+        install_ids = install_id_array(chunk['install_id'])
+        if install_ids is None:
+            raise ValueError('install_id must be an integer column without missing values')
+        columns = {'install_id': install_ids,
+                   'event_date': chunk['event_date'].to_numpy(dtype='datetime64[ns]'),
+                   'value_usd': chunk['value_usd'].to_numpy(dtype=np.float64)}
+        if self.dtypes is None:
+            self.dtypes = {column: values.dtype for column, values in columns.items()}
+            self.id_dtype = chunk['install_id'].dtype
+
+        bucket = partition_of(install_ids, self.n_buckets)
+        order = np.argsort(bucket, kind='stable')
+        bounds = np.searchsorted(bucket[order], np.arange(self.n_buckets + 1))
+        counts = np.diff(bounds)
+        self.rows += counts
+        for column, values in columns.items():
+            values = values[order].astype(self.dtypes[column], copy=False)
+            for b in np.flatnonzero(counts):
+                with open(self._path(b, column), 'ab') as f:
+                    values[bounds[b]:bounds[b + 1]].tofile(f)
+
+    def read(self, buckets):
+        """
+        Loads the events of some buckets.
+
+        :param buckets: The bucket numbers.
+        :type buckets: list
+        :return: The events, with install_id in the dtype of the first chunk.
+        :rtype: pandas.DataFrame
+        """
+        columns = {}
+        for column, dtype in (self.dtypes or {}).items():
+            parts = [np.fromfile(self._path(b, column), dtype=dtype) for b in buckets if self.rows[b]]
+            columns[column] = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+        df = pd.DataFrame(columns)
+        if self.id_dtype is not None:
+            df['install_id'] = df['install_id'].astype(self.id_dtype)
+        return df
+
+    def batches(self, memory_budget=DEFAULT_MAX_BYTES):
+        """
+        Groups consecutive buckets into batches whose aggregation and join fit in the memory budget.
+
+        :param memory_budget: The estimated peak memory of one batch in bytes.
+        :type memory_budget: int
+        :return: Lists of bucket numbers. Empty buckets are included, since their installs still join.
+        :rtype: generator
+        """
+        row_bytes = sum(dtype.itemsize for dtype in (self.dtypes or {}).values()) * JOIN_OVERHEAD
+        batch, batch_bytes = [], 0
+        for b in range(self.n_buckets):
+            nbytes = int(self.rows[b]) * row_bytes
+            if nbytes > memory_budget:
+                raise MemoryError(f'Bucket {b} needs about {nbytes} bytes, more than the memory budget of '
+                                  f'{memory_budget}; partition the events into more buckets')
+            if batch and batch_bytes + nbytes > memory_budget:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(b)
+            batch_bytes += nbytes
+        if batch:
+            yield batch
+
+
+class OutOfCoreKpiAnalytics:
+    """
+    revenue_generated_per_install and total_payouts_made_per_install of KpiAnalytics for revenue and payouts tables
+    that do not fit in memory.
+
+    The event tables are EventPartitions on disk, the installs a regular frame. Each batch of buckets is aggregated per
+    install and day, outer-joined with the installs of the same buckets and reduced to per group sums and counts; the
+    partial results are then added up. Grouped by install_id the results are identical to KpiAnalytics, for coarser
+    groups they match up to the rounding of adding the partial sums.
+    """
+
+    def __init__(self, installs_df, revenue=None, payouts=None, memory_budget=DEFAULT_MAX_BYTES):
+        self.installs_df = installs_df
+        self.events = {'revenue': revenue, 'payouts': payouts}
+        self.memory_budget = memory_budget
+        self._install_ids = install_id_array(installs_df['install_id'])
+        if self._install_ids is None:
+            raise ValueError('install_id must be an integer column without missing values')
+
+    def _install_events(self, source):
+        """
+        Yields the outer join of the per install and day events with the installs, one batch of buckets at a time.
+        """
+        events = self.events[source]
+        if events is None:
+            raise ValueError(f'No {source} events were given')
+        install_bucket = partition_of(self._install_ids, events.n_buckets)
+        for batch in events.batches(self.memory_budget):
+            events_df = events.read(batch)
+            installs_df = self.installs_df[np.isin(install_bucket, batch)]
+            agregated_events = events_df.groupby(['install_id', 'event_date'])['value_usd'].sum().reset_index()
+            events_with_installs = pd.merge(agregated_events, installs_df, on=['install_id', 'event_date'],
+                                            how='outer')
+            yield events_with_installs.rename(columns={'value_usd': f'{source}_per_install_usd'})
+
+    def _per_install(self, source, groupby_column, mean):
+        value = f'{source}_per_install_usd'
+        partials = [df.groupby(groupby_column, observed=True)[value].agg(['sum', 'count'])
+                    for df in self._install_events(source)]
+        combined = pd.concat(partials)
+        combined = combined.groupby(level=list(range(combined.index.nlevels)), observed=True).sum()
+        result = combined['sum'] / combined['count'] if mean else combined['sum']
+        return result.rename(value).reset_index()
+
+    def revenue_generated_per_install(self, groupby_column='install_id', mean=True):
+        """
+        Computes the revenue generated per install and aggregates it by the given `groupby_column`.
+
+        :param groupby_column: The column to group the data by. Defaults to 'install_id'.
+        :type groupby_column: str
+        :param mean: Whether to calculate the mean revenue generated per user or the total revenue generated per user.
+        :type mean: bool
+        :return: A dataframe with the `groupby_column` and the revenue generated per user.
+        :rtype: pandas.DataFrame
+        """
+        return self._per_install('revenue', groupby_column, mean)
+
+    def total_payouts_made_per_install(self, groupby_column='install_id', mean=True):
+        """
+        Calculates the total payouts made per install.
+
+        :param groupby_column: The column to group the payouts data by. Default is 'install_id'.
+        :type groupby_column: str
+        :param mean: If True, the payouts are averaged for each group, otherwise they are summed. Default is True.
+        :type mean: bool
+        :return: A DataFrame with the payouts per install.
+        :rtype: pandas.DataFrame
+        """
+        return self._per_install('payouts', groupby_column, mean)
@@ -0,0 +1,224 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+PARTITIONS_PER_WORKER = 4
+EVENT_SOURCES = ('revenue', 'payouts')
+EVENT_COLUMNS = ['install_id', 'event_date', 'year and month', 'value_usd']
+# Memory-mapped files in /dev/shm never touch the disk
+SHARED_MEMORY_DIR = '/dev/shm'
+# Whether this pandas version sorts the keys of an outer join (newer versions) or keeps the left keys first and
+# appends the right-only keys in order of appearance
+OUTER_JOIN_SORTS = pd.merge(pd.DataFrame({'key': [2]}), pd.DataFrame({'key': [1]}),
+                            how='outer')['key'].tolist() == [1, 2]
+
+
+def install_id_array(values):
+    """
+    Returns the install ids as a numeric array that can be written to a buffer and hashed.
+
+    :param values: The install_id column.
+    :type values: pandas.Series
+    :return: The ids, object ids as int64. None if an id is missing or object ids are not all integers.
+    :rtype: numpy.ndarray
+    """
+    if values.isna().any():
+        return None
+    if pd.api.types.is_integer_dtype(values.dtype):
+        return values.to_numpy()
+    if values.dtype == object and pd.api.types.infer_dtype(values, skipna=False) == 'integer':
+        return values.to_numpy(dtype=np.int64)
+    return None
+
+
+def _outer_join_order(df):
+    """
+    Puts the concatenated partial outer joins of the per install and day events with the installs back into the row
+    order of the serial join.
+    """
+    keys = ['install_id', 'event_date', 'install_position']
+    if OUTER_JOIN_SORTS:
+        return df.sort_values(keys, kind='mergesort', ignore_index=True)
+    # Only installs without an event on the install day have no value
+    right_only = df['value_usd'].isna()
+    matched = df[~right_only].sort_values(keys, kind='mergesort')
+    unmatched = df[right_only]
+    first_seen = unmatched.groupby(['install_id', 'event_date'])['install_position'].transform('min')
+    unmatched = unmatched.iloc[np.lexsort((unmatched['install_position'], first_seen))]
+    return pd.concat([matched, unmatched], ignore_index=True)
+
+
+def partition_of(install_ids, n_partitions):
+    """
+    Hash-partitions install ids. Equal ids always land in the same partition, whatever frame they come from.
+
+    :param install_ids: The ids as returned by install_id_array.
+    :type install_ids: numpy.ndarray
+    :param n_partitions: The number of partitions, at most 65536.
+    :type n_partitions: int
+    :return: The partition of every id.
+    :rtype: numpy.ndarray
+    """
+    # Fibonacci hashing, so that consecutive ids and id codes spread evenly over the partitions
+    hashed = install_ids.astype(np.int64).view(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return ((hashed >> np.uint64(40)) % np.uint64(n_partitions)).astype(np.uint16)
+
+
+class ColumnBuffers:
+    """
+    Columns of several frames written once to memory-mapped .npy files, with the rows grouped by partition.
+
+    A worker process maps the files and reads its partition as a contiguous slice, so the frames are neither pickled
+    per task nor copied into every worker. The files live in a temporary directory, by default in shared memory,
+    which is removed on close.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None and os.path.isdir(SHARED_MEMORY_DIR):
+            directory = SHARED_MEMORY_DIR
+        self._tmp = tempfile.TemporaryDirectory(prefix='kpi-buffers-', dir=directory)
+        self.directory = self._tmp.name
+        self.layout = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._tmp.cleanup()
+
+    def add(self, name, columns, partition, n_partitions):
+        """
+        Writes the columns of a frame, reordered so that the rows of every partition are adjacent. Rows keep their
+        relative order within a partition.
+
+        :param name: The name the frame is read back under.
+        :type name: str
+        :param columns: The column arrays by column name, all of the same length.
+        :type columns: dict
+        :param partition: The partition of every row.
+        :type partition: numpy.ndarray
+        :param n_partitions: The number of partitions.
+        :type n_partitions: int
+        :return: None
+        :rtype: None
+        """
+        order = np.argsort(partition, kind='stable')
+        bounds = np.searchsorted(partition[order], np.arange(n_partitions + 1))
+        self.layout[name] = (list(columns), bounds)
+        for i, values in enumerate(columns.values()):
+            out = np.lib.format.open_memmap(os.path.join(self.directory, f'{name}.{i}.npy'), mode='w+',
+                                            dtype=values.dtype, shape=values.shape)
+            np.take(values, order, out=out)
+            out.flush()
+            del out
+
+    @staticmethod
+    def read(directory, layout, name, partition):
+        """
+        Maps one partition of a frame written with add.
+
+        :param directory: The directory of the buffers.
+        :type directory: str
+        :param layout: The layout attribute of the buffers.
+        :type layout: dict
+        :param name: The name of the frame.
+        :type name: str
+        :param partition: The partition to read.
+        :type partition: int
+        :return: The partition's rows.
+        :rtype: pandas.DataFrame
+        """
+        columns, bounds = layout[name]
+        start, stop = bounds[partition], bounds[partition + 1]
+        return pd.DataFrame({column: np.load(os.path.join(directory, f'{name}.{i}.npy'), mmap_mode='r')[start:stop]
+                             for i, column in enumerate(columns)})
+
+
+def _join_partition(directory, layout, partition):
+    """
+    Runs the install event and retention joins of KpiAnalytics on the rows of one install_id partition. The installs
+    only carry their keys and their row position; the other install columns are attached in the parent.
+    """
+    installs = ColumnBuffers.read(directory, layout, 'installs', partition)
+    joins, months = {}, {}
+    for source in EVENT_SOURCES:
+        events = ColumnBuffers.read(directory, layout, source, partition)
+        aggregated = events.groupby(['install_id', 'event_date'])['value_usd'].sum().reset_index()
+        joins[source] = pd.merge(aggregated, installs, on=['install_id', 'event_date'], how='outer')
+        months[source] = events.groupby(['install_id', 'year and month'])['event_date'].max().reset_index()
+
+    df = installs.rename(columns={'event_date': 'install_date'})
+    df = pd.merge(df, months['payouts'], on='install_id', how='left')
+    joins['retention'] = pd.merge(df, months['revenue'], on='install_id', how='left')
+    return joins
+
+
+def partitioned_joins(installs_df, payouts_df, revenue_df, workers, directory=None):
+    """
+    Computes the joins behind KpiAnalytics' install events and retention activity on a process pool. The frames are
+    hash-partitioned by install_id, which keeps every install with all of its events, and the partial joins are
+    concatenated and put back into the row order of the serial joins, so the results are identical to them.
+
+    :param installs_df: The installs.
+    :type installs_df: pandas.DataFrame
+    :param payouts_df: The payout events.
+    :type payouts_df: pandas.DataFrame
+    :param revenue_df: The revenue events.
+    :type revenue_df: pandas.DataFrame
+    :param workers: The number of worker processes.
+    :type workers: int
+    :param directory: Where to create the column buffers. Default is shared memory if available.
+    :type directory: str
+    :return: The outer joins of the per install and day 'value_usd' with the installs under 'revenue' and
+        'payouts', and the installs left-joined with the last payout and revenue date per month under 'retention'.
+        None if the install ids are not all integers.
+    :rtype: dict
+    """
+    frames = {'installs': installs_df, 'payouts': payouts_df, 'revenue': revenue_df}
+    install_ids = {name: install_id_array(df['install_id']) for name, df in frames.items()}
+    if any(ids is None for ids in install_ids.values()):
+        return None
+
+    n_partitions = workers * PARTITIONS_PER_WORKER
+    with ColumnBuffers(directory) as buffers:
+        buffers.add('installs', {'install_id': install_ids['installs'],
+                                 'event_date': installs_df['event_date'].to_numpy(),
+                                 'install_position': np.arange(len(installs_df))},
+                    partition_of(install_ids['installs'], n_partitions), n_partitions)
+        for source in EVENT_SOURCES:
+            events_df = frames[source]
+            columns = {column: events_df[column].to_numpy() for column in EVENT_COLUMNS}
+            columns['install_id'] = install_ids[source]
+            buffers.add(source, columns, partition_of(install_ids[source], n_partitions), n_partitions)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(partial(_join_partition, buffers.directory, buffers.layout), range(n_partitions)))
+
+    # Object ids were shared as integers
+    id_dtype = installs_df['install_id'].dtype
+    installs = installs_df.reset_index(drop=True)
+
+    joins = {}
+    for source in EVENT_SOURCES:
+        df = _outer_join_order(pd.concat([part[source] for part in parts], ignore_index=True))
+        position = df['install_position'].fillna(-1).to_numpy(dtype=np.int64)
+        attached = installs.drop(columns=['install_id', 'event_date']).reindex(position).reset_index(drop=True)
+        df = pd.concat([df[['install_id', 'event_date', 'value_usd']], attached], axis=1)
+        df['install_id'] = df['install_id'].astype(id_dtype)
+        joins[source] = df
+
+    # The serial left join keeps the order of the installs
+    df = pd.concat([part['retention'] for part in parts], ignore_index=True)
+    df = df.sort_values('install_position', kind='mergesort', ignore_index=True)
+    attached = installs.rename(columns={'event_date': 'install_date', 'year and month': 'install_year and month'})
+    attached = attached.take(df['install_position'].to_numpy()).reset_index(drop=True)
+    joins['retention'] = pd.concat(
+        [attached, df[['year and month_x', 'event_date_x', 'year and month_y', 'event_date_y']]], axis=1)
+    return joins
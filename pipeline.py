@@ -0,0 +1,444 @@
+import argparse
+import ast
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Only the standard library is imported here: every stage imports what it needs when it runs, so a KPI-only run
+# never imports matplotlib or scipy, and a run whose stages are all up to date imports nothing heavy at all.
+
+SOURCES = ['adspend', 'installs', 'payouts', 'revenue']
+# The KPI tables of the notebook: file name, KpiAnalytics method and its arguments
+KPI_TABLES = {
+    'user_acquisition_costs': ('user_acquisition_costs', {'groupby_column': 'network_id'}),
+    'user_acquisition_costs_monthly': ('user_acquisition_costs', {'groupby_column': ['network_id', 'year and month']}),
+    'revenue_per_install': ('revenue_generated_per_install', {'groupby_column': 'network_id'}),
+    'revenue_per_install_monthly': ('revenue_generated_per_install',
+                                    {'groupby_column': ['network_id', 'year and month']}),
+    'payouts_per_install': ('total_payouts_made_per_install', {'groupby_column': 'network_id'}),
+    'payouts_per_install_monthly': ('total_payouts_made_per_install',
+                                    {'groupby_column': ['network_id', 'year and month']}),
+    'retention_rate': ('user_retention_rate', {'groupby_column': 'network_id'}),
+    'days_active': ('user_retention_rate', {'groupby_column': 'network_id', 'days_active': True}),
+    'retention_rate_monthly': ('user_retention_rate', {'groupby_column': ['network_id', 'install_year and month']}),
+    'total_profit': ('grouped_profit', {'groupby_column': 'network_id', 'mean': False}),
+    'total_profit_monthly': ('grouped_profit', {'groupby_column': ['network_id', 'year and month'], 'mean': False}),
+}
+# The charts of the notebook, drawn from the KPI tables and the forecast; see data_analytics.render_charts
+CHART_SPECS = {
+    'user_acquisition_costs': {'chart': 'time_series_breakdown', 'table': 'user_acquisition_costs_monthly',
+                               'x_column': 'year and month', 'y_column': 'user_acquisition_cost_usd',
+                               'breakdown_column': 'network_id', 'title': 'User acquisition cost per network'},
+    'revenue_per_install': {'chart': 'pie_chart', 'table': 'revenue_per_install', 'label_column': 'network_id',
+                            'value_column': 'revenue_per_install_usd', 'title': 'Average Revenue per network'},
+    'revenue_per_install_monthly': {'chart': 'time_series_breakdown', 'table': 'revenue_per_install_monthly',
+                                    'x_column': 'year and month', 'y_column': 'revenue_per_install_usd',
+                                    'breakdown_column': 'network_id', 'title': 'Average Revenue per network over time'},
+    'payouts_per_install': {'chart': 'bar_chart', 'table': 'payouts_per_install', 'x_column': 'network_id',
+                            'y_column': 'payouts_per_install_usd', 'title': 'Average Payout per network'},
+    'payouts_per_install_monthly': {'chart': 'time_series_breakdown', 'table': 'payouts_per_install_monthly',
+                                    'x_column': 'year and month', 'y_column': 'payouts_per_install_usd',
+                                    'breakdown_column': 'network_id', 'title': 'Average Payout per network over time'},
+    'days_active': {'chart': 'bar_chart', 'table': 'days_active', 'x_column': 'network_id', 'y_column': 'days_active',
+                    'title': 'Average days active per network'},
+    'retention_rate_monthly': {'chart': 'time_series_breakdown', 'table': 'retention_rate_monthly',
+                               'x_column': 'install_year and month', 'y_column': 'retension_rate',
+                               'breakdown_column': 'network_id', 'title': 'Average retention rate network over time'},
+    # Profit can be negative, which a pie cannot show
+    'total_profit': {'chart': 'bar_chart', 'table': 'total_profit', 'x_column': 'network_id', 'y_column': 'profit_usd',
+                     'title': 'Total Profit per network'},
+    'total_profit_monthly': {'chart': 'time_series_breakdown', 'table': 'total_profit_monthly',
+                             'x_column': 'year and month', 'y_column': 'profit_usd', 'breakdown_column': 'network_id',
+                             'title': 'Total Profit per network over time'},
+    'profit_forecast': {'chart': 'time_series_breakdown', 'table': 'profit_forecast', 'x_column': 'event_date',
+                        'y_column': 'profit_usd', 'breakdown_column': 'network_id',
+                        'title': 'Forecast profit per network'},
+}
+# Columns read back from the CSV outputs as dates
+DATE_COLUMNS = ['event_date', 'year and month', 'install_date', 'install_year and month']
+DEFAULT_OPTIONS = {'remove_outliers': None, 'drop_duplicates': False, 'horizon': 30, 'bootstrap': 0,
+                   'max_points': None}
+STATE_FILE = 'pipeline_state.json'
+
+
+def _hash(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def _module_fingerprint(name):
+    # The source of a module the stage runs, so that a code change reruns the stage; found without importing it
+    with open(importlib.util.find_spec(name).origin, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def _local_imports(name):
+    """
+    The modules of this directory that a module imports, at the top or inside functions, read from its source.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with open(importlib.util.find_spec(name).origin, 'rb') as f:
+        tree = ast.parse(f.read())
+    imported = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imported.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            imported.add(node.module.split('.')[0])
+    return {module for module in imported if os.path.exists(os.path.join(directory, f'{module}.py'))}
+
+
+def module_closure(names):
+    """
+    :param names: Modules of this directory.
+    :type names: list
+    :return: The modules and every module of this directory they import, directly or not, sorted.
+    :rtype: list
+    """
+    seen, pending = set(), list(names)
+    while pending:
+        name = pending.pop()
+        if name not in seen:
+            seen.add(name)
+            pending.extend(_local_imports(name))
+    return sorted(seen)
+
+
+def _read_csv(path):
+    import pandas as pd
+
+    df = pd.read_csv(path)
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+class Stage:
+    """
+    A step of a Pipeline. `run` gets the pipeline and the values of the `inputs` stages, in order, and returns the
+    stage's value.
+
+    A stage with `outputs` writes these files (relative to the pipeline's output directory) and is skipped while
+    they exist and its key is unchanged; the key covers the keys of its inputs, the `options` of the pipeline it
+    reads and the source of the `modules` it runs and of every module of this directory they import (see
+    module_closure), so a change to a helper such as date_index reruns the stages that use it. A skipped stage that a
+    running stage needs is loaded back from its outputs with `load`. Stages without outputs run whenever a stage that
+    needs them runs.
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), load=None, options=(), modules=()):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.load = load
+        self.options = list(options)
+        self.modules = list(modules)
+
+
+def _clean_source(name):
+    def run(pipeline):
+        from data_wrangling import REMOVE_OUTLIERS, clean_source
+
+        remove_outliers = pipeline.options['remove_outliers']
+        remove_outliers = REMOVE_OUTLIERS if remove_outliers is None else remove_outliers
+        return clean_source(pipeline.source_path(name), name in remove_outliers, pipeline.options['drop_duplicates'],
+                            cache=pipeline.frame_cache)
+
+    return Stage(name, run, options=['remove_outliers', 'drop_duplicates'], modules=['data_wrangling'])
+
+
+def _analytics(pipeline, adspend_df, installs_df, payouts_df, revenue_df):
+    from KPIs import KpiAnalytics
+
+    return KpiAnalytics(adspend_df, installs_df, payouts_df, revenue_df, workers=pipeline.workers)
+
+
+def _kpis(pipeline, analytics):
+    with pipeline.lock:
+        tables = {name: getattr(analytics, method)(**kwargs) for name, (method, kwargs) in KPI_TABLES.items()}
+    for name, df in tables.items():
+        df.to_csv(pipeline.output_path(f'kpis/{name}.csv'), index=False)
+    return tables
+
+
+def _load_kpis(pipeline):
+    return {name: _read_csv(pipeline.output_path(f'kpis/{name}.csv')) for name in KPI_TABLES}
+
+
+def _profit(pipeline, analytics):
+    with pipeline.lock:
+        df = analytics.total_profit()
+    df.to_csv(pipeline.output_path('profit.csv'), index=False)
+    return df
+
+
+def _hypotheses(pipeline, profit):
+    from hypothesis_and_forecast import ForeCast
+
+    forecast = ForeCast(profit)
+    df = forecast.regressions(bootstrap=pipeline.options['bootstrap'], workers=pipeline.workers)
+    by_network = forecast.regressions(by='network_id', bootstrap=pipeline.options['bootstrap'],
+                                      workers=pipeline.workers)
+    df.to_csv(pipeline.output_path('hypotheses.csv'), index=False)
+    by_network.to_csv(pipeline.output_path('hypotheses_by_network.csv'), index=False)
+    return df
+
+
+def _forecast(pipeline, profit):
+    from hypothesis_and_forecast import ForeCast
+
+    df = ForeCast(profit).forecast(pipeline.options['horizon'])
+    df.to_csv(pipeline.output_path('forecast.csv'), index=False)
+    return df
+
+
+def _charts(pipeline, kpis, forecast):
+    from data_analytics import render_charts
+
+    tables = dict(kpis)
+    tables['profit_forecast'] = forecast.groupby(['network_id', 'event_date'], as_index=False)['profit_usd'].sum()
+    specs = []
+    for name, spec in CHART_SPECS.items():
+        spec = dict(spec, path=pipeline.output_path(f'charts/{name}.png'))
+        spec['data'] = tables[spec.pop('table')]
+        specs.append(spec)
+    return render_charts(specs, workers=pipeline.workers, max_points=pipeline.options['max_points'])
+
+
+STAGES = [_clean_source(name) for name in SOURCES] + [
+    Stage('analytics', _analytics, inputs=SOURCES,
+          modules=['KPIs']),
+    Stage('kpis', _kpis, inputs=['analytics'], outputs=[f'kpis/{name}.csv' for name in KPI_TABLES], load=_load_kpis),
+    Stage('profit', _profit, inputs=['analytics'], outputs=['profit.csv'],
+          load=lambda pipeline: _read_csv(pipeline.output_path('profit.csv'))),
+    Stage('hypotheses', _hypotheses, inputs=['profit'], outputs=['hypotheses.csv', 'hypotheses_by_network.csv'],
+          options=['bootstrap'], modules=['hypothesis_and_forecast']),
+    Stage('forecast', _forecast, inputs=['profit'], outputs=['forecast.csv'],
+          load=lambda pipeline: _read_csv(pipeline.output_path('forecast.csv')), options=['horizon'],
+          modules=['hypothesis_and_forecast']),
+    Stage('charts', _charts, inputs=['kpis', 'forecast'], outputs=[f'charts/{name}.png' for name in CHART_SPECS],
+          options=['max_points'], modules=['data_analytics']),
+]
+
+
+class Pipeline:
+    """
+    Runs the notebook end to end without a display: the sources are read and cleaned, the KPIs computed, the
+    hypotheses tested and the profit forecast, and the results written to an output directory as CSVs and charts.
+
+    The steps are the stages of a dependency DAG (see STAGES and Stage). Stages run on a thread pool as soon as
+    their inputs are ready, so independent stages (the four sources; the KPIs and the profit; the hypotheses, the
+    forecast and the charts) overlap and a run takes about as long as its critical path. Stages whose inputs, options
+    and code are unchanged since the last run are skipped, and the cleaned sources are kept in a FrameCache, so a
+    rerun after new data only recomputes what depends on it.
+    """
+
+    def __init__(self, directory, output_directory, cache_directory=None, workers=None, stages=STAGES, **options):
+        self.directory = directory
+        self.output_directory = output_directory
+        # Where the cleaned sources are kept between runs. Default is a 'cache' directory in the output directory.
+        self.cache_directory = cache_directory or os.path.join(output_directory, 'cache')
+        self.workers = workers or os.cpu_count() or 1
+        self.stages = {stage.name: stage for stage in stages}
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown options {sorted(unknown)}')
+        self.options = {**DEFAULT_OPTIONS, **options}
+        # KpiAnalytics is not thread-safe, so the stages that share it take turns with this lock
+        self.lock = threading.Lock()
+        self._frame_cache = None
+
+    @property
+    def frame_cache(self):
+        if self._frame_cache is None:
+            from frame_cache import FrameCache
+
+            self._frame_cache = FrameCache(self.cache_directory)
+        return self._frame_cache
+
+    def source_path(self, name):
+        return os.path.join(self.directory, f'{name}.csv')
+
+    def output_path(self, name):
+        path = os.path.join(self.output_directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _closure(self, targets):
+        # The targets and everything they depend on, in the order of the stages, which is a topological order
+        needed, pending = set(), list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError(f'Unknown stage {name!r}; the stages are {list(self.stages)}')
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].inputs)
+        return [name for name in self.stages if name in needed]
+
+    def keys(self, names):
+        """
+        :param names: Stages in topological order, with all their inputs.
+        :type names: list
+        :return: The key of every stage, which changes with its inputs, options and code.
+        :rtype: dict
+        """
+        keys = {}
+        for name in names:
+            stage = self.stages[name]
+            description = {'stage': name, 'inputs': [keys[i] for i in stage.inputs],
+                           'options': {option: self.options[option] for option in stage.options},
+                           'modules': {module: _module_fingerprint(module)
+                                       for module in module_closure(stage.modules)}}
+            if name in SOURCES:
+                description['source'] = self.frame_cache.fingerprint(self.source_path(name))
+            keys[name] = _hash(description)
+        return keys
+
+    def _state(self):
+        try:
+            with open(os.path.join(self.output_directory, STATE_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state):
+        os.makedirs(self.output_directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.output_directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, os.path.join(self.output_directory, STATE_FILE))
+
+    def plan(self, targets=None, force=False):
+        """
+        Decides what every stage of a run does: 'run', 'load' its value from its outputs for a stage that runs, or
+        'skip'.
+
+        :param targets: The stages to bring up to date. Default is None (every stage with outputs).
+        :type targets: list
+        :param force: Whether to run the targets even if they are up to date. Default is False.
+        :type force: bool
+        :return: The action of every stage the targets depend on, in topological order, and the stage keys.
+        :rtype: tuple
+        """
+        targets = targets or [name for name, stage in self.stages.items() if stage.outputs]
+        names = self._closure(targets)
+        keys = self.keys(names)
+        state = self._state()
+
+        def fresh(name):
+            stage = self.stages[name]
+            return bool(stage.outputs) and not force and state.get(name) == keys[name] and all(
+                os.path.exists(os.path.join(self.output_directory, output)) for output in stage.outputs)
+
+        actions = {name: 'skip' for name in names}
+        for name in reversed(names):
+            # Every stage that needs this one is decided by now
+            if name in targets and not fresh(name):
+                actions[name] = 'run'
+            if actions[name] != 'run':
+                continue
+            for input_name in self.stages[name].inputs:
+                if actions[input_name] == 'run':
+                    continue
+                loadable = fresh(input_name) and self.stages[input_name].load is not None
+                actions[input_name] = 'load' if loadable else 'run'
+        return actions, keys
+
+    def run(self, targets=None, force=False, log=None):
+        """
+        Brings the targets up to date.
+
+        :param targets: The stages to bring up to date, e.g. ['kpis'] for the KPI tables only. Default is None
+            (every stage with outputs: the KPIs, profit, hypotheses, forecast and charts).
+        :type targets: list
+        :param force: Whether to run the targets even if they are up to date. Default is False.
+        :type force: bool
+        :param log: A stream to write a line per finished stage to, e.g. sys.stderr. Default is None.
+        :type log: file
+        :return: Per stage, its 'action' and the 'start' and 'end' in seconds since the run started, and under
+            'wall_seconds' and 'critical_path_seconds' the duration of the run and of its longest chain of stages.
+        :rtype: dict
+        """
+        actions, keys = self.plan(targets, force)
+        todo = [name for name, action in actions.items() if action != 'skip']
+        values, timings = {}, {name: {'action': action} for name, action in actions.items()}
+        state = self._state()
+        started = time.perf_counter()
+
+        def execute(name):
+            stage = self.stages[name]
+            timings[name]['start'] = time.perf_counter() - started
+            if actions[name] == 'load':
+                value = stage.load(self)
+            else:
+                value = stage.run(self, *[values[input_name] for input_name in stage.inputs])
+            timings[name]['end'] = time.perf_counter() - started
+            return value
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while todo or running:
+                # A stage is ready once its inputs are; loaded stages do not read their inputs
+                for name in [name for name in todo if actions[name] == 'load' or all(
+                        input_name in values for input_name in self.stages[name].inputs)]:
+                    running[pool.submit(execute, name)] = name
+                    todo.remove(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        values[name] = future.result()
+                    except BaseException:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    if actions[name] == 'run' and self.stages[name].outputs:
+                        state[name] = keys[name]
+                        self._write_state(state)
+                    if log is not None:
+                        timing = timings[name]
+                        print(f'{name}: {actions[name]} in {timing["end"] - timing["start"]:.2f}s', file=log)
+
+        # The longest chain of dependent stages, each counted from its own start to its end
+        finish = {}
+        for name in actions:
+            timing = timings[name]
+            duration = timing['end'] - timing['start'] if 'end' in timing else 0.0
+            finish[name] = duration + max([finish[i] for i in self.stages[name].inputs], default=0.0)
+        timings['wall_seconds'] = time.perf_counter() - started
+        timings['critical_path_seconds'] = max(finish.values(), default=0.0)
+        return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the KPI report without a notebook.')
+    parser.add_argument('directory', help='The directory with adspend.csv, installs.csv, payouts.csv and revenue.csv.')
+    parser.add_argument('--output', default='report', help='Where to write the results.')
+    parser.add_argument('--cache-dir', help='Where the cleaned sources are kept between runs.')
+    parser.add_argument('--targets', nargs='+', help='The stages to run, with what they depend on, e.g. kpis. '
+                                                     'Default is every stage with outputs.')
+    parser.add_argument('--force', action='store_true', help='Run the targets even if they are up to date.')
+    parser.add_argument('--workers', type=int, help='Stages run at the same time. Default is one per CPU.')
+    parser.add_argument('--horizon', type=int, default=DEFAULT_OPTIONS['horizon'], help='Days to forecast.')
+    parser.add_argument('--bootstrap', type=int, default=DEFAULT_OPTIONS['bootstrap'],
+                        help='Bootstrap resamples of the regression slopes.')
+    args = parser.parse_args(argv)
+
+    pipeline = Pipeline(args.directory, args.output, args.cache_dir, args.workers, horizon=args.horizon,
+                        bootstrap=args.bootstrap)
+    timings = pipeline.run(args.targets, args.force, log=sys.stderr)
+    print(f'Done in {timings["wall_seconds"]:.2f}s; critical path {timings["critical_path_seconds"]:.2f}s',
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
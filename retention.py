@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+DEFAULT_DAYS = (1, 3, 7, 14, 30)
+DEFAULT_COHORT = ['network_id', 'country_id', 'install_date']
+
+
+def _day_numbers(dates):
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+
+
+class CohortRetention:
+    """
+    Dn retention of install cohorts, computed from one sorted array of distinct (install, day offset) activity keys.
+
+    A user counts as active on day n if they have a payout or revenue event n days after their install date. The
+    events of both sources are mapped to install positions with one hash lookup, encoded as
+    `position * span + offset` and sorted once; every matrix is then a `numpy.bincount` over these keys, so the full
+    retention triangle of any cohort definition costs one pass over the distinct activity days. Cohorts are defined
+    by install columns under the names user_retention_rate uses ('install_date', 'install_year and month',
+    'network_id', 'country_id', ...). Day n of an install is only observable if it is not after `as_of`; unobservable
+    cells are left out of the denominators, which is what turns the matrix into a triangle.
+    """
+
+    def __init__(self, installs_df, payouts_df, revenue_df, as_of=None):
+        installs = installs_df.drop_duplicates('install_id').rename(
+            columns={'event_date': 'install_date', 'year and month': 'install_year and month'})
+        self.installs = installs.reset_index(drop=True)
+        self.install_days = _day_numbers(self.installs['install_date'])
+
+        install_index = pd.Index(self.installs['install_id'])
+        positions, offsets = [], []
+        for events in (payouts_df, revenue_df):
+            position = install_index.get_indexer(events['install_id'])
+            known = position >= 0
+            positions.append(position[known])
+            offsets.append(_day_numbers(events['event_date'])[known] - self.install_days[position[known]])
+        position = np.concatenate(positions)
+        offset = np.concatenate(offsets)
+
+        if as_of is None:
+            event_days = self.install_days[position] + offset
+            self.as_of = int(max(self.install_days.max(initial=0), event_days.max(initial=0)))
+        else:
+            self.as_of = int(_day_numbers(pd.Series([pd.Timestamp(as_of)]))[0])
+        keep = (offset >= 0) & (self.install_days[position] + offset <= self.as_of)
+        position, offset = position[keep], offset[keep]
+
+        # Sorted by install, then by day offset
+        self.span = int(offset.max(initial=0)) + 1
+        keys = np.unique(position.astype(np.int64) * self.span + offset)
+        self.activity_install = keys // self.span
+        self.activity_offset = keys % self.span
+
+    @property
+    def nbytes(self):
+        return int(self.installs.memory_usage(deep=True).sum() + self.install_days.nbytes +
+                   self.activity_install.nbytes + self.activity_offset.nbytes)
+
+    def _cohorts(self, cohort_columns):
+        grouped = self.installs.groupby(cohort_columns, observed=True)
+        cohort_of = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        cohorts = grouped.size().rename('cohort_size').reset_index()
+        return cohorts, cohort_of
+
+    @staticmethod
+    def _count(cohort_of, values, n_cohorts, width):
+        counted = cohort_of >= 0
+        flat = cohort_of[counted] * width + values[counted]
+        return np.bincount(flat, minlength=n_cohorts * width).reshape(n_cohorts, width)
+
+    def _observable(self, cohort_of, n_cohorts, max_day):
+        # Installs whose day n is not after as_of, per cohort and n
+        horizon = np.clip(self.as_of - self.install_days, -1, max_day) + 1
+        counts = self._count(cohort_of, horizon, n_cohorts, max_day + 2)
+        return counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+
+    def _last_active(self):
+        last = np.full(len(self.installs), -1, dtype=np.int64)
+        if len(self.activity_install):
+            ends = np.append(np.flatnonzero(np.diff(self.activity_install)), len(self.activity_install) - 1)
+            last[self.activity_install[ends]] = self.activity_offset[ends]
+        return last
+
+    def activity_matrix(self, cohort_columns=None, max_day=30):
+        """
+        Counts the active users of every cohort on every day offset from 0 to `max_day`.
+
+        :param cohort_columns: The install columns that define a cohort. Default is network, country and install date.
+        :type cohort_columns: list
+        :param max_day: The last day offset. Default is 30.
+        :type max_day: int
+        :return: The cohort columns, 'cohort_size' and one column of active users per day offset (0 ... max_day).
+        :rtype: pandas.DataFrame
+        """
+        cohorts, cohort_of = self._cohorts(cohort_columns or DEFAULT_COHORT)
+        in_range = self.activity_offset <= max_day
+        counts = self._count(cohort_of[self.activity_install[in_range]], self.activity_offset[in_range],
+                             len(cohorts), max_day + 1)
+        return pd.concat([cohorts, pd.DataFrame(counts, columns=list(range(max_day + 1)))], axis=1)
+
+    def retention(self, days=DEFAULT_DAYS, cohort_columns=None, rolling=False):
+        """
+        Calculates the Dn retention rate in percent of every cohort for the given day offsets.
+
+        :param days: The day offsets, e.g. (1, 3, 7, 14, 30) or range(31) for the full triangle.
+        :type days: iterable
+        :param cohort_columns: The install columns that define a cohort. Default is network, country and install date.
+        :type cohort_columns: list
+        :param rolling: If True, a user is retained on day n if they were active on day n or later (rolling
+            retention); otherwise they must be active on exactly day n. Default is False.
+        :type rolling: bool
+        :return: The cohort columns, 'cohort_size' and one 'D<n>' column per day offset. Cells that cannot be observed
+            yet are NaN.
+        :rtype: pandas.DataFrame
+        """
+        days = list(days)
+        max_day = max(days)
+        cohorts, cohort_of = self._cohorts(cohort_columns or DEFAULT_COHORT)
+        n_cohorts = len(cohorts)
+
+        if rolling:
+            last = self._last_active()
+            counts = self._count(cohort_of, np.minimum(last, max_day) + 1, n_cohorts, max_day + 2)
+            active = counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+        else:
+            in_range = self.activity_offset <= max_day
+            active = self._count(cohort_of[self.activity_install[in_range]], self.activity_offset[in_range],
+                                 n_cohorts, max_day + 1)
+        observable = self._observable(cohort_of, n_cohorts, max_day)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(observable > 0, active / observable * 100, np.nan)
+        rates = pd.DataFrame(rates[:, days], columns=[f'D{day}' for day in days])
+        return pd.concat([cohorts, rates], axis=1)
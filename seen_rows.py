@@ -0,0 +1,279 @@
+import abc
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+# The exact table doubles before more than this share of its slots is taken
+MAX_LOAD_FACTOR = 0.5
+DEFAULT_SLOTS = 1 << 16
+DEFAULT_ERROR_RATE = 0.001
+# The hash of a missing value in any column
+_MISSING = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(x):
+    """The splitmix64 finalizer, which spreads every bit of x over the whole 64-bit result."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _column_hashes(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        hashes = _column_hashes(pd.Series(values.cat.categories))
+        return np.where(codes >= 0, hashes[codes], _MISSING)
+    if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufmM':
+        values = values.to_numpy()
+        if values.dtype.kind == 'f':
+            # -0.0 equals 0.0 and every NaN equals every other NaN, as in DataFrame.duplicated
+            values = values.astype(np.float64) + 0.0
+            values[np.isnan(values)] = np.nan
+            bits = values.view(np.uint64)
+        elif values.dtype.kind in 'mM':
+            bits = values.view(np.int64).view(np.uint64)
+        elif values.dtype.kind == 'u':
+            bits = values.astype(np.uint64)
+        else:
+            bits = values.astype(np.int64).view(np.uint64)
+        return _mix(bits)
+    # Integers hash as in integer columns, also in object columns, e.g. ids after id_columns_to_object
+    if values.dtype == object and pd.api.types.infer_dtype(values, skipna=False) == 'integer':
+        return _mix(values.to_numpy().astype(np.int64).view(np.uint64))
+    # Other columns hash each distinct value once
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+    integers = np.fromiter((isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in uniques),
+                           dtype=bool, count=len(uniques))
+    hashes = np.empty(len(uniques), dtype=np.uint64)
+    hashes[integers] = _mix(uniques[integers].astype(np.int64).view(np.uint64))
+    hashes[~integers] = pd.util.hash_array(uniques[~integers])
+    return np.where(codes >= 0, hashes[codes], _MISSING)
+
+
+def row_fingerprints(df):
+    """
+    Hashes every row of a frame to 64 bits. Numeric, boolean and datetime columns are hashed from their values, other
+    columns once per distinct value, so the fingerprint of a row only depends on its values (and column dtypes), not
+    on the rest of the frame. Two different rows get the same fingerprint with a probability of about 2^-64.
+
+    :param df: The frame.
+    :type df: pandas.DataFrame
+    :return: The fingerprint of every row.
+    :rtype: numpy.ndarray
+    """
+    fingerprints = np.zeros(len(df), dtype=np.uint64)
+    for i in range(df.shape[1]):
+        fingerprints = _mix(fingerprints * np.uint64(31) + _column_hashes(df.iloc[:, i]))
+    return fingerprints
+
+
+class _SeenSet(abc.ABC):
+    """
+    The part of SeenRows and BloomSeenRows that does not depend on how the fingerprints are stored.
+    """
+
+    def first_occurrences(self, data, remember=True):
+        """
+        Marks the rows of `data` that were not seen before, neither in earlier batches nor earlier in `data`, and
+        remembers them. Takes time linear in the rows of `data`.
+
+        :param data: The batch to check.
+        :type data: pandas.DataFrame
+        :param remember: Whether to add the new rows to the seen rows. Default is True.
+        :type remember: bool
+        :return: A boolean mask that is True for the first occurrence of each row.
+        :rtype: numpy.ndarray
+        """
+        fingerprints = row_fingerprints(data)
+        first = ~pd.Series(fingerprints).duplicated().to_numpy()
+        first[first] = ~self.contains(fingerprints[first])
+        if remember:
+            self.add(fingerprints[first])
+        return first
+
+    @abc.abstractmethod
+    def contains(self, fingerprints):
+        """
+        :param fingerprints: Row fingerprints, see row_fingerprints.
+        :type fingerprints: numpy.ndarray
+        :return: A boolean mask that is True for the fingerprints seen before.
+        :rtype: numpy.ndarray
+        """
+
+    @abc.abstractmethod
+    def add(self, fingerprints):
+        """
+        Remembers the fingerprints.
+
+        :param fingerprints: Row fingerprints, see row_fingerprints.
+        :type fingerprints: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+
+    def flush(self):
+        """
+        Writes the seen rows to their file, if they have one.
+
+        :return: None
+        :rtype: None
+        """
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+
+
+class SeenRows(_SeenSet):
+    """
+    Remembers the fingerprints of the rows of a source that were already ingested, so that duplicates can be
+    detected across chunks, files and runs.
+
+    The fingerprints are kept in an open-addressing hash table of 64-bit slots that is at most half full, so looking
+    up and adding a batch take time linear in the batch. With a path the table is a memory-mapped .npy file that
+    persists across runs: opening the same path again continues where the last run stopped. A new table starts with
+    `slots` slots, rounded up to a power of two.
+    """
+
+    def __init__(self, path=None, slots=DEFAULT_SLOTS):
+        self.path = path
+        if path is not None and os.path.exists(path):
+            self._array = np.load(path, mmap_mode='r+')
+        else:
+            self._array = self._allocate(1 << max(int(slots) - 1, 1).bit_length(), path)
+        self.size = int(np.count_nonzero(self._array))
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _allocate(slots, path):
+        if path is None:
+            return np.zeros(slots, dtype=np.uint64)
+        # A new file reads as zeros, the empty slot
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint64, shape=(slots,))
+
+    @staticmethod
+    def _keys(fingerprints):
+        # 0 marks an empty slot, so the lowest bit of every key is set
+        return fingerprints | np.uint64(1)
+
+    def contains(self, fingerprints):
+        """
+        :param fingerprints: Row fingerprints as returned by row_fingerprints.
+        :type fingerprints: numpy.ndarray
+        :return: Whether each fingerprint was added before.
+        :rtype: numpy.ndarray
+        """
+        keys = self._keys(fingerprints)
+        mask = np.uint64(len(self._array) - 1)
+        found = np.zeros(len(keys), dtype=bool)
+        # Every round probes the next slot of the keys that found neither themselves nor an empty slot yet
+        pending, slots = np.arange(len(keys)), keys & mask
+        while len(pending):
+            stored = self._array[slots.astype(np.int64)]
+            hit = stored == keys[pending]
+            found[pending[hit]] = True
+            probing = ~hit & (stored != 0)
+            pending, slots = pending[probing], (slots[probing] + np.uint64(1)) & mask
+        return found
+
+    def add(self, fingerprints):
+        """
+        Adds fingerprints that are neither in the table yet nor repeated among themselves.
+
+        :param fingerprints: Row fingerprints as returned by row_fingerprints.
+        :type fingerprints: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        if self.size + len(fingerprints) > MAX_LOAD_FACTOR * len(self._array):
+            self._grow(self.size + len(fingerprints))
+        self._insert(self._keys(fingerprints))
+        self.size += len(fingerprints)
+
+    def _insert(self, keys):
+        mask = np.uint64(len(self._array) - 1)
+        slots = keys & mask
+        while len(keys):
+            positions = slots.astype(np.int64)
+            free = self._array[positions] == 0
+            self._array[positions[free]] = keys[free]
+            # Of several keys that found the same free slot, the last one written got it
+            placed = free & (self._array[positions] == keys)
+            keys, slots = keys[~placed], (slots[~placed] + np.uint64(1)) & mask
+
+    def _grow(self, size):
+        slots = len(self._array)
+        while size > MAX_LOAD_FACTOR * slots:
+            slots *= 2
+        old = self._array
+        keys = old[old != 0]
+        # A file-backed table is rebuilt next to the old file, which it replaces once complete
+        self._array = self._allocate(slots, None if self.path is None else self.path + '.tmp')
+        self._insert(keys)
+        del old
+        if self.path is not None:
+            self._array.flush()
+            os.replace(self.path + '.tmp', self.path)
+
+
+class BloomSeenRows(_SeenSet):
+    """
+    Remembers the rows of a source that were already ingested in a Bloom filter: a fixed bit array of about
+    -ln(error_rate) / ln(2)^2 bits per row of the capacity (14.4 bits, i.e. 1.8 bytes, at 0.1%), no matter how
+    wide the rows are, in which every row sets the bits of several hashes of its fingerprint.
+
+    Unlike SeenRows it can report a row that was never added as seen, which drops that row as a duplicate. As long
+    as at most `capacity` rows were added this happens to about `error_rate` of the new rows; the rate grows as more
+    rows are added. Rows that were added are always reported as seen. With a path the bit array is a memory-mapped
+    .npy file that persists across runs; it has to be opened with the same capacity and error rate.
+    """
+
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE, path=None):
+        self.path = path
+        self.n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        n_bytes = (self.n_bits + 7) // 8
+        if path is not None and os.path.exists(path):
+            self._array = np.load(path, mmap_mode='r+')
+            if self._array.shape != (n_bytes,) or self._array.dtype != np.uint8:
+                raise ValueError(f'{path} holds a Bloom filter of another capacity or error rate')
+        elif path is not None:
+            self._array = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(n_bytes,))
+        else:
+            self._array = np.zeros(n_bytes, dtype=np.uint8)
+
+    def _positions(self, fingerprints):
+        # Double hashing: the i-th bit of a row is (fingerprint + i * step) modulo the number of bits
+        step = (fingerprints >> np.uint64(32)) | np.uint64(1)
+        for i in range(self.n_hashes):
+            bits = (fingerprints + np.uint64(i) * step) % np.uint64(self.n_bits)
+            yield (bits >> np.uint64(3)).astype(np.int64), (bits & np.uint64(7)).astype(np.uint8)
+
+    def contains(self, fingerprints):
+        """
+        :param fingerprints: Row fingerprints as returned by row_fingerprints.
+        :type fingerprints: numpy.ndarray
+        :return: Whether each fingerprint was probably added before.
+        :rtype: numpy.ndarray
+        """
+        found = np.ones(len(fingerprints), dtype=bool)
+        for byte, bit in self._positions(fingerprints):
+            found &= (self._array[byte] >> bit) & 1 == 1
+        return found
+
+    def add(self, fingerprints):
+        """
+        Adds fingerprints to the filter.
+
+        :param fingerprints: Row fingerprints as returned by row_fingerprints.
+        :type fingerprints: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        for byte, bit in self._positions(fingerprints):
+            # One bit at a time, so that rows setting different bits of the same byte do not undo each other
+            for shift in range(8):
+                self._array[byte[bit == shift]] |= np.uint8(1 << shift)
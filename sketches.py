@@ -0,0 +1,481 @@
+import math
+
+import numpy as np
+import pandas as pd
+from seen_rows import row_fingerprints
+
+# 2^11 registers per HyperLogLog: 2 KB per cell and a standard error of 1.04 / sqrt(2^11) = 2.3%
+DEFAULT_PRECISION = 11
+# Quantiles come back within 1% of the value of the exact rank
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Magnitudes below this are counted as zero by the quantile sketches
+MIN_VALUE = 1e-9
+# The largest exponent of a float64, so that the bucket of every finite value is known up front
+_MAX_LOG = math.log(np.finfo(np.float64).max)
+CELL_KEYS = ['network_id', 'country_id', 'event_date']
+SOURCES = ('installs', 'payouts', 'revenue')
+
+
+def _bit_length(values):
+    # frexp is exact for integers below 2^53, so the 64 bits are split in halves
+    high, low = values >> np.uint64(32), values & np.uint64(0xFFFFFFFF)
+    return np.where(high > 0, 32 + np.frexp(high.astype(np.float64))[1], np.frexp(low.astype(np.float64))[1])
+
+
+def _day_numbers(dates):
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+
+
+def _group_starts(groups, n_groups):
+    counts = np.bincount(groups, minlength=n_groups)
+    return np.concatenate([[0], np.cumsum(counts)[:-1]]), counts
+
+
+class HyperLogLogs:
+    """
+    One HyperLogLog distinct-count sketch per cell, as one array of 2^precision registers per cell.
+
+    A cell's estimate has a relative standard error of 1.04 / sqrt(2^precision), e.g. 2.3% at precision 11, and
+    about 95% of the estimates are within twice that. Counts up to 2.5 * 2^precision use linear counting over the
+    empty registers, which is more accurate still, though two ids of a small cell can share a register (at
+    precision 11, about 1 in 100 cells of 5 ids is estimated as 4). Sketches merge without loss: the register-wise
+    maximum of two sketches is the sketch of the union, so a group of cells is estimated as accurately as a single
+    cell, and merging is exact however the rows were split. Memory is 2^precision bytes per cell, no matter how many
+    rows were added.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros((0, 1 << precision), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.registers)
+
+    @property
+    def nbytes(self):
+        return self.registers.nbytes
+
+    def resize(self, n_cells):
+        """
+        Adds empty cells up to `n_cells`.
+
+        :param n_cells: The number of cells.
+        :type n_cells: int
+        :return: None
+        :rtype: None
+        """
+        if n_cells > len(self.registers):
+            grown = np.zeros((n_cells, self.registers.shape[1]), dtype=np.uint8)
+            grown[:len(self.registers)] = self.registers
+            self.registers = grown
+
+    def add(self, cells, hashes):
+        """
+        Adds 64-bit hashes, e.g. of ids, to cells.
+
+        :param cells: The cell of every hash.
+        :type cells: numpy.ndarray
+        :param hashes: Uniformly distributed 64-bit hashes, e.g. from seen_rows.row_fingerprints.
+        :type hashes: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        self.resize(int(cells.max(initial=-1)) + 1)
+        if not len(hashes):
+            return
+        p = self.precision
+        register = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        # The rank is the position of the first set bit of the remaining bits
+        rank = np.minimum(65 - _bit_length(hashes << np.uint64(p)), 65 - p)
+        # Of every register hit, the largest rank is the last of its keys in sorted order
+        keys = np.unique((cells.astype(np.int64) * (1 << p) + register) * 64 + rank)
+        flat, rank = keys // 64, (keys % 64).astype(np.uint8)
+        last = np.append(flat[1:] != flat[:-1], True)
+        registers = self.registers.reshape(-1)
+        registers[flat[last]] = np.maximum(registers[flat[last]], rank[last])
+
+    def merge(self, other, cells):
+        """
+        Merges the sketches of another instance into this one.
+
+        :param other: The sketches to merge, with the same precision.
+        :type other: HyperLogLogs
+        :param cells: The cell of this instance every cell of `other` merges into.
+        :type cells: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        if other.precision != self.precision:
+            raise ValueError('HyperLogLogs of different precisions cannot be merged')
+        self.resize(int(cells.max(initial=-1)) + 1)
+        self.registers[cells] = np.maximum(self.registers[cells], other.registers[:len(cells)])
+
+    def estimate(self, groups=None, n_groups=None):
+        """
+        Estimates the number of distinct hashes of every cell or group of cells.
+
+        :param groups: The group of every cell; cells with a negative group are left out. Default is None (one
+            group per cell).
+        :type groups: numpy.ndarray
+        :param n_groups: The number of groups. Default is None (one more than the largest group).
+        :type n_groups: int
+        :return: The estimates.
+        :rtype: numpy.ndarray
+        """
+        registers = self.registers
+        if groups is not None:
+            n_groups = int(groups.max(initial=-1)) + 1 if n_groups is None else n_groups
+            order = np.argsort(groups, kind='stable')
+            order = order[groups[order] >= 0]
+            starts, counts = _group_starts(groups[order], n_groups)
+            # The union of the cells of a group is their register-wise maximum
+            registers = np.zeros((n_groups, registers.shape[1]), dtype=np.uint8)
+            if len(order):
+                present = counts > 0
+                registers[present] = np.maximum.reduceat(self.registers[order], starts[present], axis=0)
+        m = registers.shape[1]
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=1)
+        zeros = (registers == 0).sum(axis=1)
+        # Small counts use linear counting over the empty registers
+        with np.errstate(divide='ignore'):
+            linear = m * np.log(m / zeros)
+        return np.where((estimate <= 2.5 * m) & (zeros > 0), linear, estimate)
+
+
+class QuantileSketches:
+    """
+    One quantile sketch per cell that buckets values on a logarithmic scale, as DDSketch does: the buckets of a
+    value of magnitude x span [gamma^(k-1), gamma^k) with gamma = (1 + relative_accuracy) / (1 - relative_accuracy).
+
+    The quantile q of a cell or group of cells comes back within relative_accuracy of the exact value of rank
+    floor(q * (n - 1)) (the 'lower' quantile), for values of magnitude at least MIN_VALUE; smaller magnitudes are
+    counted as zero. The error does not grow with the number of values or with merging, which is exact. Only the
+    buckets that were hit are stored, at most about ln(max / min) / ln(gamma) per cell for values between min and
+    max in magnitude (about 1,200 for 0.01 to 10^9 at 1%), no matter how many values were added.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, min_value=MIN_VALUE):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self._min_k = math.ceil(math.log(min_value) / self._log_gamma)
+        # A value's slot is its signed bucket, 0 for zero, shifted to be non-negative; cell c owns slots
+        # c * n_slots to (c + 1) * n_slots - 1
+        self._width = math.ceil(_MAX_LOG / self._log_gamma) - self._min_k + 1
+        self.n_slots = 2 * self._width + 1
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.counts.nbytes
+
+    def _slots(self, values):
+        magnitude = np.abs(values)
+        with np.errstate(divide='ignore'):
+            k = np.ceil(np.log(np.maximum(magnitude, self.min_value)) / self._log_gamma).astype(np.int64)
+        position = np.where(magnitude < self.min_value, 0, np.sign(values).astype(np.int64) * (k - self._min_k + 1))
+        return position + self._width
+
+    def _values(self, slots):
+        # The middle of the bucket, which is within relative_accuracy of every value in it
+        position = slots - self._width
+        k = np.abs(position) - 1 + self._min_k
+        return np.where(position == 0, 0.0, np.sign(position) * 2 * self.gamma ** k / (self.gamma + 1))
+
+    def _add_counts(self, keys, counts):
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.keys = keys
+        self.counts = np.bincount(inverse, np.concatenate([self.counts, counts]).astype(np.float64)).astype(np.int64)
+
+    def add(self, cells, values):
+        """
+        Adds values to cells; missing values are left out.
+
+        :param cells: The cell of every value.
+        :type cells: numpy.ndarray
+        :param values: The values.
+        :type values: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        present = ~np.isnan(values)
+        keys = cells[present].astype(np.int64) * self.n_slots + self._slots(values[present])
+        keys, counts = np.unique(keys, return_counts=True)
+        self._add_counts(keys, counts)
+
+    def merge(self, other, cells):
+        """
+        Merges the sketches of another instance into this one.
+
+        :param other: The sketches to merge, with the same relative accuracy and minimum value.
+        :type other: QuantileSketches
+        :param cells: The cell of this instance every cell of `other` merges into.
+        :type cells: numpy.ndarray
+        :return: None
+        :rtype: None
+        """
+        if (other.relative_accuracy, other.min_value) != (self.relative_accuracy, self.min_value):
+            raise ValueError('QuantileSketches of different accuracies cannot be merged')
+        self._add_counts(cells[other.keys // other.n_slots] * self.n_slots + other.keys % other.n_slots, other.counts)
+
+    def _grouped(self, groups, n_groups):
+        # The counts per group and slot, sorted by group and then by value
+        cells = self.keys // self.n_slots
+        group = np.zeros(len(cells), dtype=np.int64) if groups is None else groups[cells]
+        present = group >= 0
+        keys, inverse = np.unique(group[present] * self.n_slots + self.keys[present] % self.n_slots,
+                                  return_inverse=True)
+        counts = np.bincount(inverse, self.counts[present].astype(np.float64)).astype(np.int64)
+        return keys // self.n_slots, keys % self.n_slots, counts
+
+    def quantiles(self, q, groups=None, n_groups=1):
+        """
+        Estimates quantiles of every group of cells.
+
+        :param q: The quantiles, between 0 and 1.
+        :type q: list
+        :param groups: The group of every cell; cells with a negative group are left out. Default is None (all cells
+            in one group).
+        :type groups: numpy.ndarray
+        :param n_groups: The number of groups. Default is 1.
+        :type n_groups: int
+        :return: One row per group and one column per quantile; NaN for groups without values.
+        :rtype: numpy.ndarray
+        """
+        group, slots, counts = self._grouped(groups, n_groups)
+        starts, n_keys = _group_starts(group, n_groups)
+        cumulative = np.cumsum(counts)
+        before = np.concatenate([[0], cumulative])[starts]
+        totals = np.bincount(group, counts.astype(np.float64), minlength=n_groups)
+        result = np.full((n_groups, len(q)), np.nan)
+        present = n_keys > 0
+        for i, quantile in enumerate(q):
+            rank = np.floor(quantile * (totals[present] - 1))
+            # The first slot of the group whose cumulative count passes the rank
+            position = np.searchsorted(cumulative, before[present] + rank, side='right')
+            result[present, i] = self._values(slots[position])
+        return result
+
+    def totals(self, groups=None, n_groups=1):
+        """
+        :return: The number of values of every group of cells, see quantiles.
+        :rtype: numpy.ndarray
+        """
+        group, _, counts = self._grouped(groups, n_groups)
+        return np.bincount(group, counts.astype(np.float64), minlength=n_groups).astype(np.int64)
+
+    def count_outside(self, lower, upper):
+        """
+        Estimates how many values of all cells are below `lower` or above `upper`; values within relative_accuracy
+        of a bound may be counted on the wrong side.
+
+        :return: The count.
+        :rtype: int
+        """
+        values = self._values(self.keys % self.n_slots)
+        return int(self.counts[(values < lower) | (values > upper)].sum())
+
+
+class KpiSketches:
+    """
+    Approximate KPIs for real-time dashboards from mergeable sketches kept per network, country and day, updated in
+    one streaming pass over the events instead of holding them in memory.
+
+    Every cell has a HyperLogLog of its install ids (distinct installs, or distinct active installs for payouts and
+    revenue, see HyperLogLogs for the error) and, for payouts and revenue, a quantile sketch of value_usd (see
+    QuantileSketches), plus exact row counts and sums. Queries roll the cells up to any of their columns and 'year
+    and month'. Memory grows with the number of cells, i.e. with networks, countries and days, never with the
+    number of events, and ids are hashed to 64 bits instead of kept. Payouts and revenue are kept per day only,
+    unless their frames carry network_id and country_id; attributing them through their installs would need every
+    install id in memory.
+
+    Two instances merge, e.g. the sketches of several partitions or processes, see merge.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.precision = precision
+        self.relative_accuracy = relative_accuracy
+        # Per source: the cell keys, with days as day numbers, the sketches and the exact rows and sums per cell
+        self.cells = {}
+        self.distinct = {}
+        self.values = {}
+        self.rows = {}
+        self.sums = {}
+
+    @property
+    def nbytes(self):
+        return int(sum(self.distinct[source].nbytes + self.rows[source].nbytes + self.sums[source].nbytes +
+                       (self.values[source].nbytes if source in self.values else 0) for source in self.cells))
+
+    def _start(self, source, columns):
+        keys = [key for key in CELL_KEYS if key in columns]
+        self.cells[source] = pd.MultiIndex.from_arrays([[]] * len(keys), names=keys)
+        self.distinct[source] = HyperLogLogs(self.precision)
+        if source != 'installs':
+            self.values[source] = QuantileSketches(self.relative_accuracy)
+        self.rows[source] = np.zeros(0, dtype=np.int64)
+        self.sums[source] = np.zeros(0)
+
+    def _cell_codes(self, source, cells):
+        """
+        The cell of every row of `cells`, a frame of cell keys, adding the cells that are new; rows with missing keys
+        get -1.
+        """
+        grouped = cells.groupby(list(cells.columns), sort=False)
+        # Rows with a missing key are in no group
+        rows = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        batch_cells = grouped.size().index
+        if not isinstance(batch_cells, pd.MultiIndex):
+            batch_cells = pd.MultiIndex.from_arrays([batch_cells], names=cells.columns)
+        codes = self.cells[source].get_indexer(batch_cells)
+        new = codes < 0
+        if new.any():
+            codes[new] = len(self.cells[source]) + np.arange(new.sum())
+            self.cells[source] = self.cells[source].append(batch_cells[new])
+            n_cells = len(self.cells[source])
+            self.rows[source] = np.concatenate([self.rows[source], np.zeros(new.sum(), dtype=np.int64)])
+            self.sums[source] = np.concatenate([self.sums[source], np.zeros(new.sum())])
+            self.distinct[source].resize(n_cells)
+        if not len(codes):
+            # Every row has a missing key
+            return np.full(len(rows), -1, dtype=np.int64)
+        return np.where(rows >= 0, codes[np.maximum(rows, 0)], -1)
+
+    def _key_frame(self, source, df):
+        columns = {key: df[key] for key in self.cells[source].names}
+        columns['event_date'] = _day_numbers(df['event_date'])
+        return pd.DataFrame(columns, index=df.index)
+
+    def update(self, installs_df=None, payouts_df=None, revenue_df=None):
+        """
+        Adds a batch of events, e.g. the chunks of StreamingDataCleaning.iter_chunks, to the sketches. Rows with
+        missing cell keys or install ids are left out.
+
+        :param installs_df: New installs.
+        :type installs_df: pandas.DataFrame
+        :param payouts_df: New payouts.
+        :type payouts_df: pandas.DataFrame
+        :param revenue_df: New revenue events.
+        :type revenue_df: pandas.DataFrame
+        :return: self
+        :rtype: KpiSketches
+        """
+        for source, df in zip(SOURCES, (installs_df, payouts_df, revenue_df)):
+            if df is None or not len(df):
+                continue
+            if source not in self.cells:
+                self._start(source, df.columns)
+            cells = self._cell_codes(source, self._key_frame(source, df))
+            has_id = (cells >= 0) & df['install_id'].notna().to_numpy()
+            self.distinct[source].add(cells[has_id], row_fingerprints(df.loc[has_id, ['install_id']]))
+            self.rows[source] += np.bincount(cells[cells >= 0], minlength=len(self.rows[source]))
+            if source in self.values:
+                values = df['value_usd'].to_numpy(dtype=np.float64)
+                present = (cells >= 0) & ~np.isnan(values)
+                self.sums[source] += np.bincount(cells[present], values[present], minlength=len(self.sums[source]))
+                self.values[source].add(cells[cells >= 0], values[cells >= 0])
+        return self
+
+    def merge(self, other):
+        """
+        Adds the sketches of another instance with the same precision and accuracy, e.g. of another partition of the
+        events; the result is the same as if this instance had seen the other's events too.
+
+        :param other: The sketches to merge.
+        :type other: KpiSketches
+        :return: self
+        :rtype: KpiSketches
+        """
+        for source, other_cells in other.cells.items():
+            if source not in self.cells:
+                self._start(source, other_cells.names)
+            if list(other_cells.names) != list(self.cells[source].names):
+                raise ValueError(f'The {source} sketches are kept per different columns')
+            cells = self._cell_codes(source, other_cells.to_frame(index=False))
+            self.rows[source][cells] += other.rows[source]
+            self.sums[source][cells] += other.sums[source]
+            self.distinct[source].merge(other.distinct[source], cells)
+            if source in self.values:
+                self.values[source].merge(other.values[source], cells)
+        return self
+
+    def _groups(self, source, groupby_column):
+        """
+        The group of every cell of a source, and the group keys.
+        """
+        if source not in self.cells:
+            raise ValueError(f'No {source} were added')
+        cells = self.cells[source].to_frame(index=False)
+        cells['event_date'] = pd.to_datetime(cells['event_date'], unit='D')
+        cells['year and month'] = cells['event_date'].dt.to_period('M').dt.to_timestamp()
+        if groupby_column is None:
+            return np.zeros(len(cells), dtype=np.int64), pd.DataFrame(index=[0])
+        groupby_column = [groupby_column] if isinstance(groupby_column, str) else list(groupby_column)
+        grouped = cells.groupby(groupby_column, sort=True)
+        return grouped.ngroup().to_numpy(), grouped.size().index.to_frame(index=False)
+
+    def distinct_installs(self, groupby_column='network_id', source='installs'):
+        """
+        Estimates the number of distinct install ids per group, as user_retention_rate's 'total_users', see
+        HyperLogLogs for the error. With source 'payouts' or 'revenue' it counts the installs active in each group.
+
+        :param groupby_column: The column or columns to group by: network_id, country_id, event_date or 'year and
+            month'. Default is 'network_id'.
+        :type groupby_column: str or list
+        :param source: 'installs', 'payouts' or 'revenue'. Default is 'installs'.
+        :type source: str
+        :return: The group columns and 'installs', the estimate rounded to a whole number.
+        :rtype: pandas.DataFrame
+        """
+        groups, result = self._groups(source, groupby_column)
+        result['installs'] = np.round(self.distinct[source].estimate(groups, len(result))).astype(np.int64)
+        return result
+
+    def value_quantiles(self, source, q=(0.25, 0.5, 0.75), groupby_column=None):
+        """
+        Estimates the distribution of the payout or revenue values per group, see QuantileSketches for the error.
+
+        :param source: 'payouts' or 'revenue'.
+        :type source: str
+        :param q: The quantiles. Default is the quartiles.
+        :type q: tuple
+        :param groupby_column: The column or columns to group by, see distinct_installs. Default is None (all cells).
+        :type groupby_column: str or list
+        :return: The group columns, the exact 'rows' and 'mean' of the values and one 'q<quantile>' column per
+            quantile, e.g. 'q0.5'.
+        :rtype: pandas.DataFrame
+        """
+        groups, result = self._groups(source, groupby_column)
+        rows = np.bincount(groups, self.rows[source], minlength=len(result))
+        sums = np.bincount(groups, self.sums[source], minlength=len(result))
+        counts = self.values[source].totals(groups, len(result))
+        result['rows'] = rows.astype(np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result['mean'] = sums / counts
+        quantiles = self.values[source].quantiles(q, groups, len(result))
+        for i, quantile in enumerate(q):
+            result[f'q{quantile:g}'] = quantiles[:, i]
+        return result
+
+    def outlier_bounds(self, source, groupby_column=None):
+        """
+        Estimates the IQR outlier bounds of the payout or revenue values per group, as DataCleaning.iqr_bounds does
+        for the exact values.
+
+        :param source: 'payouts' or 'revenue'.
+        :type source: str
+        :param groupby_column: The column or columns to group by, see distinct_installs. Default is None (all cells).
+        :type groupby_column: str or list
+        :return: The group columns, 'lower_bound' and 'upper_bound'.
+        :rtype: pandas.DataFrame
+        """
+        groups, result = self._groups(source, groupby_column)
+        quartiles = self.values[source].quantiles((0.25, 0.75), groups, len(result))
+        iqr = quartiles[:, 1] - quartiles[:, 0]
+        result['lower_bound'] = quartiles[:, 0] - 1.5 * iqr
+        result['upper_bound'] = quartiles[:, 1] + 1.5 * iqr
+        return result
@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_START_DATE = '2022-01-01'
+DEFAULT_DAYS = 120
+DEFAULT_CHUNK_INSTALLS = 1_000_000
+# Average events per install; the activity of single users is heavy-tailed around these means
+PAYOUTS_PER_INSTALL = 2.0
+REVENUE_PER_INSTALL = 3.0
+# Odd multiplier, so that the install ids are a bijection of the install numbers that does not look sequential
+ID_MULTIPLIER = 0x9E3779B1
+ID_MODULUS = 2 ** 40
+
+
+def installs_for_rows(rows):
+    """
+    Returns the number of installs that gives about `rows` rows over the installs, payouts and revenue tables.
+
+    :param rows: The total number of rows wanted.
+    :type rows: int
+    :return: The number of installs.
+    :rtype: int
+    """
+    return max(1, int(rows / (1 + PAYOUTS_PER_INSTALL + REVENUE_PER_INSTALL)))
+
+
+class SyntheticData:
+    """
+    A seeded generator of adspend, installs, payouts and revenue tables with the schema of the original CSVs.
+
+    The skew mimics a real user acquisition setup: a few networks and countries get most of the installs (Zipf
+    weights), most users never pay while a few whales produce most of the revenue (gamma distributed activity and
+    Pareto distributed amounts), activity decays over the days after the install, and the tables contain the missing
+    values, duplicate rows and outliers the cleaning steps are there for. Installs are generated in chunks with one
+    random stream per chunk, so the output only depends on the seed and any scale can be written to CSV without
+    holding it in memory.
+    """
+
+    def __init__(self, n_installs, seed=0, n_networks=12, n_countries=40, start_date=DEFAULT_START_DATE,
+                 days=DEFAULT_DAYS, chunk_installs=DEFAULT_CHUNK_INSTALLS):
+        self.n_installs = n_installs
+        self.seed = seed
+        self.n_networks = n_networks
+        self.n_countries = n_countries
+        self.dates = pd.date_range(start_date, periods=days)
+        self.chunk_installs = chunk_installs
+        self.network_ids = np.arange(1, n_networks + 1)
+        self.country_ids = np.arange(1, n_countries + 1)
+        self.network_weights = self._zipf_weights(n_networks, 1.2)
+        self.country_weights = self._zipf_weights(n_countries, 1.0)
+
+    @classmethod
+    def for_rows(cls, rows, seed=0, **kwargs):
+        """
+        Creates a generator for about `rows` rows over the installs, payouts and revenue tables.
+
+        :param rows: The total number of rows, e.g. 10_000 to 100_000_000.
+        :type rows: int
+        :param seed: The random seed. Default is 0.
+        :type seed: int
+        :return: The generator.
+        :rtype: SyntheticData
+        """
+        return cls(installs_for_rows(rows), seed=seed, **kwargs)
+
+    @staticmethod
+    def _zipf_weights(n, exponent):
+        weights = 1 / np.arange(1, n + 1) ** exponent
+        return weights / weights.sum()
+
+    def _ids(self, n, start):
+        # Large, non-sequential but unique ids
+        return (np.arange(start, start + n, dtype=np.int64) * ID_MULTIPLIER) % ID_MODULUS
+
+    def _rng(self, *stream):
+        return np.random.default_rng([self.seed, *stream])
+
+    def adspend(self):
+        """
+        Generates the ad spend: one row per network, country and day with spend, plus extra rows for some cells,
+        a few missing values and exact duplicates.
+
+        :return: Columns event_date, network_id, country_id and value_usd.
+        :rtype: pandas.DataFrame
+        """
+        rng = self._rng(0)
+        cells = pd.MultiIndex.from_product([self.dates, self.network_ids, self.country_ids],
+                                           names=['event_date', 'network_id', 'country_id']).to_frame(index=False)
+        # Spend follows the install volume of the network and country
+        weight = np.repeat(np.outer(self.network_weights, self.country_weights).ravel()[None, :], len(self.dates), 0)
+        weight = weight.ravel() * self.n_installs / len(self.dates)
+        has_spend = rng.random(len(cells)) < np.minimum(1, 2 * weight)
+        df = cells[has_spend].reset_index(drop=True)
+        df['value_usd'] = rng.gamma(2.0, 1.0 + weight[has_spend]) * 1.5
+        df = pd.concat([df, df.sample(frac=0.2, random_state=rng.integers(2 ** 31))], ignore_index=True)
+        df.loc[rng.random(len(df)) < 0.001, 'value_usd'] = np.nan
+        df = pd.concat([df, df.sample(frac=0.001, random_state=rng.integers(2 ** 31))], ignore_index=True)
+        return self._with_string_dates(df)
+
+    def chunks(self):
+        """
+        Generates the installs, payouts and revenue chunk by chunk.
+
+        :return: Tuples of (installs, payouts, revenue) frames per chunk of installs.
+        :rtype: generator
+        """
+        for chunk, start in enumerate(range(0, self.n_installs, self.chunk_installs)):
+            yield self._chunk(chunk + 1, start, min(self.chunk_installs, self.n_installs - start))
+
+    def _chunk(self, chunk, start, n):
+        rng = self._rng(chunk)
+        install_dates = self.dates.values[rng.integers(0, len(self.dates), n)]
+        installs = pd.DataFrame({'install_id': self._ids(n, start),
+                                 'event_date': install_dates,
+                                 'network_id': rng.choice(self.network_ids, n, p=self.network_weights),
+                                 'country_id': rng.choice(self.country_ids, n, p=self.country_weights)})
+        installs = pd.concat([installs, installs.sample(frac=0.001, random_state=rng.integers(2 ** 31))],
+                             ignore_index=True)
+
+        # Most users are barely active, a few are very active
+        activity = rng.gamma(0.3, 1 / 0.3, n)
+        events = []
+        for per_install, scale in [(PAYOUTS_PER_INSTALL, 0.5), (REVENUE_PER_INSTALL, 1.0)]:
+            counts = rng.poisson(activity * per_install)
+            install = np.repeat(np.arange(n), counts)
+            offset = np.minimum(rng.geometric(0.12, len(install)) - 1, len(self.dates))
+            df = pd.DataFrame({'install_id': installs['install_id'].to_numpy()[install],
+                               'event_date': install_dates[install] + offset.astype('timedelta64[D]'),
+                               'value_usd': (rng.pareto(1.8, len(install)) + 0.05) * scale})
+            df.loc[rng.random(len(df)) < 0.001, 'value_usd'] = np.nan
+            df = pd.concat([df, df.sample(frac=0.001, random_state=rng.integers(2 ** 31))], ignore_index=True)
+            # The original tables are not sorted by install
+            events.append(df.iloc[rng.permutation(len(df))])
+        return tuple(self._with_string_dates(df) for df in [installs] + events)
+
+    @staticmethod
+    def _with_string_dates(df):
+        # Like the CSVs, which DataCleaning.date_column_type parses
+        df = df.reset_index(drop=True)
+        df['event_date'] = pd.to_datetime(df['event_date']).dt.strftime('%Y-%m-%d')
+        return df
+
+    def frames(self):
+        """
+        Generates all four tables in memory.
+
+        :return: The 'adspend', 'installs', 'payouts' and 'revenue' frames.
+        :rtype: dict
+        """
+        installs, payouts, revenue = (pd.concat(frames, ignore_index=True) for frames in zip(*self.chunks()))
+        return {'adspend': self.adspend(), 'installs': installs, 'payouts': payouts, 'revenue': revenue}
+
+    def write_csv(self, directory):
+        """
+        Writes the four tables as adspend.csv, installs.csv, payouts.csv and revenue.csv, one chunk at a time.
+
+        :param directory: The output directory; it is created if needed.
+        :type directory: str
+        :return: The paths of the files by table name.
+        :rtype: dict
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = {name: os.path.join(directory, f'{name}.csv') for name in ['adspend', 'installs', 'payouts', 'revenue']}
+        self.adspend().to_csv(paths['adspend'], index=False)
+        for i, chunk in enumerate(self.chunks()):
+            for name, df in zip(['installs', 'payouts', 'revenue'], chunk):
+                df.to_csv(paths[name], mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        return paths
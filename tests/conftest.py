@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_wrangling import DataCleaning  # noqa: E402
+from synthetic_data import SyntheticData  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def kpi_frames():
+    # Cleaned synthetic adspend, installs, payouts and revenue frames with their dates broken down. Tests copy
+    # them before changing them
+    frames = SyntheticData.for_rows(20_000, days=40).frames()
+    for name, df in frames.items():
+        cleaner = DataCleaning(data=df, columns=list(df.columns))
+        cleaner.id_columns_to_object()
+        cleaner.date_column_type()
+        if 'value_usd' in df.columns:
+            cleaner.fill_missing_values(verbose=False)
+        df = cleaner.data.drop_duplicates(['install_id'] if name == 'installs' else None).reset_index(drop=True)
+        frames[name] = DataCleaning.break_down_date(df)
+    return frames
@@ -0,0 +1,62 @@
+import pandas as pd
+from aggregate_cache import AggregateCache
+from KPIs import KpiAnalytics
+
+
+def test_least_recently_used_entries_are_evicted_under_the_byte_cap():
+    cache = AggregateCache(max_bytes=30)
+    for key in 'abc':
+        cache.put(('ns', key), bytes(10))
+    assert cache.current_bytes == 30
+
+    # Reading 'a' makes 'b' the least recently used entry
+    assert cache.get_or_compute(('ns', 'a'), lambda: None) == bytes(10)
+    cache.put(('ns', 'd'), bytes(10))
+    assert ('ns', 'b') not in cache and all(('ns', key) in cache for key in 'acd')
+
+    cache.put(('ns', 'e'), bytes(25))
+    assert [key for key in 'acde' if ('ns', key) in cache] == ['e']
+    assert cache.current_bytes == 25
+
+    # A value larger than the cap on its own is not stored, and replaces the entry it was stored under
+    cache.put(('ns', 'e'), bytes(31))
+    assert len(cache) == 0 and cache.current_bytes == 0
+
+
+def test_invalidate_drops_the_matching_entries_of_a_namespace():
+    cache = AggregateCache()
+    for namespace in ['x', 'y']:
+        for name in ['profit', 'retention']:
+            cache.put((namespace, name), bytes(1))
+
+    cache.invalidate('x', lambda key: key[1] == 'profit')
+    assert set(cache._entries) == {('x', 'retention'), ('y', 'profit'), ('y', 'retention')}
+    cache.invalidate('y')
+    assert set(cache._entries) == {('x', 'retention')}
+    cache.invalidate()
+    assert len(cache) == 0 and cache.current_bytes == 0
+
+
+def test_keys_carry_the_versions_of_the_frames_they_depend_on(kpi_frames):
+    frames = kpi_frames
+    cache = AggregateCache()
+    analytics = KpiAnalytics(**{f'{name}_df': df for name, df in frames.items()}, cache=cache)
+    other = KpiAnalytics(**{f'{name}_df': df for name, df in frames.items()}, cache=cache)
+    acquisition = analytics._cache_key('user_acquisition_costs', 'network_id')
+    revenue = analytics._cache_key('revenue_generated_per_install', 'network_id')
+    assert acquisition != other._cache_key('user_acquisition_costs', 'network_id')
+
+    analytics.user_acquisition_costs('network_id')
+    analytics.revenue_generated_per_install('network_id')
+    analytics.revenue_df = frames['revenue'].iloc[::2].reset_index(drop=True)
+    assert analytics._cache_key('user_acquisition_costs', 'network_id') == acquisition
+    assert analytics._cache_key('revenue_generated_per_install', 'network_id') != revenue
+
+    hits, misses = cache.hits, cache.misses
+    analytics.user_acquisition_costs('network_id')
+    assert cache.hits > hits and cache.misses == misses
+    got = analytics.revenue_generated_per_install('network_id')
+    assert cache.misses > misses
+    expected = KpiAnalytics(**{f'{name}_df': df for name, df in frames.items() if name != 'revenue'},
+                            revenue_df=frames['revenue'].iloc[::2].reset_index(drop=True))
+    pd.testing.assert_frame_equal(got, expected.revenue_generated_per_install('network_id'))
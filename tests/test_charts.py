@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+from data_analytics import downsample_frame, lttb, render_charts
+
+
+def test_lttb_keeps_endpoints_and_extremes():
+    rng = np.random.default_rng(0)
+    y = np.cumsum(rng.normal(size=10_000))
+    y[3_001], y[7_777] = y.max() + 50, y.min() - 50
+    x = pd.date_range('2022-01-01', periods=len(y), freq='min')
+
+    kept = lttb(x, y, 200)
+    assert len(kept) == 200 and (np.diff(kept) > 0).all()
+    assert {0, len(y) - 1, 3_001, 7_777} <= set(kept)
+    # Short lines are kept whole
+    assert (lttb(x[:100], y[:100], 200) == np.arange(100)).all()
+
+
+def test_lines_are_downsampled_like_single_lines():
+    rng = np.random.default_rng(1)
+    data = pd.DataFrame({'day': np.tile(np.arange(1_000), 3), 'network_id': np.repeat([3, 1, 2], 1_000),
+                         'value': rng.normal(size=3_000)}).sample(frac=1, random_state=0)
+    got = downsample_frame(data, 'day', 'value', 50, 'network_id')
+    for network_id, line in data.groupby('network_id', sort=False):
+        line = line.sort_values('day')
+        expected = line.iloc[lttb(line['day'], line['value'], 50)]
+        pd.testing.assert_frame_equal(got[got['network_id'] == network_id], expected[['day', 'value', 'network_id']])
+
+
+def test_render_charts_writes_images(tmp_path):
+    data = pd.DataFrame({'event_date': np.tile(pd.date_range('2022-01-01', periods=5_000, freq='h'), 2),
+                         'network_id': np.repeat([1, 2], 5_000), 'profit_usd': np.arange(10_000.0)})
+    specs = [{'chart': 'time_series_breakdown', 'data': data, 'x_column': 'event_date', 'y_column': 'profit_usd',
+              'breakdown_column': 'network_id', 'path': str(tmp_path / 'breakdown.png')},
+             {'chart': 'bar_chart', 'data': data.groupby('network_id', as_index=False)['profit_usd'].sum(),
+              'x_column': 'network_id', 'y_column': 'profit_usd', 'path': str(tmp_path / 'bar.svg')}]
+    paths = render_charts(specs, workers=2)
+    assert paths == [spec['path'] for spec in specs]
+    with open(paths[0], 'rb') as f:
+        assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+    with open(paths[1]) as f:
+        assert '<svg' in f.read()
@@ -0,0 +1,22 @@
+import pandas as pd
+from date_index import DateIndex, date_index_of, sort_by_date
+
+
+def test_match_is_checked_once_per_frame(monkeypatch):
+    df = sort_by_date(pd.DataFrame({'event_date': pd.to_datetime(['2022-01-03', '2022-01-01', '2022-01-02',
+                                                                  '2022-01-01']),
+                                    'value': range(4)}))
+    checks = []
+    matches = DateIndex.matches
+    monkeypatch.setattr(DateIndex, 'matches', lambda self, dates: checks.append(len(dates)) or matches(self, dates))
+
+    index = date_index_of(df)
+    assert index is not None and date_index_of(df) is index
+    assert checks == [4]
+
+    # Frames derived from the indexed one carry the index in attrs and are checked again
+    assert date_index_of(df.iloc[::-1]) is None
+    assert date_index_of(df.iloc[:2]) is None
+    df['event_date'] = df['event_date'].iloc[::-1].to_numpy()
+    assert date_index_of(df) is None
+    assert len(checks) == 4
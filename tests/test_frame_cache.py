@@ -0,0 +1,55 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from frame_cache import FrameCache
+
+
+def test_extension_dtypes_round_trip(tmp_path):
+    cache = FrameCache(str(tmp_path))
+    df = pd.DataFrame({
+        'local': pd.Series(pd.date_range('2022-03-26', periods=4, freq='12H', tz='Europe/Berlin')),
+        'count': pd.array([1, None, 3, 4], dtype='Int64'),
+        'share': pd.array([0.5, None, 1.5, 2.0], dtype='Float64'),
+        'paid': pd.array([True, None, False, True], dtype='boolean'),
+        'label': pd.array(['a', None, 'c', 'd'], dtype='string'),
+        'value': np.arange(4.0),
+    }, index=[10, 11, 12, 13])
+    df.loc[11, 'local'] = pd.NaT
+    cache.put('entry', df)
+    pd.testing.assert_frame_equal(cache.get('entry'), df)
+
+
+def test_unrestorable_dtype_is_rejected(tmp_path, monkeypatch):
+    cache = FrameCache(str(tmp_path))
+    df = pd.DataFrame({'value': pd.array([1, 2], dtype='Int64')})
+    monkeypatch.setattr(FrameCache, '_restorable', staticmethod(lambda name, dtype: False))
+    with pytest.raises(TypeError):
+        cache.put('entry', df)
+    assert 'entry' not in cache
+
+
+def test_concurrent_fingerprints(tmp_path, monkeypatch):
+    sources = []
+    for i in range(8):
+        path = tmp_path / f'source{i}.csv'
+        path.write_text(f'a,b\n{i},{i}\n')
+        sources.append(str(path))
+    cache = FrameCache(str(tmp_path / 'cache'))
+    threads = [threading.Thread(target=cache.fingerprint, args=(path,)) for path in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every fingerprint was remembered, so none of the files is read again
+    opened = []
+    real_open = open
+    monkeypatch.setattr('builtins.open', lambda path, *args, **kwargs: opened.append(os.fspath(path)) or real_open(
+        path, *args, **kwargs))
+    fingerprints = [FrameCache(str(tmp_path / 'cache')).fingerprint(path) for path in sources]
+    monkeypatch.undo()
+    assert not set(opened) & set(sources)
+    assert len(set(fingerprints)) == len(sources)
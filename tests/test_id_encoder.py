@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+from data_wrangling import DataCleaning, IdEncoder
+from KPIs import KpiAnalytics
+
+
+def test_encode_decode_round_trip():
+    encoder = IdEncoder()
+    first = encoder.encode('install_id', pd.Series(['b', 'a', 'b'], index=[5, 6, 7]))
+    # Codes of a later batch continue from the labels seen before
+    second = encoder.encode('install_id', pd.Series(['c', 'a']))
+    assert first.tolist() == [0, 1, 0] and first.index.tolist() == [5, 6, 7]
+    assert second.tolist() == [2, 1]
+
+    df = pd.DataFrame({'install_id': pd.concat([first, second], ignore_index=True), 'value': range(5)})
+    assert encoder.decode(df)['install_id'].tolist() == ['b', 'a', 'b', 'c', 'a']
+    # Missing codes, e.g. from outer joins, become missing labels
+    decoded = encoder.decode(pd.DataFrame({'install_id': [1.0, np.nan]}))['install_id']
+    assert decoded[0] == 'a' and pd.isna(decoded[1])
+
+
+@pytest.mark.parametrize('use_cube', [True, False])
+def test_kpis_with_encoded_ids_equal_raw_ids(kpi_frames, use_cube):
+    encoder = IdEncoder()
+    encoded_frames = {}
+    for name, df in kpi_frames.items():
+        cleaner = DataCleaning(data=df.copy(), columns=list(df.columns))
+        cleaner.id_columns_to_codes(encoder)
+        encoded_frames[name] = cleaner.data
+    encoded = KpiAnalytics(**{f'{name}_df': df for name, df in encoded_frames.items()}, id_encoder=encoder,
+                           use_cube=use_cube)
+    raw = KpiAnalytics(**{f'{name}_df': df for name, df in kpi_frames.items()}, use_cube=use_cube)
+
+    for method, args in [('grouped_profit', ('network_id',)), ('grouped_profit', (['country_id', 'year and month'],)),
+                         ('user_acquisition_costs', ('country_id',)), ('revenue_generated_per_install', ()),
+                         ('total_payouts_made_per_install', ('network_id',)), ('user_retention_rate', ('country_id',)),
+                         ('total_profit', ())]:
+        pd.testing.assert_frame_equal(getattr(encoded, method)(*args), getattr(raw, method)(*args), obj=method)
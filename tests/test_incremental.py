@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+from data_wrangling import DATE_PARTS, DataCleaning
+from KPIs import KpiAnalytics
+from synthetic_data import SyntheticData
+
+CUT = pd.Timestamp('2022-01-25')
+
+
+@pytest.fixture(scope='module')
+def frames():
+    frames = SyntheticData.for_rows(30_000, days=40).frames()
+    for name, df in frames.items():
+        cleaner = DataCleaning(data=df, columns=list(df.columns))
+        cleaner.id_columns_to_object()
+        cleaner.date_column_type()
+        if 'value_usd' in df.columns:
+            cleaner.fill_missing_values(verbose=False)
+        df = cleaner.data.drop_duplicates(['install_id'] if name == 'installs' else None).reset_index(drop=True)
+        frames[name] = DataCleaning.break_down_date(df)
+    return frames
+
+
+def _kpis(analytics):
+    return [analytics.grouped_profit('network_id'), analytics.user_retention_rate('country_id'),
+            analytics.revenue_generated_per_install('network_id'), analytics.user_acquisition_costs('country_id')]
+
+
+def test_append_matches_full_recompute(frames):
+    analytics = KpiAnalytics(**{f'{name}_df': df[df['event_date'] < CUT] for name, df in frames.items()})
+    _kpis(analytics)
+    for day in pd.date_range(CUT, frames['installs']['event_date'].max() + pd.Timedelta(days=60)):
+        analytics.append(**{f'{name}_df': df[df['event_date'] == day] for name, df in frames.items()})
+    assert analytics._incremental is not None
+
+    full = KpiAnalytics(**{f'{name}_df': df for name, df in frames.items()})
+    for got, expected in zip(_kpis(analytics), _kpis(full)):
+        pd.testing.assert_frame_equal(got.reset_index(drop=True), expected.reset_index(drop=True), rtol=1e-9)
+
+
+def test_append_keeps_entries_of_other_frames(frames):
+    analytics = KpiAnalytics(**{f'{name}_df': df[df['event_date'] < CUT] for name, df in frames.items()})
+    revenue = analytics.revenue_generated_per_install('network_id')
+    analytics.user_acquisition_costs('network_id')
+    analytics.append(adspend_df=frames['adspend'][frames['adspend']['event_date'] == CUT])
+
+    hits = analytics.cache.hits
+    pd.testing.assert_frame_equal(analytics.revenue_generated_per_install('network_id'), revenue)
+    assert analytics.cache.hits > hits
+    misses = analytics.cache.misses
+    analytics.user_acquisition_costs('network_id')
+    assert analytics.cache.misses > misses
+
+
+def test_append_leaves_the_batch_unchanged(frames):
+    analytics = KpiAnalytics(**{f'{name}_df': df[df['event_date'] < CUT] for name, df in frames.items()})
+    revenue = frames['revenue'][frames['revenue']['event_date'] == CUT].drop(columns=DATE_PARTS)
+    before = revenue.copy()
+    analytics.append(revenue_df=revenue)
+
+    pd.testing.assert_frame_equal(revenue, before)
+    assert set(DATE_PARTS) <= set(analytics.revenue_df.columns)
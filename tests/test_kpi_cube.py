@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+from kpi_cube import KpiCube
+from KPIs import KpiAnalytics
+
+GROUPS = ['network_id', 'country_id', ['network_id', 'country_id'], ['network_id', 'year and month'],
+          ['country_id', 'year'], ['country_id', 'event_date']]
+
+
+@pytest.fixture(scope='module')
+def analytics(kpi_frames):
+    frames = {f'{name}_df': df for name, df in kpi_frames.items()}
+    return KpiAnalytics(**frames), KpiAnalytics(**frames, use_cube=False)
+
+
+@pytest.mark.parametrize('groupby_column', GROUPS)
+@pytest.mark.parametrize('method, kwargs', [('user_acquisition_costs', {}), ('user_acquisition_costs', {'mean': False}),
+                                            ('revenue_generated_per_install', {}),
+                                            ('revenue_generated_per_install', {'mean': False}),
+                                            ('total_payouts_made_per_install', {}),
+                                            ('grouped_profit', {}), ('grouped_profit', {'mean': False})])
+def test_cube_answers_equal_raw_group_bys(analytics, monkeypatch, method, kwargs, groupby_column):
+    cube, raw = analytics
+    queries = []
+    query = KpiCube._query
+    monkeypatch.setattr(KpiCube, '_query', lambda self, *args: queries.append(args) or query(self, *args))
+
+    got = getattr(cube, method)(groupby_column, **kwargs)
+    expected = getattr(raw, method)(groupby_column, **kwargs)
+    assert queries
+    # The outer joins of the raw path turn the calendar columns of the events into floats, the cube keeps integers
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False, rtol=1e-9)
+
+
+@pytest.mark.parametrize('groupby_column', ['network_id', ['country_id', 'install_year and month']])
+def test_cube_retention_equals_raw_group_by(analytics, groupby_column):
+    cube, raw = analytics
+    assert cube.cube().covers_retention(groupby_column)
+    for days_active in [False, True]:
+        pd.testing.assert_frame_equal(cube.user_retention_rate(groupby_column, days_active),
+                                      raw.user_retention_rate(groupby_column, days_active), rtol=1e-9)
+
+
+def test_rollups_read_only_the_cube(analytics):
+    cube = analytics[0].cube()
+    monthly = cube.rollup(['network_id', 'country_id', 'year and month'])
+    # Rolling up the monthly cube gives the same totals as rolling up the day-grain cube
+    pd.testing.assert_frame_equal(monthly.rollup('network_id').data, cube.rollup('network_id').data)
+    assert len(monthly.data) < len(cube.data)
@@ -0,0 +1,70 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pandas as pd
+import pytest
+from kpi_service import KpiService
+
+
+class _FailingAnalytics:
+    def grouped_profit(self, *args, **kwargs):
+        raise RuntimeError('boom')
+
+
+def test_unexpected_error_returns_500_and_is_counted(capsys):
+    service = KpiService(_FailingAnalytics())
+    server = service.serve(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f'{url}/grouped_profit', timeout=10)
+        assert error.value.code == 500
+        assert json.loads(error.value.read()) == {'error': 'RuntimeError: boom'}
+
+        with urllib.request.urlopen(f'{url}/metrics', timeout=10) as response:
+            metrics = json.loads(response.read())
+        assert metrics['endpoints']['grouped_profit']['errors'] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'RuntimeError: boom' in capsys.readouterr().err
+
+
+class _CountingAnalytics:
+    def __init__(self):
+        self.rows = 1
+
+    def grouped_profit(self, *args, **kwargs):
+        return pd.DataFrame({'network_id': [1], 'profit_usd': [float(self.rows)]})
+
+    def append(self, **frames):
+        self.rows += 1
+
+
+def test_answer_computed_before_append_is_not_kept(monkeypatch):
+    service = KpiService(_CountingAnalytics())
+    encoding, release = threading.Event(), threading.Event()
+    encode = KpiService._encode
+
+    def slow_encode(df):
+        encoding.set()
+        release.wait(10)
+        return encode(df)
+
+    monkeypatch.setattr(service, '_encode', slow_encode)
+    answers = []
+    thread = threading.Thread(target=lambda: answers.append(service.answer('grouped_profit', {})))
+    thread.start()
+    assert encoding.wait(10)
+    # The append lands while the pre-append answer is being encoded, before it is stored
+    service.append()
+    release.set()
+    thread.join()
+
+    body, cached = service.answer('grouped_profit', {})
+    assert json.loads(answers[0][0])[0]['profit_usd'] == 1
+    assert not cached and json.loads(body)[0]['profit_usd'] == 2
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+from KPIs import KpiAnalytics
+from out_of_core import EventPartitions, OutOfCoreKpiAnalytics
+
+
+@pytest.fixture(scope='module')
+def analytics(kpi_frames, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('events'))
+    # Chunks of the events, as StreamingDataCleaning yields them, into few buckets
+    partitions = {source: EventPartitions.from_chunks(np.array_split(kpi_frames[source], 7), directory, n_buckets=16)
+                  for source in ['revenue', 'payouts']}
+    # A budget far below the event tables, so the buckets are joined in several batches
+    out_of_core = OutOfCoreKpiAnalytics(kpi_frames['installs'], memory_budget=200_000, **partitions)
+    assert len(list(partitions['revenue'].batches(out_of_core.memory_budget))) > 2
+    yield out_of_core, KpiAnalytics(**{f'{name}_df': df for name, df in kpi_frames.items()}, use_cube=False)
+    for events in partitions.values():
+        events.close()
+
+
+@pytest.mark.parametrize('method', ['revenue_generated_per_install', 'total_payouts_made_per_install'])
+@pytest.mark.parametrize('groupby_column', ['install_id', 'network_id', ['country_id', 'year and month']])
+@pytest.mark.parametrize('mean', [True, False])
+def test_out_of_core_equals_in_memory(analytics, method, groupby_column, mean):
+    out_of_core, in_memory = analytics
+    got = getattr(out_of_core, method)(groupby_column, mean)
+    expected = getattr(in_memory, method)(groupby_column, mean)
+    if groupby_column == 'install_id':
+        pd.testing.assert_frame_equal(got, expected)
+    else:
+        # The partial sums of the batches are added in another order
+        pd.testing.assert_frame_equal(got, expected, rtol=1e-12)
@@ -0,0 +1,24 @@
+import KPIs
+import pandas as pd
+import pytest
+from KPIs import KpiAnalytics
+
+CASES = [('revenue_generated_per_install', ('install_id',)), ('revenue_generated_per_install', ('network_id',)),
+         ('total_payouts_made_per_install', (['network_id', 'year and month'],)),
+         ('user_retention_rate', ('network_id',)), ('user_retention_rate', (['country_id', 'install_date'], True)),
+         ('total_profit', ()), ('grouped_profit', ('country_id',))]
+
+
+@pytest.mark.parametrize('use_cube', [False, True])
+def test_two_workers_equal_serial(kpi_frames, monkeypatch, use_cube):
+    joins = []
+    partitioned_joins = KPIs.partitioned_joins
+    monkeypatch.setattr(KPIs, 'partitioned_joins', lambda *args: joins.append(partitioned_joins(*args)) or joins[-1])
+
+    frames = {f'{name}_df': df for name, df in kpi_frames.items()}
+    parallel = KpiAnalytics(**frames, workers=2, use_cube=use_cube)
+    serial = KpiAnalytics(**frames, use_cube=use_cube)
+    for method, args in CASES:
+        pd.testing.assert_frame_equal(getattr(parallel, method)(*args), getattr(serial, method)(*args), obj=method)
+    # The joins ran on the process pool instead of falling back to the serial ones
+    assert joins and all(result is not None for result in joins)
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+import pipeline
+import pytest
+from pipeline import SOURCES, Pipeline, module_closure
+from synthetic_data import SyntheticData
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def data_directory(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('data'))
+    SyntheticData.for_rows(6_000, days=40).write_csv(directory)
+    return directory
+
+
+def _pipeline(data_directory, output, **options):
+    return Pipeline(data_directory, str(output), workers=1, **options)
+
+
+def test_plan_runs_loads_and_skips(data_directory, tmp_path):
+    actions, _ = _pipeline(data_directory, tmp_path).plan(['kpis'])
+    assert actions == dict.fromkeys(SOURCES + ['analytics', 'kpis'], 'run')
+
+    _pipeline(data_directory, tmp_path).run(['kpis', 'profit'])
+    actions, _ = _pipeline(data_directory, tmp_path).plan(['kpis', 'profit'])
+    assert set(actions.values()) == {'skip'}
+
+    # The forecast runs from the profit written by the first run, so nothing before it runs again
+    actions, _ = _pipeline(data_directory, tmp_path).plan(['forecast'])
+    assert actions == {**dict.fromkeys(SOURCES + ['analytics'], 'skip'), 'profit': 'load', 'forecast': 'run'}
+
+    os.remove(os.path.join(tmp_path, 'profit.csv'))
+    actions, _ = _pipeline(data_directory, tmp_path).plan(['kpis', 'profit'])
+    assert actions == {**dict.fromkeys(SOURCES + ['analytics', 'profit'], 'run'), 'kpis': 'skip'}
+
+
+def test_option_change_reruns_only_affected_stages(data_directory, tmp_path):
+    _pipeline(data_directory, tmp_path).run(['profit', 'forecast'])
+    timings = _pipeline(data_directory, tmp_path, horizon=7).run(['profit', 'forecast'])
+    actions = {name: timing['action'] for name, timing in timings.items() if isinstance(timing, dict)}
+    assert actions == {**dict.fromkeys(SOURCES + ['analytics'], 'skip'), 'profit': 'load', 'forecast': 'run'}
+
+
+def test_helper_module_change_reruns_its_users(data_directory, tmp_path, monkeypatch):
+    assert {'date_index', 'data_wrangling', 'tracing'} <= set(module_closure(['KPIs']))
+    assert 'tracing' in module_closure(['hypothesis_and_forecast'])
+
+    _pipeline(data_directory, tmp_path).run(['kpis', 'forecast'])
+    fingerprint = pipeline._module_fingerprint
+    monkeypatch.setattr(pipeline, '_module_fingerprint',
+                        lambda name: 'changed' if name == 'date_index' else fingerprint(name))
+    actions, _ = _pipeline(data_directory, tmp_path).plan(['kpis', 'forecast'])
+    assert actions == dict.fromkeys(SOURCES + ['analytics', 'kpis', 'profit', 'forecast'], 'run')
+
+
+def test_kpi_run_imports_no_plotting_or_statistics(data_directory, tmp_path):
+    script = ('import sys, pipeline\n'
+              f'pipeline.Pipeline({data_directory!r}, {str(tmp_path)!r}, workers=1).run(["kpis"])\n'
+              'print(sorted(m for m in ("matplotlib", "statsmodels", "scipy.stats") if m in sys.modules))\n')
+    output = subprocess.run([sys.executable, '-c', script], cwd=REPO, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == '[]'
+    assert os.path.exists(os.path.join(tmp_path, 'kpis', 'total_profit.csv'))
@@ -0,0 +1,36 @@
+import pandas as pd
+from KPIs import KpiAnalytics
+
+
+def _analytics():
+    dates = pd.to_datetime(['2022-01-01', '2022-01-02', '2022-02-01', '2022-02-03'])
+    installs = pd.DataFrame({'install_id': ['a', 'b', 'c', 'd'], 'event_date': dates,
+                             'network_id': [1, 1, 2, 2], 'country_id': [1, 2, 1, 2]})
+    events = pd.DataFrame({'install_id': ['a', 'b', 'c', 'd'], 'event_date': dates + pd.Timedelta(days=1),
+                           'value_usd': [1.0, 2.0, 3.0, 4.0]})
+    adspend = installs[['event_date', 'network_id', 'country_id']].assign(value_usd=10.0)
+    return KpiAnalytics(adspend, installs, events, events.copy())
+
+
+def test_sub_analytics_own_their_frames():
+    analytics = _analytics()
+    plan = analytics.query().where(network_id=[1]).user_retention_rate('network_id').plan()
+    frames = {'installs': analytics.installs_df[analytics.installs_df['network_id'] == 1]}
+    sub = plan._sub_analytics(frames, {'adspend': set(), 'installs': {'install_id', 'event_date', 'network_id'},
+                                       'payouts': set(), 'revenue': set()})
+    # Deriving date columns on a slice of the filtered frames would raise SettingWithCopyWarning
+    assert all(getattr(sub, f'{name}_df')._is_copy is None for name in ['adspend', 'installs', 'payouts', 'revenue'])
+    result = analytics.query().where(network_id=[1]).user_retention_rate('network_id').collect()
+    assert result['total_users'].tolist() == [2]
+
+
+def test_collected_results_are_copies():
+    analytics = _analytics()
+    query = analytics.query().where(country_id=[1]).grouped_profit('network_id')
+    first = query.collect()
+    expected = first.copy()
+    first['profit_usd'] = 0
+
+    second = query.collect()
+    assert second is not first
+    pd.testing.assert_frame_equal(second, expected)
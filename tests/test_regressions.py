@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from hypothesis_and_forecast import HYPOTHESES, ForeCast
+from KPIs import KpiAnalytics
+
+
+@pytest.fixture(scope='module')
+def forecast(kpi_frames):
+    return ForeCast(df=KpiAnalytics(**{f'{name}_df': df for name, df in kpi_frames.items()}).total_profit())
+
+
+# statsmodels divides by the zero residual degrees of freedom of two-row segments
+@pytest.mark.filterwarnings('ignore:invalid value encountered:RuntimeWarning')
+@pytest.mark.parametrize('by', ['network_id', ['country_id', 'year and month']])
+def test_regressions_equal_ols_per_segment(forecast, by):
+    result = forecast.regressions(by=by)
+    columns = [by] if isinstance(by, str) else by
+    assert len(result) == len(HYPOTHESES) * forecast.df.groupby(columns).ngroups
+
+    for _, row in result.iterrows():
+        segment = forecast.df
+        for col in columns:
+            segment = segment[segment[col] == row[col]]
+        segment = segment.dropna(subset=[row['x'], row['y']])
+        assert row['n'] == len(segment)
+        if segment[row['x']].nunique() < 2:
+            # The slope of a constant x is undefined; statsmodels would drop the constant and fit another model
+            assert np.isnan(row['slope'])
+            continue
+        model = sm.OLS(segment[row['y']], sm.add_constant(segment[row['x']])).fit()
+        np.testing.assert_allclose([row['intercept'], row['slope']], model.params, rtol=1e-8, atol=1e-9)
+        np.testing.assert_allclose(row['r_squared'], model.rsquared, rtol=1e-8, atol=1e-12)
+        if row['n'] == 2:
+            # No residual degrees of freedom are left for the standard errors
+            assert np.isnan(row['slope_se']) and np.isnan(row['p_value'])
+            continue
+        np.testing.assert_allclose([row['intercept_se'], row['slope_se']], model.bse, rtol=1e-8, atol=1e-9)
+        np.testing.assert_allclose(row['p_value'], model.pvalues.iloc[1], rtol=1e-6, atol=1e-12)
+
+
+def test_bootstrap_intervals_do_not_depend_on_workers(forecast):
+    serial = forecast.regressions(by='network_id', bootstrap=300, seed=1)
+    parallel = forecast.regressions(by='network_id', bootstrap=300, seed=1, workers=2)
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert (serial['slope_ci_low'] <= serial['slope']).all() and (serial['slope'] <= serial['slope_ci_high']).all()
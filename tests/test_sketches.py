@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from seen_rows import row_fingerprints
+from sketches import DEFAULT_PRECISION, DEFAULT_RELATIVE_ACCURACY, HyperLogLogs, KpiSketches, QuantileSketches
+
+
+def _hashes(ids):
+    return row_fingerprints(pd.DataFrame({'install_id': ids}))
+
+
+def test_hyperloglog_relative_error():
+    rng = np.random.default_rng(0)
+    n_cells, n_ids = 200, 20_000
+    ids = rng.choice(2 ** 50, n_cells * n_ids, replace=False)
+    cells = np.repeat(np.arange(n_cells), n_ids)
+    sketches = HyperLogLogs()
+    # Every id twice, which must not change the estimate
+    sketches.add(np.concatenate([cells, cells]), _hashes(np.concatenate([ids, ids])))
+
+    error = sketches.estimate() / n_ids - 1
+    standard_error = 1.04 / np.sqrt(2 ** DEFAULT_PRECISION)
+    assert abs(error.mean()) < standard_error
+    assert error.std() < 1.25 * standard_error
+    assert (np.abs(error) < 2 * standard_error).mean() > 0.9
+
+
+def test_quantiles_within_relative_accuracy():
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(0, 2, 50_000) * rng.choice([-1, 1], 50_000, p=[0.1, 0.9])
+    cells = rng.integers(0, 5, len(values))
+    sketches = QuantileSketches()
+    sketches.add(cells, values)
+
+    q = [0, 0.01, 0.25, 0.5, 0.75, 0.99, 1]
+    expected = np.quantile(values, q, method='lower')
+    got = sketches.quantiles(q)[0]
+    assert (np.abs(got - expected) <= DEFAULT_RELATIVE_ACCURACY * np.abs(expected) + 1e-12).all()
+
+    for cell, row in enumerate(sketches.quantiles(q, np.arange(5), 5)):
+        expected = np.quantile(values[cells == cell], q, method='lower')
+        assert (np.abs(row - expected) <= DEFAULT_RELATIVE_ACCURACY * np.abs(expected) + 1e-12).all()
+
+
+def _events(rng, n, n_ids):
+    return pd.DataFrame({'install_id': rng.integers(0, n_ids, n),
+                         'event_date': pd.Timestamp('2022-01-01') + pd.to_timedelta(rng.integers(0, 30, n), 'D'),
+                         'network_id': rng.integers(1, 4, n),
+                         'country_id': rng.integers(1, 6, n),
+                         'value_usd': rng.pareto(1.8, n)})
+
+
+def test_merge_equals_single_pass():
+    rng = np.random.default_rng(2)
+    installs, revenue = _events(rng, 20_000, 10 ** 9).drop(columns='value_usd'), _events(rng, 30_000, 10 ** 9)
+    single = KpiSketches().update(installs_df=installs, revenue_df=revenue)
+
+    # Two partitions of the rows in another order, with cells the other partition does not have
+    first = np.arange(len(revenue)) % 3 == 0
+    merged = KpiSketches().update(installs_df=installs.iloc[::2], revenue_df=revenue[first].iloc[::-1])
+    merged.merge(KpiSketches().update(installs_df=installs.iloc[1::2], revenue_df=revenue[~first]))
+
+    for groupby_column in ['network_id', ['country_id', 'year and month'], 'event_date']:
+        for source in ['installs', 'revenue']:
+            pd.testing.assert_frame_equal(merged.distinct_installs(groupby_column, source),
+                                          single.distinct_installs(groupby_column, source))
+        expected = single.value_quantiles('revenue', (0.1, 0.5, 0.9), groupby_column)
+        got = merged.value_quantiles('revenue', (0.1, 0.5, 0.9), groupby_column)
+        pd.testing.assert_frame_equal(got.drop(columns='mean'), expected.drop(columns='mean'))
+        np.testing.assert_allclose(got['mean'], expected['mean'], rtol=1e-12)
+
+
+def test_rows_with_missing_cell_keys_are_left_out():
+    rng = np.random.default_rng(3)
+    installs = _events(rng, 100, 10 ** 9).drop(columns='value_usd')
+    installs['network_id'] = np.nan
+    sketches = KpiSketches().update(installs_df=installs)
+    assert sketches.distinct_installs('country_id').empty
+
+    installs.loc[:9, 'network_id'] = 1
+    sketches.update(installs_df=installs)
+    assert sketches.distinct_installs('network_id')['installs'].tolist() == [10]
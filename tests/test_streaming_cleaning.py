@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+from data_wrangling import DataCleaning, IdEncoder, StreamingDataCleaning
+from seen_rows import SeenRows
+
+
+def _write(path, install_ids):
+    pd.DataFrame({'install_id': install_ids, 'event_date': '2022-01-01', 'value_usd': 1.0}).to_csv(path, index=False)
+    return str(path)
+
+
+def test_seen_rows_across_runs_with_fresh_encoders(tmp_path):
+    seen_path = str(tmp_path / 'seen.npy')
+    first = StreamingDataCleaning(_write(tmp_path / 'a.csv', ['a', 'b']), id_encoder=IdEncoder(),
+                                  seen=SeenRows(seen_path), break_down_date=False)
+    assert len(first.read()) == 2
+
+    # A new run: the encoder starts over and gives 'z' the code 'a' had, the seen rows come from disk
+    encoder = IdEncoder()
+    second = StreamingDataCleaning(_write(tmp_path / 'b.csv', ['z', 'b']), id_encoder=encoder,
+                                   seen=SeenRows(seen_path), break_down_date=False)
+    data = encoder.decode(second.read())
+    assert data['install_id'].tolist() == ['z']
+    assert second.num_duplicates == 1
+
+
+def test_exact_statistics_match_in_memory_cleaning(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 5_000
+    df = pd.DataFrame({'install_id': rng.integers(0, 10 ** 6, n).astype(str),
+                       'event_date': '2022-01-01',
+                       'value_usd': rng.lognormal(0, 2, n) * rng.choice([-1, 1], n, p=[0.1, 0.9]),
+                       'clicks': rng.integers(0, 5, n)})
+    df.loc[rng.choice(n, 300, replace=False), 'value_usd'] = np.nan
+    path = str(tmp_path / 'events.csv')
+    df.to_csv(path, index=False)
+
+    # Chunks far smaller than the file, so the quartiles come from several passes over the spilled columns
+    cleaning = StreamingDataCleaning(path, chunksize=700, remove_outliers=True, break_down_date=False)
+    outliers = cleaning.compute_statistics()
+
+    # The quartiles over whole columns in memory, each over the rows the earlier columns kept
+    keep = np.ones(n, dtype=bool)
+    for col in ['value_usd', 'clicks']:
+        column = df[col].fillna(cleaning.means[col])
+        lower_bound, upper_bound = DataCleaning.iqr_bounds(column[keep])
+        assert cleaning.bounds[col] == (lower_bound, upper_bound)
+        is_outlier = ((column < lower_bound) | (column > upper_bound)).to_numpy()
+        assert outliers[col] == (is_outlier & keep).sum()
+        keep &= ~is_outlier
+    assert len(cleaning.read()) == keep.sum()
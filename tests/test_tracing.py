@@ -0,0 +1,42 @@
+import threading
+
+import numpy as np
+import pytest
+import tracing
+
+
+@pytest.fixture
+def tracer():
+    tracer = tracing.enable()
+    yield tracer
+    tracing.disable()
+
+
+def _memory(tracer):
+    return {span['name']: span['peak_memory_bytes'] for span in tracer.spans}
+
+
+def test_overlapping_threads_record_no_memory(tracer):
+    if not tracer.memory:
+        pytest.skip('The peak resident set size cannot be reset here')
+    entered, release = threading.Event(), threading.Event()
+
+    def work():
+        with tracing.span('thread'):
+            entered.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=work)
+    with tracing.span('main'):
+        thread.start()
+        entered.wait(10)
+        with tracing.span('main nested'):
+            np.ones(10 ** 6)
+        release.set()
+        thread.join()
+    with tracing.span('main after'):
+        np.ones(10 ** 6)
+
+    memory = _memory(tracer)
+    assert memory['main'] is None and memory['main nested'] is None and memory['thread'] is None
+    assert memory['main after'] is not None
@@ -0,0 +1,340 @@
+import atexit
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+# Set to a file path to trace a whole run and write the trace there at exit
+TRACE_ENV_VAR = 'KPI_TRACE'
+
+_tracer = None
+
+
+def _status_bytes(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    raise OSError(f'{field} not found')
+
+
+def reset_peak_rss():
+    """
+    Resets the kernel's record of the peak resident set size of this process (Linux only).
+
+    :return: True if the peak was reset, False where that is not possible.
+    :rtype: bool
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _status_bytes('VmHWM')
+        return True
+    except OSError:
+        return False
+
+
+def current_rss():
+    """
+    :return: The resident set size of this process in bytes.
+    :rtype: int
+    """
+    return _status_bytes('VmRSS')
+
+
+def peak_rss():
+    """
+    :return: The peak resident set size of this process in bytes since the last reset_peak_rss.
+    :rtype: int
+    """
+    return _status_bytes('VmHWM')
+
+
+def _row_count(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    data = getattr(value, 'data', None)
+    if isinstance(data, pd.DataFrame):
+        return len(data)
+    return None
+
+
+class _NullSpan:
+    """
+    What span returns while tracing is disabled: entering, leaving and annotating it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    One timed stage of a trace. Use it as a context manager; set adds attributes such as row counts.
+    """
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.peak = 0
+        # Whether a span of another thread was open at the same time, see Tracer
+        self.overlapped = False
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.id = next(self.tracer._ids)
+        self.parent = stack[-1].id if stack else None
+        self.depth = len(stack)
+        self.tracer._fold_peak()
+        self.tracer._open(self)
+        if self.tracer.memory:
+            reset_peak_rss()
+            self.rss = current_rss()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu_start
+        self.tracer._fold_peak()
+        self.tracer._close()
+        record = {'id': self.id, 'parent': self.parent, 'depth': self.depth, 'name': self.name,
+                  'thread': threading.get_ident(), 'start': self.start - self.tracer.start,
+                  'wall_seconds': wall, 'cpu_seconds': cpu,
+                  'peak_memory_bytes': self.peak - self.rss if self.tracer.memory and not self.overlapped else None}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.attributes)
+        self.tracer.spans.append(record)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Collects the spans of the instrumented stages: wall time, CPU time, peak memory growth, row counts and, for joins,
+    the join cardinality and fan-out.
+
+    Peak memory is the growth of the process's peak resident set size during the span, which the Linux kernel tracks
+    at no cost; a nested span resets the peak, so the enclosing spans fold the peak seen so far into their own first.
+    Where the peak cannot be reset (not Linux) the memory column is None. The peak is one for the whole process, so
+    it is only recorded for spans during which no other thread had a span open: the spans of concurrent threads
+    reset each other's peaks and share the memory they measure, so their memory column is None as well. Time and
+    rows are recorded for every span.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.start = time.perf_counter()
+        self.memory = reset_peak_rss()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        # The stacks of open spans of every thread, to tell which spans overlap another thread's
+        self._stacks = {}
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _open(self, span):
+        stack = self._stack()
+        with self._lock:
+            others = [other for spans in self._stacks.values() if spans is not stack for other in spans]
+            if others:
+                span.overlapped = True
+                for other in others + stack:
+                    other.overlapped = True
+            stack.append(span)
+            self._stacks[threading.get_ident()] = stack
+
+    def _close(self):
+        stack = self._stack()
+        with self._lock:
+            stack.pop()
+            if not stack:
+                del self._stacks[threading.get_ident()]
+
+    def _fold_peak(self):
+        if self.memory:
+            peak = peak_rss()
+            for span in self._stack():
+                span.peak = max(span.peak, peak)
+
+    def to_json(self, path=None):
+        """
+        Returns the trace as JSON and optionally writes it to a file.
+
+        :param path: The file to write. Default is None (only return the JSON).
+        :type path: str
+        :return: The trace, one record per span in the order the spans ended.
+        :rtype: str
+        """
+        trace = json.dumps({'spans': self.spans}, indent=2, default=str)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(trace)
+        return trace
+
+    def summary(self):
+        """
+        Aggregates the spans per stage.
+
+        :return: Per stage name: the number of calls, the total wall time, the self time (without nested stages), the
+            CPU time, the largest peak memory growth and the summed row counts, the slowest stage first.
+        :rtype: pandas.DataFrame
+        """
+        columns = ['calls', 'wall_seconds', 'self_seconds', 'cpu_seconds', 'peak_memory_bytes', 'rows_in', 'rows_out']
+        if not self.spans:
+            return pd.DataFrame(columns=['name'] + columns)
+        df = pd.DataFrame(self.spans)
+        children = df.groupby('parent')['wall_seconds'].sum()
+        df['self_seconds'] = df['wall_seconds'] - df['id'].map(children).fillna(0)
+        for column in ['rows_in', 'rows_out', 'peak_memory_bytes']:
+            if column not in df:
+                df[column] = None
+        summary = df.groupby('name').agg(calls=('id', 'size'), wall_seconds=('wall_seconds', 'sum'),
+                                         self_seconds=('self_seconds', 'sum'), cpu_seconds=('cpu_seconds', 'sum'),
+                                         peak_memory_bytes=('peak_memory_bytes', 'max'),
+                                         rows_in=('rows_in', 'sum'), rows_out=('rows_out', 'sum'))
+        return summary.sort_values('wall_seconds', ascending=False).reset_index()
+
+
+def enable():
+    """
+    Starts tracing the instrumented stages into a new tracer.
+
+    :return: The tracer.
+    :rtype: Tracer
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    """
+    Stops tracing.
+
+    :return: The tracer that was active, or None.
+    :rtype: Tracer
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def active():
+    """
+    :return: The active tracer, or None while tracing is disabled.
+    :rtype: Tracer
+    """
+    return _tracer
+
+
+def span(name, **attributes):
+    """
+    Opens a span for a stage that is not a whole function, e.g. `with span('ForeCast.ols', rows_in=len(x)):`.
+
+    :param name: The stage name.
+    :type name: str
+    :param attributes: Extra attributes of the span.
+    :return: A context manager; a shared no-op object while tracing is disabled.
+    :rtype: Span
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return Span(_tracer, name, attributes)
+
+
+def traced(name):
+    """
+    Decorates a function or method as a traced stage. The rows in are those of the first argument that is a frame or
+    has a `data` frame (e.g. a DataCleaning instance), the rows out those of the returned frame or else of that same
+    argument after the call. While tracing is disabled the wrapper only checks one global.
+
+    :param name: The stage name, e.g. 'KpiAnalytics.total_profit'.
+    :type name: str
+    :return: The decorator.
+    :rtype: callable
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+            source = next((arg for arg in args if _row_count(arg) is not None), None)
+            with Span(_tracer, name, {'rows_in': _row_count(source)}) as current:
+                result = fn(*args, **kwargs)
+                rows_out = _row_count(result)
+                current.set(rows_out=rows_out if rows_out is not None else _row_count(source))
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+def _unique_keys(frame, keys):
+    keys = keys if isinstance(keys, list) else [keys]
+    # Series and frames can also be joined on their index levels
+    if isinstance(frame, pd.Series) or not set(keys) <= set(frame.columns):
+        frame = frame.reset_index()
+    return not frame.duplicated(keys).any()
+
+
+def merge(left, right, name='merge', **kwargs):
+    """
+    pandas.merge, traced as a join: besides the time and rows it records whether the keys are unique on either side
+    (one_to_one, one_to_many, many_to_one or many_to_many) and the fan-out, the output rows per left row. Checking the
+    keys costs a pass over both key columns, which is only paid while tracing.
+
+    :param left: The left frame.
+    :type left: pandas.DataFrame
+    :param right: The right frame.
+    :type right: pandas.DataFrame
+    :param name: The stage name. Default is 'merge'.
+    :type name: str
+    :param kwargs: The arguments of pandas.merge.
+    :return: The merged frame.
+    :rtype: pandas.DataFrame
+    """
+    if _tracer is None:
+        return pd.merge(left, right, **kwargs)
+    with Span(_tracer, name, {'rows_in': len(left) + len(right), 'left_rows': len(left),
+                              'right_rows': len(right), 'how': kwargs.get('how', 'inner')}) as current:
+        result = pd.merge(left, right, **kwargs)
+        on = kwargs.get('on')
+        left_on, right_on = kwargs.get('left_on', on), kwargs.get('right_on', on)
+        if left_on is not None and right_on is not None:
+            left_unique, right_unique = _unique_keys(left, left_on), _unique_keys(right, right_on)
+            current.set(cardinality=f"{'one' if left_unique else 'many'}_to_{'one' if right_unique else 'many'}")
+        current.set(rows_out=len(result), fan_out=len(result) / len(left) if len(left) else None)
+    return result
+
+
+def _trace_run(path):
+    tracer = enable()
+    atexit.register(lambda: tracer.to_json(path))
+
+
+if os.environ.get(TRACE_ENV_VAR):
+    _trace_run(os.environ[TRACE_ENV_VAR])